@@ -13,13 +13,25 @@ from .models import (
     Identity,
     Ledger,
     LedgerType,
+    RollupSigningSession,
     Transaction,
+    TrimmedRecord,
     TxRollup,
+    TxRollupHead,
     Vendor,
     set_connection_info,
+    close_pools,
+    Snapshot,
     get_migrations,
     publish_migrations,
     automigrate,
+    upgrade_schema,
 )
 from .version import version
-from .helpers import parse_timestamp
+from .clearing import ClearingGraph, ClearingHouse
+from .helpers import DEFAULT_PRAGMAS, parse_timestamp
+from .memory import MemoryEngine
+from .mirror import InProcessTransport, SocketTransport
+from .scheduler import RollupScheduler
+from .segments import ArchiveSegment, SegmentWriter
+from .sharding import SHARD_PRAGMAS, ShardMap
@@ -3,6 +3,7 @@ from .Account import Account
 from .ArchivedEntry import ArchivedEntry
 from .Correspondence import Correspondence
 from .Identity import Identity
+from .concurrency import fetch_by_ids
 from bookchain.enums import AccountType, EntryType
 from sqloquent.asyncql import AsyncHashedModel, AsyncRelatedCollection
 from sqloquent.errors import vert, tert
@@ -88,6 +89,10 @@ class ArchivedTransaction(AsyncHashedModel):
 
         if reload:
             await self.entries().reload()
+            accounts = await fetch_by_ids(Account, [e.account_id for e in self.entries])
+            for entry in self.entries:
+                if entry.account_id in accounts:
+                    entry.account = accounts[entry.account_id]
 
         # first check that all ledgers balance
         ledgers = {}
@@ -96,8 +101,6 @@ class ArchivedTransaction(AsyncHashedModel):
             vert(entry.account_id in self.auth_scripts or not entry.account.locking_scripts
                  or entry.type not in entry.account.locking_scripts,
                 f"missing auth script for account {entry.account_id} ({entry.account.name})")
-            if reload:
-                await entry.account().reload()
             if entry.account.ledger_id not in ledgers:
                 ledgers[entry.account.ledger_id] = {'Dr': 0, 'Cr': 0}
             if entry.type in (EntryType.CREDIT, EntryType.CREDIT.value):
@@ -1,7 +1,9 @@
 from __future__ import annotations
 from .Account import Account
 from .Ledger import Ledger
+from .concurrency import gather_limited
 from bookchain.enums import AccountType
+from bookchain.helpers import _batches
 from sqloquent.asyncql import AsyncHashedModel, AsyncRelatedCollection
 import packify
 
@@ -44,18 +46,92 @@ class Identity(AsyncHashedModel):
         }
 
     async def correspondents(self, reload: bool = False) -> list[Identity]:
-        """Get the correspondents for this Identity."""
+        """Get the correspondents for this Identity. The counterparty
+            Identities of all the Correspondences are loaded with
+            concurrent batched queries.
+        """
         if reload:
             await self.correspondences().reload()
 
-        correspondents = []
-        for correspondence in self.correspondences:
-            if reload:
-                await correspondence.identities().reload()
-            for identity in correspondence.identities:
-                if identity.id != self.id:
-                    correspondents.append(identity)
-        return correspondents
+        ids = [
+            identity_id
+            for correspondence in self.correspondences
+            for identity_id in correspondence.identity_ids.split(',')
+            if identity_id != self.id
+        ]
+        batches = await gather_limited(*[
+            Identity.query().is_in('id', batch).get()
+            for batch in _batches(list(set(ids)))
+        ])
+        identities = {
+            identity.id: identity
+            for batch in batches
+            for identity in batch
+        }
+        return [identities[i] for i in ids if i in identities]
+
+    async def load_correspondents(
+            self, reload: bool = False
+        ) -> dict[str, tuple[Identity, list[Account]]]:
+        """Eagerly loads the counterparty Identities of all the
+            Correspondences of this Identity and the Nostro and Vostro
+            Accounts of each relationship (on both sides) with a
+            constant number of (batched) queries, run concurrently with
+            `gather_limited`. Returns a dict mapping counterparty
+            Identity ID to a tuple of the Identity and the list of
+            Accounts.
+        """
+        if reload:
+            await self.correspondences().reload()
+
+        correspondence_ids = [c.id for c in self.correspondences]
+        ledger_ids = list(set([
+            ledger_id
+            for correspondence in self.correspondences
+            for ledger_id in correspondence.ledger_ids.split(',')
+        ]))
+        account_types = [AccountType.NOSTRO_ASSET.value, AccountType.VOSTRO_LIABILITY.value]
+        ledger_batches = _batches(ledger_ids)
+        results = await gather_limited(
+            self.correspondents(),
+            *[
+                Ledger.query().is_in('id', batch).get()
+                for batch in ledger_batches
+            ],
+            *[
+                Account.query().is_in('correspondence_id', batch).is_in(
+                    'type', account_types
+                ).get()
+                for batch in _batches(correspondence_ids)
+            ],
+        )
+        identities = results[0]
+        ledger_batches = results[1:1+len(ledger_batches)]
+        account_batches = results[1+len(ledger_batches):]
+        ledgers: dict[str, str] = {
+            ledger.id: ledger.identity_id
+            for batch in ledger_batches
+            for ledger in batch
+        }
+        accounts: list[Account] = [a for batch in account_batches for a in batch]
+        return self._group_correspondent_accounts(identities, ledgers, accounts)
+
+    def _group_correspondent_accounts(
+            self, identities: list[Identity], ledgers: dict[str, str],
+            accounts: list[Account]
+        ) -> dict[str, tuple[Identity, list[Account]]]:
+        """Groups the Nostro and Vostro Accounts by counterparty using
+            the map of Ledger ID to owner Identity ID.
+        """
+        result = {identity.id: (identity, []) for identity in identities}
+        for account in accounts:
+            owner_id = ledgers.get(account.ledger_id, None)
+            counterparty_id = account.details
+            if owner_id == self.id and counterparty_id in result:
+                result[counterparty_id][1].append(account)
+            elif counterparty_id == self.id and owner_id in result:
+                result[owner_id][1].append(account)
+        return result
 
     async def get_correspondent_accounts(
             self, correspondent: Identity, reload: bool = False
@@ -1,6 +1,7 @@
 from __future__ import annotations
 from .Account import Account
-from bookchain.enums import AccountType, LedgerType
+from .TxRollupHead import TxRollupHead
+from bookchain.enums import AccountType, EntryType, LedgerType
 from sqloquent.asyncql import (
     AsyncHashedModel, AsyncRelatedModel, AsyncRelatedCollection,
     AsyncQueryBuilderProtocol,
@@ -67,16 +68,27 @@ class Ledger(AsyncHashedModel):
         """Ensure conditions are encoded before querying."""
         return super().query(cls._encode(conditions), connection_info)
 
-    async def balances(self, reload: bool = False) -> dict[str, tuple[int, AccountType]]:
+    async def balances(
+            self, reload: bool = False,
+            rolled_up_balances: dict[str, tuple[EntryType, int]]|None = None
+        ) -> dict[str, tuple[int, AccountType]]:
         """Return a dict mapping account ids to their balances. Accounts
             with sub-accounts will not include the sub-account balances;
-            the sub-account balances will be returned separately.
+            the sub-account balances will be returned separately. Unless
+            rolled_up_balances is passed, the balances of the most
+            recent trimmed TxRollups of the chains of the Ledger and of
+            the Correspondences of its Accounts are used as the starting
+            balances.
         """
         balances = {}
         if reload:
             await self.accounts().reload()
+        if rolled_up_balances is None:
+            rolled_up_balances = await TxRollupHead.get_rolled_up_balances(
+                self.id, *[a.correspondence_id for a in self.accounts]
+            )
         for account in self.accounts:
-            balances[account.id] = (await account.balance(False), account.type)
+            balances[account.id] = (await account.balance(False, rolled_up_balances), account.type)
         return balances
 
     def setup_basic_accounts(self) -> list[Account]:
@@ -0,0 +1,145 @@
+from __future__ import annotations
+from .Correspondence import Correspondence
+from .TxRollup import TxRollup
+from sqloquent.errors import tert, vert
+import tapescript
+
+
+class RollupSigningSession:
+    """A RollupSigningSession collects the signatures of the Identities
+        of a Correspondence for a TxRollup. The TxRollup ID, sigfields,
+        and txru_lock are computed once when the session is started, and
+        each partial signature (the witness script made by
+        `tapescript.make_single_sig_witness` with the sigfields) is
+        verified against the pubkey of its Identity as it arrives. When
+        the txru_lock is the default n-of-n multisig lock, the
+        auth_script is assembled from the partial signatures; a custom
+        txru_lock requires the full auth_script to be provided to
+        `finalize`.
+    """
+    txrollup: TxRollup
+    rollup_id: str
+    sigfields: dict[str, bytes]
+    txru_lock: bytes|None
+    pubkeys: dict[str, bytes]
+    signatures: dict[str, bytes]
+    is_multisig: bool
+
+    def __init__(
+            self, txrollup: TxRollup, txru_lock: bytes|None,
+            pubkeys: dict[str, bytes], is_multisig: bool = True
+        ) -> None:
+        """Use `start` to create a session for a Correspondence TxRollup.
+            Raises TypeError for invalid arguments.
+        """
+        tert(type(txrollup) is TxRollup, 'txrollup must be a TxRollup')
+        tert(txru_lock is None or type(txru_lock) is bytes,
+            'txru_lock must be bytes or None')
+        tert(type(pubkeys) is dict and all([
+                type(k) is str and type(v) is bytes for k, v in pubkeys.items()
+            ]), 'pubkeys must be dict[str, bytes]')
+        self.txrollup = txrollup
+        self.rollup_id = txrollup.generate_id(txrollup.data)
+        self.sigfields = {'sigfield1': bytes.fromhex(self.rollup_id)}
+        self.txru_lock = txru_lock
+        self.pubkeys = pubkeys
+        self.signatures = {}
+        self.is_multisig = is_multisig
+        self._locks = {
+            identity_id: tapescript.make_single_sig_lock(pubkey).bytes
+            for identity_id, pubkey in pubkeys.items()
+        }
+
+    @classmethod
+    async def start(
+            cls, txrollup: TxRollup, correspondence: Correspondence|None = None
+        ) -> RollupSigningSession:
+        """Starts a signing session for a TxRollup of a Correspondence,
+            loading the Correspondence (if not provided), its Identities,
+            and its txru_lock once. Raises ValueError if the TxRollup is
+            not for a Correspondence.
+        """
+        tert(type(txrollup) is TxRollup, 'txrollup must be a TxRollup')
+        vert(txrollup.correspondence_id is not None,
+            'txrollup must be for a Correspondence')
+        if correspondence is None:
+            correspondence = await Correspondence.find(txrollup.correspondence_id)
+        vert(correspondence is not None and
+            correspondence.id == txrollup.correspondence_id,
+            'correspondence must be the Correspondence of the txrollup')
+        await correspondence.identities().reload()
+        pubkeys = {
+            identity.id: identity.pubkey
+            for identity in correspondence.identities
+            if identity.pubkey
+        }
+        return cls(
+            txrollup, await correspondence.get_txru_lock(),
+            pubkeys, correspondence.txru_lock is None
+        )
+
+    @property
+    def missing(self) -> list[str]:
+        """The IDs of the Identities that have not signed yet."""
+        return [i for i in self.pubkeys if i not in self.signatures]
+
+    def sign(self, identity_id: str, seed: bytes) -> bytes:
+        """Creates the partial signature of an Identity with its private
+            key seed, adds it to the session, and returns it. Raises
+            ValueError if the seed does not match the Identity's pubkey.
+        """
+        signature = tapescript.make_single_sig_witness(seed, self.sigfields).bytes
+        vert(self.add_signature(identity_id, signature),
+            'seed does not match the pubkey of the identity')
+        return signature
+
+    def add_signature(self, identity_id: str, signature: bytes) -> bool:
+        """Verifies the partial signature of an Identity and adds it to
+            the session. Returns False (and does not add it) if it is
+            not valid. Raises ValueError for an Identity that is not
+            part of the session.
+        """
+        tert(type(signature) is bytes, 'signature must be bytes')
+        vert(identity_id in self.pubkeys, 'identity is not part of the session')
+        if not tapescript.run_auth_scripts(
+            [signature, self._locks[identity_id]], {**self.sigfields}
+        ):
+            return False
+        self.signatures[identity_id] = signature
+        return True
+
+    @property
+    def auth_script(self) -> bytes|None:
+        """The auth_script assembled from the partial signatures, or
+            None if signatures are missing or the txru_lock is custom.
+        """
+        if not self.is_multisig or len(self.missing) > 0:
+            return None
+        return b''.join([self.signatures[i] for i in self.pubkeys])
+
+    def verify(self, auth_script: bytes|None = None) -> bool:
+        """Verifies the auth_script (or the assembled auth_script if
+            none is provided) against the txru_lock.
+        """
+        auth_script = auth_script if auth_script is not None else self.auth_script
+        if self.txru_lock is None:
+            return True
+        if auth_script is None:
+            return False
+        return tapescript.run_auth_scripts(
+            [auth_script, self.txru_lock], {**self.sigfields}
+        )
+
+    def finalize(self, auth_script: bytes|None = None) -> TxRollup:
+        """Sets the auth_script (or the assembled auth_script if none is
+            provided) on the TxRollup and returns it. Raises ValueError
+            if the auth_script is not valid or if the TxRollup was
+            changed after the session was started.
+        """
+        vert(self.txrollup.generate_id(self.txrollup.data) == self.rollup_id,
+            'txrollup was changed during the signing session')
+        auth_script = auth_script if auth_script is not None else self.auth_script
+        vert(self.verify(auth_script), 'auth_script is not valid')
+        self.txrollup.id = self.rollup_id
+        self.txrollup.auth_script = auth_script
+        return self.txrollup
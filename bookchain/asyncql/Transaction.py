@@ -4,9 +4,10 @@ from .ArchivedTransaction import ArchivedTransaction
 from .Correspondence import Correspondence
 from .Entry import Entry
 from .Identity import Identity
+from .concurrency import fetch_by_ids, gather_limited
 from ..helpers import parse_timestamp
 from bookchain.enums import AccountType, EntryType
-from sqloquent.asyncql import AsyncHashedModel, AsyncRelatedCollection
+from sqloquent.asyncql import AsyncHashedModel, AsyncRelatedCollection, AsyncRelatedModel
 from sqloquent.errors import vert, tert
 import packify
 
@@ -19,16 +20,18 @@ class Transaction(AsyncHashedModel):
         recorded on the Ledgers of the Identities that are party to the
         Transaction. Any Entry for an Account that has a locking_script
         will require a valid tapscript unlocking script to be recorded
-        in the auth_scripts dict of the Transaction.
+        in the auth_scripts dict of the Transaction. The rollup_id is
+        set when the Transaction is committed to a saved TxRollup; it is
+        not hashed, and Transactions without one are pending.
     """
     connection_info: str = ''
     table: str = 'transactions'
     id_column: str = 'id'
     columns: tuple[str] = (
         'id', 'entry_ids', 'ledger_ids', 'timestamp', 'details', 'auth_scripts',
-        'description',
+        'description', 'rollup_id',
     )
-    columns_excluded_from_hash: tuple[str] = ('auth_scripts', 'description',)
+    columns_excluded_from_hash: tuple[str] = ('auth_scripts', 'description', 'rollup_id',)
     id: str
     entry_ids: str
     ledger_ids: str
@@ -36,9 +39,11 @@ class Transaction(AsyncHashedModel):
     details: bytes
     auth_scripts: bytes
     description: str|None
+    rollup_id: str|None
     entries: AsyncRelatedCollection
     ledgers: AsyncRelatedCollection
     rollups: AsyncRelatedCollection
+    rollup: AsyncRelatedModel
 
     # override automatic properties
     @property
@@ -93,12 +98,17 @@ class Transaction(AsyncHashedModel):
             'entries must be list[Entry]')
         tert(type(timestamp) is str, 'timestamp must be str')
 
-        ledgers = set()
         for entry in entries:
             entry.id = entry.generate_id(entry.data)
-            if reload:
-                await entry.account().reload()
-            vert(await Transaction.query().contains('entry_ids', entry.id).count() == 0,
+        if reload:
+            await cls.load_accounts(entries)
+        counts = await gather_limited(*[
+            Transaction.query().contains('entry_ids', entry.id).count()
+            for entry in entries
+        ])
+        ledgers = set()
+        for entry, count in zip(entries, counts):
+            vert(count == 0,
                  f"entry {entry.id} is already contained within a Transaction")
             ledgers.add(entry.account.ledger_id)
 
@@ -118,6 +128,33 @@ class Transaction(AsyncHashedModel):
         txn.id = txn.generate_id(txn.data)
         return txn
 
+    @staticmethod
+    async def load_accounts(entries: list[Entry]) -> None:
+        """Loads the Accounts of the entries with batched queries
+            instead of reloading the relation one Entry at a time.
+        """
+        accounts = await fetch_by_ids(Account, [e.account_id for e in entries])
+        for entry in entries:
+            if entry.account_id in accounts:
+                entry.account = accounts[entry.account_id]
+
+    @classmethod
+    async def load_entries(
+            cls, txns: list[Transaction], load_accounts: bool = False
+        ) -> None:
+        """Loads the entries of the Transactions (and their Accounts if
+            load_accounts is True) with batched queries instead of
+            reloading the relations one Transaction at a time.
+        """
+        entry_ids = [i for txn in txns for i in txn.entry_ids.split(',')]
+        entries: dict[str, Entry] = await fetch_by_ids(Entry, entry_ids)
+        for txn in txns:
+            txn.entries = [
+                entries[i] for i in txn.entry_ids.split(',') if i in entries
+            ]
+        if load_accounts:
+            await cls.load_accounts(list(entries.values()))
+
     async def validate(self, tapescript_runtime: dict = {}, reload: bool = False) -> bool:
         """Determines if a Transaction is valid using the rules of accounting
             and checking all auth scripts against their locking scripts. The
@@ -134,6 +171,7 @@ class Transaction(AsyncHashedModel):
 
         if reload:
             await self.entries().reload()
+            await self.load_accounts(list(self.entries))
 
         if len(self.entries) == 0:
             return False
@@ -146,8 +184,6 @@ class Transaction(AsyncHashedModel):
                 or not entry.account.locking_scripts
                 or entry.type not in entry.account.locking_scripts,
                 f"missing auth script for account {entry.account_id} ({entry.account.name})")
-            if reload:
-                await entry.account().reload()
             if entry.account.ledger_id not in ledgers:
                 ledgers[entry.account.ledger_id] = {'Dr': 0, 'Cr': 0}
             if entry.type in (EntryType.CREDIT, EntryType.CREDIT.value):
@@ -208,20 +244,15 @@ class Transaction(AsyncHashedModel):
         # finally check that correspondent accounting is not violated
         if len(ledgers) > 1:
             accounts = [e.account for e in self.entries]
+            cor_accts = await Correspondence._correspondent_accounts(accounts)
 
             for acct in accounts:
                 acct: Account
-                if acct.type is AccountType.NOSTRO_ASSET and type(acct.details) is str \
-                    and acct.details != acct.id and await Identity.find(acct.details):
+                if acct.type is AccountType.NOSTRO_ASSET and acct.id in cor_accts:
                     # Nostro account must have equivalent Vostro account
-                    nostro = acct
-                    await nostro.ledger().reload()
-                    cor: Correspondence = await Correspondence.query().contains(
-                        'identity_ids', nostro.ledger.identity_id
-                    ).contains('identity_ids', nostro.details).first()
-                    if cor is None:
+                    accts = cor_accts[acct.id]
+                    if accts is None:
                         continue
-                    accts = await cor.get_accounts()
                     if acct.details not in accts:
                         return False
                     if AccountType.VOSTRO_LIABILITY not in accts[acct.details]:
@@ -236,17 +267,11 @@ class Transaction(AsyncHashedModel):
                     if offsetting_entry[0].amount != entry.amount:
                         return False
 
-                if acct.type is AccountType.VOSTRO_LIABILITY and type(acct.details) is str \
-                    and acct.details != acct.id and await Identity.find(acct.details):
+                if acct.type is AccountType.VOSTRO_LIABILITY and acct.id in cor_accts:
                     # Vostro account must have equivalent Nostro account
-                    vostro = acct
-                    await vostro.ledger().reload()
-                    cor: Correspondence = await Correspondence.query().contains(
-                        'identity_ids', vostro.ledger.identity_id
-                    ).contains('identity_ids', vostro.details).first()
-                    if cor is None:
+                    accts = cor_accts[acct.id]
+                    if accts is None:
                         continue
-                    accts = await cor.get_accounts()
                     if acct.details not in accts:
                         return False
                     if AccountType.NOSTRO_ASSET not in accts[acct.details]:
@@ -276,8 +301,9 @@ class Transaction(AsyncHashedModel):
         """Archive the Transaction. If it has already been archived,
             return the existing ArchivedTransaction.
         """
-        archived_txn_id = ArchivedTransaction.generate_id({**self.data})
+        data = {c: self.data.get(c, None) for c in ArchivedTransaction.columns}
+        archived_txn_id = ArchivedTransaction.generate_id({**data})
         try:
-            return await ArchivedTransaction.insert({**self.data})
+            return await ArchivedTransaction.insert(data)
         except Exception as e:
             return await ArchivedTransaction.find(archived_txn_id)
@@ -0,0 +1,35 @@
+from __future__ import annotations
+from sqloquent.asyncql import AsyncSqlModel, AsyncRelatedModel
+
+
+class TrimmedRecord(AsyncSqlModel):
+    """A TrimmedRecord maps the AsyncDeletedModel of a Transaction or
+        Entry trimmed by a TxRollup to the ID of that TxRollup, keyed by
+        the ID of the AsyncDeletedModel, so that the trimmed records of
+        a TxRollup can be found with an indexed query. For a TxRollup
+        trimmed into an ArchiveSegment, no AsyncDeletedModels are saved
+        and it is keyed by the ID of the Transaction or Entry instead.
+        It is written by `TxRollup.trim` and is not hashed.
+    """
+    connection_info: str = ''
+    table: str = 'trimmed_records'
+    id_column: str = 'id'
+    columns: tuple[str] = ('id', 'rollup_id')
+    id: str
+    rollup_id: str
+    rollup: AsyncRelatedModel
+
+    @classmethod
+    async def _table_exists(cls) -> bool:
+        """Returns True if the trimmed_records table exists. Returns
+            False without querying if no connection_info is set.
+        """
+        if not cls.connection_info:
+            return False
+        query = cls.query()
+        async with query.context_manager(query.connection_info) as cursor:
+            await cursor.execute(
+                "select count(*) from sqlite_master where type = 'table' and name = ?",
+                [cls.table]
+            )
+            return (await cursor.fetchone())[0] > 0
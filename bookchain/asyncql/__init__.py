@@ -8,15 +8,31 @@ from .Customer import Customer
 from .Entry import Entry
 from .Identity import Identity
 from .Ledger import Ledger
+from .RollupSigningSession import RollupSigningSession
 from .Transaction import Transaction
+from .TrimmedRecord import TrimmedRecord
 from .TxRollup import TxRollup
+from .TxRollupHead import TxRollupHead
 from .Vendor import Vendor
+from .clearing import ClearingHouse
+from .concurrency import set_concurrency_limit
+from .memory import AsyncMemoryPool, configure_memory
+from .pool import (
+    AsyncConnectionPool, AsyncPooledContext, AsyncPooledQueryBuilder,
+    DEFAULT_PRAGMAS, configure_pool, close_pools,
+)
+from .scheduler import RollupScheduler
+from .sharding import AsyncShardedPool, configure_sharding
+from .snapshot import AsyncSnapshot, AsyncSnapshotContext, AsyncSnapshotQueryBuilder
 from bookchain.enums import AccountType, EntryType, LedgerType
+from bookchain.memory import MemoryEngine, get_engine
+from bookchain.sharding import SHARD_PRAGMAS, ShardMap
 from sqloquent.asyncql import (
-    AsyncDeletedModel, AsyncAttachment,
+    AsyncDeletedModel, AsyncAttachment, AsyncSqlQueryBuilder,
     async_contains, async_within, async_has_many, async_belongs_to,
     async_has_one,
 )
+from sqloquent.errors import vert
 
 
 Identity.ledgers = async_has_many(Identity, Ledger, 'identity_id')
@@ -56,6 +72,7 @@ Ledger.rollups = async_within(Ledger, TxRollup, 'ledger_id')
 
 TxRollup.transactions = async_contains(TxRollup, Transaction, 'tx_ids')
 Transaction.rollups = async_within(Transaction, TxRollup, 'tx_ids')
+Transaction.rollup = async_belongs_to(Transaction, TxRollup, 'rollup_id')
 
 TxRollup.parent = async_belongs_to(TxRollup, TxRollup, 'parent_id')
 TxRollup.child = async_has_one(TxRollup, TxRollup, 'parent_id')
@@ -63,6 +80,11 @@ TxRollup.child = async_has_one(TxRollup, TxRollup, 'parent_id')
 TxRollup.correspondence = async_belongs_to(TxRollup, Correspondence, 'correspondence_id')
 Correspondence.rollups = async_within(Correspondence, TxRollup, 'correspondence_id')
 
+TxRollupHead.rollup = async_belongs_to(TxRollupHead, TxRollup, 'rollup_id')
+TxRollupHead.trimmed_rollup = async_belongs_to(TxRollupHead, TxRollup, 'trimmed_rollup_id')
+
+TrimmedRecord.rollup = async_belongs_to(TrimmedRecord, TxRollup, 'rollup_id')
+
 ArchivedEntry.transactions = async_within(ArchivedEntry, ArchivedTransaction, 'entry_ids')
 ArchivedTransaction.entries = async_contains(ArchivedTransaction, ArchivedEntry, 'entry_ids')
 
@@ -73,25 +95,65 @@ ArchivedTransaction.ledgers = async_contains(ArchivedTransaction, Ledger, 'ledge
 Ledger.archived_transactions = async_within(Ledger, ArchivedTransaction, 'ledger_ids')
 
 
-def set_connection_info(db_file_path: str):
+def set_connection_info(
+        db_file_path: str, pool_size: int|None = None,
+        pragmas: dict[str, int|str]|None = None,
+        shards: list[str]|ShardMap|None = None, snapshots: bool = False
+    ):
     """Set the connection info for all models to use the specified
-        sqlite3 database file path.
+        sqlite3 database file path. If pool_size is provided, all models
+        share an `AsyncConnectionPool` with up to pool_size concurrent
+        reader connections and a single writer connection, configured
+        with the pragmas (default `DEFAULT_PRAGMAS`), and the
+        `gather_limited` concurrency limit is set to pool_size;
+        otherwise, each operation uses its own connection as before.
+        If shards (a list of database file paths or a `ShardMap` with
+        db_file_path as its home) are provided, Ledgers and their
+        records are stored in the shards and all models share an
+        `AsyncShardedPool` of pool_size (default 1) reader connections;
+        the pragmas then default to `SHARD_PRAGMAS`. Await `close_pools`
+        to close the pooled connections. With a pool_size, or if
+        snapshots is True, the bookchain models read through the
+        connection of an `AsyncSnapshot` of db_file_path within its
+        `async with` block; with snapshots alone, sqloquent's shared
+        AsyncDeletedModel and AsyncAttachment keep sqloquent's
+        AsyncSqlQueryBuilder. If db_file_path is the connection_info
+        of an open `MemoryEngine`, all models share an
+        `AsyncMemoryPool` of pool_size (default 1) reader connections.
     """
-    Account.connection_info = db_file_path
-    AccountCategory.connection_info = db_file_path
-    ArchivedEntry.connection_info = db_file_path
-    ArchivedTransaction.connection_info = db_file_path
-    Correspondence.connection_info = db_file_path
-    Currency.connection_info = db_file_path
-    Customer.connection_info = db_file_path
-    Entry.connection_info = db_file_path
-    Identity.connection_info = db_file_path
-    Ledger.connection_info = db_file_path
-    Transaction.connection_info = db_file_path
-    TxRollup.connection_info = db_file_path
-    Vendor.connection_info = db_file_path
-    AsyncDeletedModel.connection_info = db_file_path
-    AsyncAttachment.connection_info = db_file_path
+    query_builder_class = AsyncSqlQueryBuilder
+    if get_engine(db_file_path) is not None:
+        pool_size = pool_size or 1
+        configure_memory(get_engine(db_file_path), pool_size)
+        query_builder_class = AsyncPooledQueryBuilder
+    elif shards is not None:
+        if type(shards) is not ShardMap:
+            shards = ShardMap(db_file_path, shards, pragmas=pragmas)
+        vert(shards.home == db_file_path, 'shards.home must be db_file_path')
+        pool_size = pool_size or 1
+        configure_sharding(shards, pool_size)
+        query_builder_class = AsyncPooledQueryBuilder
+    elif pool_size is not None:
+        configure_pool(db_file_path, pool_size, pragmas)
+        query_builder_class = AsyncPooledQueryBuilder
+    elif snapshots:
+        query_builder_class = AsyncSnapshotQueryBuilder
+    set_concurrency_limit(pool_size or 1)
+
+    for model in (
+        Account, AccountCategory, ArchivedEntry, ArchivedTransaction,
+        Correspondence, Currency, Customer, Entry, Identity, Ledger,
+        Transaction, TrimmedRecord, TxRollup, TxRollupHead, Vendor,
+    ):
+        model.connection_info = db_file_path
+        model.query_builder_class = query_builder_class
+    for model in (AsyncDeletedModel, AsyncAttachment):
+        model.connection_info = db_file_path
+        model.query_builder_class = (
+            AsyncSqlQueryBuilder if query_builder_class is AsyncSnapshotQueryBuilder
+            else query_builder_class
+        )
+    TxRollupHead._tables.clear()
 
 
 # no longer needed
@@ -0,0 +1,108 @@
+from __future__ import annotations
+from .Correspondence import Correspondence
+from .Entry import Entry
+from bookchain.clearing import ClearingGraph
+from bookchain.netting import payments_root
+from sqloquent.errors import tert, vert
+
+
+class ClearingHouse:
+    """A ClearingHouse routes and clears payments between Identities
+        across chains of Correspondences. The Correspondences and the
+        balances of their Identities are loaded once into a cached
+        ClearingGraph. Clearing does not change the cached balances,
+        since the Transactions are only recorded once the caller has
+        signed and saved them; call `refresh` for each Correspondence
+        once its Transactions have been saved. Credit limits are read
+        from the 'credit_limits' dict (Identity ID to int or None) in
+        the details of each Correspondence, falling back to
+        default_limit.
+    """
+    graph: ClearingGraph
+    correspondences: dict[str, Correspondence]
+
+    def __init__(self, default_limit: int|None = 0) -> None:
+        """Raises TypeError for invalid default_limit."""
+        self.graph = ClearingGraph(default_limit)
+        self.correspondences = {}
+
+    async def add(
+            self, correspondence: Correspondence,
+            limits: dict[str, int|None]|None = None
+        ) -> None:
+        """Adds a Correspondence to the graph, loading the balances of
+            its Identities. The limits override the 'credit_limits' in
+            the details of the Correspondence. Raises TypeError for an
+            invalid argument.
+        """
+        tert(type(correspondence) is Correspondence,
+            'correspondence must be a Correspondence')
+        balances = await correspondence.balances()
+        self.correspondences[correspondence.id] = correspondence
+        self.graph.set_correspondence(
+            correspondence.id,
+            {
+                identity_id: balances.get(identity_id, 0)
+                for identity_id in correspondence.identity_ids.split(',')
+            },
+            limits if limits is not None else
+                correspondence.details.get('credit_limits', None)
+        )
+
+    def remove(self, correspondence: Correspondence) -> None:
+        """Removes a Correspondence from the graph."""
+        self.correspondences.pop(correspondence.id, None)
+        self.graph.remove_correspondence(correspondence.id)
+
+    async def refresh(self, correspondence: Correspondence|None = None) -> None:
+        """Reloads the balances of a Correspondence, or of all the
+            Correspondences if none is provided.
+        """
+        if correspondence is not None:
+            return await self.add(correspondence)
+        for correspondence in list(self.correspondences.values()):
+            await self.add(correspondence)
+
+    def find_route(
+            self, payer_id: str, payee_id: str, amount: int
+        ) -> list[tuple[str, str, Correspondence]]|None:
+        """Finds the shortest route with enough available credit for the
+            payer to pay the amount to the payee. Returns a list of
+            (payer ID, payee ID, Correspondence) hops, or None if there
+            is no such route.
+        """
+        hops = self.graph.find_route(payer_id, payee_id, amount)
+        if hops is None:
+            return None
+        return [(a, b, self.correspondences[cid]) for a, b, cid in hops]
+
+    async def clear(
+            self, payments: list[tuple[str, str, int]], txn_nonce: bytes
+        ) -> list[tuple[Correspondence, list[Entry], list[Entry], dict[str, bytes]]]:
+        """Nets a batch of (payer ID, payee ID, amount) payments across
+            the whole graph (cancelling cyclic obligations), routes the
+            net amounts, and prepares the entries for each hop with
+            `Correspondence.settle_payments`. Returns a list of tuples
+            of the Correspondence, the two lists of entries, and the
+            Transaction details, which additionally include the
+            'clearing_root' committing to the original payments. The
+            payments are routed on a copy of the graph, so the cached
+            balances are unchanged until the Correspondences are
+            refreshed after the Transactions are saved. Raises
+            ValueError if a net amount cannot be routed.
+        """
+        hops = self.graph.copy().clear(payments)
+        clearing_root = payments_root(payments)
+        by_correspondence: dict[str, list[tuple[str, str, int]]] = {}
+        for payer_id, payee_id, cid, amount in hops:
+            by_correspondence.setdefault(cid, []).append((payer_id, payee_id, amount))
+
+        settlements = []
+        for cid in sorted(by_correspondence):
+            correspondence = self.correspondences[cid]
+            for entries1, entries2, details in await correspondence.settle_payments(
+                by_correspondence[cid], txn_nonce
+            ):
+                details['clearing_root'] = clearing_root
+                settlements.append((correspondence, entries1, entries2, details))
+        return settlements
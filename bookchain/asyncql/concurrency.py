@@ -0,0 +1,62 @@
+from asyncio import Semaphore, gather
+from bookchain.helpers import _batches
+from sqloquent.errors import tert
+from typing import Any, Awaitable
+
+
+_limit: int = 1
+
+
+def get_concurrency_limit() -> int:
+    """Returns the default number of awaitables that `gather_limited`
+        runs at once.
+    """
+    return _limit
+
+def set_concurrency_limit(limit: int) -> None:
+    """Sets the default number of awaitables that `gather_limited` runs
+        at once. The default of 1 is required with sqloquent's default
+        AsyncSqliteContext, which shares a single connection and cursor
+        for each database among all tasks, so concurrent queries would
+        interleave on the cursor. Raise it only when the models use a
+        context manager that gives each task its own connection. Raises
+        TypeError for an invalid limit.
+    """
+    global _limit
+    tert(type(limit) is int and limit > 0, 'limit must be a positive int')
+    _limit = limit
+
+async def gather_limited(*aws: Awaitable, limit: int|None = None) -> list[Any]:
+    """Awaits the awaitables concurrently with `asyncio.gather`, at most
+        limit (default `get_concurrency_limit()`) at a time, and returns
+        their results in order. Coroutines are not started until a slot
+        is free.
+    """
+    tert(limit is None or (type(limit) is int and limit > 0),
+        'limit must be a positive int or None')
+    semaphore = Semaphore(limit or _limit)
+
+    async def run(aw: Awaitable) -> Any:
+        async with semaphore:
+            return await aw
+
+    return list(await gather(*[run(aw) for aw in aws]))
+
+async def fetch_by_ids(
+        model: type, ids: list[str], column: str = 'id'
+    ) -> dict[str, Any]:
+    """Fetches the records of the model class whose column (default
+        'id') is in the given IDs with batched `is_in` queries run with
+        `gather_limited`. Returns a dict mapping the column value to the
+        record (the last one for non-unique columns).
+    """
+    ids = list(set([i for i in ids if i]))
+    results = await gather_limited(*[
+        model.query().is_in(column, batch).get()
+        for batch in _batches(ids)
+    ])
+    return {
+        record.data[column]: record
+        for batch in results
+        for record in batch
+    }
@@ -0,0 +1,40 @@
+from __future__ import annotations
+from .pool import AsyncConnectionPool, _pools, _retired
+from bookchain.memory import MemoryEngine
+from sqloquent.errors import tert
+import aiosqlite
+
+
+class AsyncMemoryPool(AsyncConnectionPool):
+    """An `AsyncConnectionPool` of connections to a `MemoryEngine`."""
+    engine: MemoryEngine
+
+    def __init__(self, engine: MemoryEngine, size: int = 1) -> None:
+        """Raises TypeError or ValueError for invalid arguments."""
+        tert(type(engine) is MemoryEngine, 'engine must be MemoryEngine')
+        super().__init__(engine.connection_info, size, {})
+        self.engine = engine
+
+    async def _connect(self) -> aiosqlite.Connection:
+        """Opens a connection to the in-memory database."""
+        connection = aiosqlite.connect(self.connection_info, uri=True)
+        # do not block interpreter exit if the pool is never closed
+        connection.daemon = True
+        await connection
+        return connection
+
+
+def configure_memory(engine: MemoryEngine, size: int = 1) -> AsyncMemoryPool:
+    """Configures the `AsyncMemoryPool` used by `AsyncPooledContext` for
+        the MemoryEngine and returns it. An existing pool for the engine
+        with the same size is kept; a replaced pool keeps its
+        connections until `close_pools` is awaited.
+    """
+    pool = AsyncMemoryPool(engine, size)
+    existing = _pools.get(engine.connection_info)
+    if existing is not None:
+        if type(existing) is AsyncMemoryPool and existing.size == size:
+            return existing
+        _retired.append(existing)
+    _pools[engine.connection_info] = pool
+    return pool
@@ -0,0 +1,322 @@
+from __future__ import annotations
+from asyncio import AbstractEventLoop, Lock, Semaphore, get_running_loop
+from .snapshot import AsyncSnapshot, _snapshot_for
+from bookchain.helpers import DEFAULT_PRAGMAS, _pragma_statements
+from contextvars import ContextVar
+from sqloquent.asyncql import AsyncSqlQueryBuilder
+from sqloquent.errors import tert, vert
+from types import TracebackType
+from typing import Any
+import aiosqlite
+import re
+
+
+_pools: dict[str, AsyncConnectionPool] = {}
+_retired: list[AsyncConnectionPool] = []
+_bindings: ContextVar[dict[str, _Binding]] = ContextVar('_bindings', default={})
+_read_sql = re.compile(r'^\s*(select|with)\b', re.IGNORECASE)
+_write_sql = re.compile(r'\b(insert|update|delete|replace)\b', re.IGNORECASE)
+
+
+def _is_read(sql: str) -> bool:
+    """Returns True if the SQL statement only reads."""
+    if not _read_sql.match(sql):
+        return False
+    return sql.lstrip()[:4].lower() != 'with' or not _write_sql.search(sql)
+
+
+class AsyncConnectionPool:
+    """A pool of long-lived aiosqlite connections to a database file:
+        up to size reader connections used concurrently and a single
+        writer connection that is held by one task (and the tasks it
+        gathers) at a time, which serializes writes without SQLITE_BUSY
+        errors. The pragmas are applied to each connection when it is
+        opened. Connections are opened lazily and kept open until
+        `close` is awaited. The locks belong to the running event loop;
+        if the pool is used from another event loop, they are recreated
+        and the connections are reused.
+    """
+    connection_info: str
+    size: int
+    pragmas: dict[str, int|str]
+    _idle: list[aiosqlite.Connection]
+    _writer: aiosqlite.Connection|None
+    _loop: AbstractEventLoop|None
+
+    def __init__(
+            self, connection_info: str, size: int = 4,
+            pragmas: dict[str, int|str]|None = None
+        ) -> None:
+        """Raises TypeError or ValueError for invalid arguments."""
+        tert(type(connection_info) is str, 'connection_info must be str')
+        vert(connection_info not in ('', ':memory:'),
+            'connection_info must be a database file path')
+        tert(type(size) is int, 'size must be int')
+        vert(size > 0, 'size must be positive')
+        pragmas = {**DEFAULT_PRAGMAS} if pragmas is None else pragmas
+        self._statements = _pragma_statements(pragmas)
+        self.connection_info = connection_info
+        self.size = size
+        self.pragmas = pragmas
+        self._idle = []
+        self._writer = None
+        self._loop = None
+
+    def _sync_loop(self) -> None:
+        """(Re)creates the locks for the running event loop."""
+        loop = get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._readers = Semaphore(self.size)
+            self._write_lock = Lock()
+
+    async def _connect(self) -> aiosqlite.Connection:
+        """Opens a connection and applies the pragmas."""
+        connection = aiosqlite.connect(self.connection_info)
+        # do not block interpreter exit if the pool is never closed
+        connection.daemon = True
+        await connection
+        for statement in await self._setup_statements(connection):
+            await connection.execute(statement)
+        return connection
+
+    async def _setup_statements(self, connection: aiosqlite.Connection) -> list[str]:
+        """Returns the statements to run on each new connection."""
+        return self._statements
+
+    async def acquire_reader(self) -> aiosqlite.Connection:
+        """Waits for a free reader connection and returns it."""
+        self._sync_loop()
+        await self._readers.acquire()
+        try:
+            return self._idle.pop() if self._idle else await self._connect()
+        except BaseException:
+            self._readers.release()
+            raise
+
+    def release_reader(self, connection: aiosqlite.Connection) -> None:
+        """Returns a reader connection to the pool."""
+        self._idle.append(connection)
+        self._readers.release()
+
+    async def acquire_writer(self) -> aiosqlite.Connection:
+        """Waits for the writer connection and returns it."""
+        self._sync_loop()
+        await self._write_lock.acquire()
+        try:
+            if self._writer is None:
+                self._writer = await self._connect()
+            return self._writer
+        except BaseException:
+            self._write_lock.release()
+            raise
+
+    async def release_writer(self, commit: bool = True) -> None:
+        """Commits (or rolls back) the writer connection and returns it
+            to the pool.
+        """
+        try:
+            if commit:
+                await self._writer.commit()
+            else:
+                await self._writer.rollback()
+        finally:
+            self._write_lock.release()
+
+    def _cursor(self, binding: _Binding) -> _PooledCursor:
+        """Returns the cursor for a context using the pool."""
+        return _PooledCursor(binding)
+
+    async def close(self) -> None:
+        """Closes all idle connections."""
+        connections, self._idle = self._idle, []
+        if self._writer is not None:
+            connections.append(self._writer)
+            self._writer = None
+        for connection in connections:
+            await connection.close()
+
+
+class _Binding:
+    """The connections used by a task (and the tasks it gathers) within
+        its outermost `AsyncPooledContext`.
+    """
+    def __init__(self, pool: AsyncConnectionPool) -> None:
+        self.pool = pool
+        self.depth = 0
+        self.reader = None
+        self.writer = None
+        self.cursors = []
+        self.lock = Lock()
+
+    async def connection(self, write: bool) -> aiosqlite.Connection:
+        """Returns the writer connection if it is held or needed, else
+            the reader connection, acquiring them from the pool.
+        """
+        if self.writer is not None:
+            return self.writer
+        async with self.lock:
+            if write and self.writer is None:
+                self.writer = await self.pool.acquire_writer()
+            if not write and self.writer is None and self.reader is None:
+                self.reader = await self.pool.acquire_reader()
+        return self.writer or self.reader
+
+    async def release(self, commit: bool) -> None:
+        """Closes the cursors and returns the connections to the pool."""
+        cursors, self.cursors = self.cursors, []
+        for cursor in cursors:
+            await cursor.close()
+        if self.reader is not None:
+            self.pool.release_reader(self.reader)
+            self.reader = None
+        if self.writer is not None:
+            self.writer = None
+            await self.pool.release_writer(commit)
+
+
+class _PooledCursor:
+    """Cursor that runs read statements on the reader connection and
+        write statements on the writer connection of a _Binding. Once
+        the writer connection is held, all statements use it so that
+        reads see the uncommitted writes.
+    """
+    def __init__(self, binding: _Binding) -> None:
+        self.binding = binding
+        self.cursor = None
+        self.connection = None
+
+    async def _prepare(self, write: bool) -> aiosqlite.Cursor:
+        connection = await self.binding.connection(write)
+        if connection is not self.connection:
+            self.connection = connection
+            self.cursor = await connection.cursor()
+            self.binding.cursors.append(self.cursor)
+        return self.cursor
+
+    async def execute(self, sql: str, parameters: Any = ()) -> _PooledCursor:
+        await (await self._prepare(not _is_read(sql))).execute(sql, parameters)
+        return self
+
+    async def executemany(self, sql: str, parameters: Any) -> _PooledCursor:
+        await (await self._prepare(True)).executemany(sql, parameters)
+        return self
+
+    async def executescript(self, sql: str) -> _PooledCursor:
+        await (await self._prepare(True)).executescript(sql)
+        return self
+
+    async def fetchone(self) -> Any:
+        return await self.cursor.fetchone()
+
+    async def fetchall(self) -> Any:
+        return await self.cursor.fetchall()
+
+    @property
+    def rowcount(self) -> int:
+        return self.cursor.rowcount if self.cursor else -1
+
+    @property
+    def lastrowid(self) -> int|None:
+        return self.cursor.lastrowid if self.cursor else None
+
+
+class AsyncPooledContext:
+    """Context manager for the `AsyncConnectionPool` configured for the
+        connection_info with `configure_pool`. Nested contexts in a task
+        and in the tasks it gathers share the connections of the
+        outermost context, which commits or rolls back the writes when
+        it exits. Within an `AsyncSnapshot` of the database file, the
+        snapshot connection is used instead.
+    """
+    connection_info: str
+    snapshot: AsyncSnapshot|None = None
+
+    def __init__(self, connection_info: str = '') -> None:
+        """Raises TypeError for non-str connection_info."""
+        if not connection_info and hasattr(self, 'connection_info'):
+            connection_info = self.connection_info
+        tert(type(connection_info) is str, 'connection_info must be str')
+        self.connection_info = connection_info
+
+    async def __aenter__(self) -> _PooledCursor:
+        """Enter the context block and return the cursor. Raises
+            ValueError if no pool is configured for the connection_info.
+        """
+        self.snapshot = _snapshot_for(self.connection_info)
+        if self.snapshot is not None:
+            self.cursor = await self.snapshot.connection.cursor()
+            return self.cursor
+
+        bindings = _bindings.get()
+        self.token = None
+        if self.connection_info not in bindings:
+            vert(self.connection_info in _pools,
+                f'no pool configured for {self.connection_info}')
+            self.token = _bindings.set({
+                **bindings,
+                self.connection_info: _Binding(_pools[self.connection_info]),
+            })
+        self.binding = _bindings.get()[self.connection_info]
+        self.binding.depth += 1
+        return self.binding.pool._cursor(self.binding)
+
+    async def __aexit__(
+            self, exc_type: type[BaseException] | None,
+            exc_value: BaseException | None,
+            traceback: TracebackType | None
+        ) -> None:
+        """Exit the context block. The outermost context commits or
+            rolls back and returns the connections to the pool.
+        """
+        if self.snapshot is not None:
+            await self.cursor.close()
+            return
+
+        self.binding.depth -= 1
+        if self.token is None:
+            return
+        try:
+            await self.binding.release(exc_type is None)
+        finally:
+            _bindings.reset(self.token)
+
+
+class AsyncPooledQueryBuilder(AsyncSqlQueryBuilder):
+    """Query builder that uses `AsyncPooledContext` by default."""
+    def __init__(self, *args, **kwargs) -> None:
+        kwargs.setdefault('context_manager', AsyncPooledContext)
+        super().__init__(*args, **kwargs)
+
+
+def configure_pool(
+        connection_info: str, size: int = 4,
+        pragmas: dict[str, int|str]|None = None
+    ) -> AsyncConnectionPool:
+    """Configures the `AsyncConnectionPool` used by `AsyncPooledContext`
+        for the connection_info and returns it. An existing pool with
+        the same size and pragmas is kept; a replaced pool keeps its
+        connections until `close_pools` is awaited.
+    """
+    pool = AsyncConnectionPool(connection_info, size, pragmas)
+    existing = _pools.get(connection_info)
+    if existing is not None:
+        if type(existing) is AsyncConnectionPool and existing.size == pool.size \
+            and existing.pragmas == pool.pragmas:
+            return existing
+        _retired.append(existing)
+    _pools[connection_info] = pool
+    return pool
+
+def get_pool(connection_info: str) -> AsyncConnectionPool|None:
+    """Returns the pool configured for the connection_info, if any."""
+    return _pools.get(connection_info)
+
+async def close_pools() -> None:
+    """Closes the connections of all configured and replaced pools.
+        The pools remain configured and reopen connections as needed.
+    """
+    while _retired:
+        await _retired.pop().close()
+    for pool in list(_pools.values()):
+        await pool.close()
@@ -0,0 +1,342 @@
+from __future__ import annotations
+from .Correspondence import Correspondence
+from .Entry import Entry
+from .Ledger import Ledger
+from .Transaction import Transaction
+from .TxRollup import TxRollup
+from .TxRollupHead import TxRollupHead
+from asyncio import Event, TimeoutError, wait_for
+from bookchain.helpers import _batches, parse_timestamp
+from inspect import isawaitable
+from sqloquent.asyncql import AsyncSqlQueryBuilder
+from sqloquent.errors import tert, vert
+from time import time
+from typing import Awaitable, Callable
+
+
+class RollupScheduler:
+    """A RollupScheduler creates TxRollups automatically for the watched
+        Ledgers and Correspondences. A TxRollup is created for a Ledger
+        or Correspondence when max_txns un-rolled Transactions have
+        accumulated or when max_age seconds have passed since the head
+        of its TxRollup chain (or since its oldest un-rolled Transaction
+        if it has no chain yet). TxRollups for Correspondences must be
+        authorized by the signer, which is called with the prepared
+        TxRollup (with its ID set) and the Correspondence and must
+        return (or be a coroutine function returning) the auth_script
+        bytes. If trim is True, the Transactions are trimmed after the
+        TxRollup is saved (to an ArchiveSegment if segment_dir is
+        provided). The lag of each watched Ledger and Correspondence is
+        recorded in `metrics`.
+    """
+    max_txns: int
+    max_age: float|None
+    signer: Callable[[TxRollup, Correspondence], bytes|Awaitable[bytes]]|None
+    trim: bool
+    segment_dir: str|None
+    snapshot_interval: int|None
+    include_balance_root: bool
+    watched: dict[str, Ledger|Correspondence]
+    metrics: dict[str, dict[str, int|float|None]]
+
+    def __init__(
+            self, max_txns: int = 1000, max_age: float|None = 60.0,
+            signer: Callable[[TxRollup, Correspondence], bytes|Awaitable[bytes]]|None = None,
+            trim: bool = False, segment_dir: str|None = None,
+            snapshot_interval: int|None = None,
+            include_balance_root: bool = False,
+        ) -> None:
+        """Raises TypeError for invalid arguments."""
+        tert(type(max_txns) is int and max_txns > 0,
+            'max_txns must be a positive int')
+        tert(max_age is None or (type(max_age) in (int, float) and max_age >= 0),
+            'max_age must be a non-negative int|float or None')
+        tert(signer is None or callable(signer), 'signer must be callable or None')
+        tert(segment_dir is None or type(segment_dir) is str,
+            'segment_dir must be str or None')
+        self.max_txns = max_txns
+        self.max_age = max_age
+        self.signer = signer
+        self.trim = trim
+        self.segment_dir = segment_dir
+        self.snapshot_interval = snapshot_interval
+        self.include_balance_root = include_balance_root
+        self.watched = {}
+        self.metrics = {}
+
+    def watch(self, ledger_or_correspondence: Ledger|Correspondence) -> None:
+        """Adds a Ledger or Correspondence to the watched set. Raises
+            TypeError for invalid argument or ValueError for a
+            Correspondence if no signer is configured.
+        """
+        tert(type(ledger_or_correspondence) in (Ledger, Correspondence),
+            'ledger_or_correspondence must be a Ledger or Correspondence')
+        vert(type(ledger_or_correspondence) is Ledger or self.signer is not None,
+            'a signer is required to roll up a Correspondence')
+        self.watched[ledger_or_correspondence.id] = ledger_or_correspondence
+        self.metrics.setdefault(ledger_or_correspondence.id, {
+            'height': None,
+            'pending': 0,
+            'lag': 0.0,
+            'since_head': 0.0,
+            'rollups': 0,
+            'rolled_up': 0,
+            'trimmed': 0,
+            'last_rollup_at': None,
+            'last_duration': None,
+        })
+
+    def unwatch(self, ledger_or_correspondence: Ledger|Correspondence) -> None:
+        """Removes a Ledger or Correspondence from the watched set."""
+        self.watched.pop(ledger_or_correspondence.id, None)
+        self.metrics.pop(ledger_or_correspondence.id, None)
+
+    def _pending_query(
+            self, ledger_or_correspondence: Ledger|Correspondence
+        ) -> AsyncSqlQueryBuilder:
+        """Returns a query builder for the Transactions recorded on
+            exactly the Ledgers of the Ledger or Correspondence that
+            have not been committed to a TxRollup. Uses the indexed
+            ledger_ids and rollup_id columns.
+        """
+        ledger_ids = ledger_or_correspondence.id
+        if type(ledger_or_correspondence) is Correspondence:
+            ledger_ids = ','.join(sorted(ledger_or_correspondence.ledger_ids.split(',')))
+        return Transaction.query().equal('ledger_ids', ledger_ids).is_null('rollup_id')
+
+    async def pending_count(
+            self, ledger_or_correspondence: Ledger|Correspondence
+        ) -> int:
+        """Returns the number of un-rolled Transactions recorded on
+            exactly the Ledgers of the Ledger or Correspondence using a
+            count query. For a Correspondence, this is an upper bound:
+            Transactions with Entries for other Accounts are only
+            excluded by `pending_transactions`.
+        """
+        return await self._pending_query(ledger_or_correspondence).count()
+
+    async def _oldest_pending(
+            self, ledger_or_correspondence: Ledger|Correspondence
+        ) -> int|None:
+        """Returns the parsed timestamp of the oldest un-rolled
+            Transaction counted by `pending_count`, loading only that
+            Transaction, or None if there are none.
+        """
+        txn = await self._pending_query(ledger_or_correspondence).order_by(
+            'timestamp', 'asc'
+        ).first()
+        return (parse_timestamp(txn.timestamp) or 0) if txn is not None else None
+
+    async def pending_transactions(
+            self, ledger_or_correspondence: Ledger|Correspondence
+        ) -> list[Transaction]:
+        """Returns up to max_txns of the Transactions of the Ledger or
+            Correspondence that have not been committed to a TxRollup,
+            oldest first. Ledger Transactions are those recorded only on
+            that Ledger, and Correspondence Transactions are those
+            recorded on exactly the Ledgers of the Correspondence with
+            Entries only for its Accounts. Uses the indexed ledger_ids
+            and rollup_id columns, ordered by timestamp, and loads the
+            Transactions max_txns at a time until enough are found.
+        """
+        query = self._pending_query(ledger_or_correspondence).order_by(
+            'timestamp', 'asc'
+        )
+        if type(ledger_or_correspondence) is not Correspondence:
+            txns: list[Transaction] = await query.take(self.max_txns)
+            txns.sort(key=lambda t: (parse_timestamp(t.timestamp) or 0, t.id))
+            return txns
+
+        accounts = await ledger_or_correspondence.get_accounts()
+        acct_ids = set([a.id for _, aa in accounts.items() for _, a in aa.items()])
+        txns = []
+        offset = 0
+        while len(txns) < self.max_txns:
+            chunk: list[Transaction] = await query.skip(offset).take(self.max_txns)
+            if len(chunk) == 0:
+                break
+            offset += len(chunk)
+            entry_ids = [e for txn in chunk for e in txn.entry_ids.split(',')]
+            entries: dict[str, Entry] = {
+                e.id: e
+                for batch in _batches(entry_ids)
+                for e in await Entry.query().is_in('id', batch).get()
+            }
+            txns.extend([
+                txn for txn in chunk
+                if all([
+                    e in entries and entries[e].account_id in acct_ids
+                    for e in txn.entry_ids.split(',')
+                ])
+            ])
+
+        txns = txns[:self.max_txns]
+        txns.sort(key=lambda t: (parse_timestamp(t.timestamp) or 0, t.id))
+        return txns
+
+    async def lag(
+            self, ledger_or_correspondence: Ledger|Correspondence,
+            txns: list[Transaction]|None = None
+        ) -> dict[str, int|float|None]:
+        """Returns the height of the head of the TxRollup chain, the
+            number of pending Transactions, the age in seconds of the
+            oldest pending Transaction, and the seconds since the head
+            of the chain was created (or since the oldest pending
+            Transaction if there is no chain) for the Ledger or
+            Correspondence. If txns is not provided, the pending
+            Transactions are counted with `pending_count` and only read
+            in chunks to find the oldest if there are any, so they are
+            never all loaded at once.
+        """
+        if txns is None:
+            pending = await self.pending_count(ledger_or_correspondence)
+            oldest = None
+            if pending:
+                oldest = await self._oldest_pending(ledger_or_correspondence)
+        else:
+            pending = len(txns)
+            oldest = parse_timestamp(txns[0].timestamp) if len(txns) else None
+        now = time()
+        head = await TxRollup.head_for(ledger_or_correspondence)
+        since = float(head.timestamp) if head is not None else oldest
+        return {
+            'height': head.height if head is not None else None,
+            'pending': pending,
+            'lag': max(now - oldest, 0.0) if oldest is not None else 0.0,
+            'since_head': max(now - since, 0.0) if since is not None else 0.0,
+        }
+
+    async def due(
+            self, ledger_or_correspondence: Ledger|Correspondence,
+            txns: list[Transaction]|None = None
+        ) -> bool:
+        """Returns True if a TxRollup should be created for the Ledger
+            or Correspondence.
+        """
+        return self._due(await self.lag(ledger_or_correspondence, txns))
+
+    def _due(self, lag: dict[str, int|float|None]) -> bool:
+        """Returns True if a TxRollup should be created given the lag."""
+        if lag['pending'] == 0:
+            return False
+        if lag['pending'] >= self.max_txns:
+            return True
+        return self.max_age is not None and lag['since_head'] >= self.max_age
+
+    async def rollup(
+            self, ledger_or_correspondence: Ledger|Correspondence,
+            txns: list[Transaction]|None = None
+        ) -> TxRollup|None:
+        """Creates, saves, and optionally trims a TxRollup of up to
+            max_txns of the pending Transactions of the Ledger or
+            Correspondence, regardless of whether it is due. Returns
+            None if there are no pending Transactions. Raises ValueError
+            for a Correspondence if no signer is configured or if the
+            signed TxRollup is not valid.
+        """
+        tert(type(ledger_or_correspondence) in (Ledger, Correspondence),
+            'ledger_or_correspondence must be a Ledger or Correspondence')
+        vert(type(ledger_or_correspondence) is Ledger or self.signer is not None,
+            'a signer is required to roll up a Correspondence')
+        start = time()
+        if txns is None:
+            txns = await self.pending_transactions(ledger_or_correspondence)
+        txns = txns[:self.max_txns]
+        if len(txns) == 0:
+            return None
+
+        head = await TxRollup.head_for(ledger_or_correspondence)
+        kwargs = {'ledger': ledger_or_correspondence}
+        if type(ledger_or_correspondence) is Correspondence:
+            kwargs = {'correspondence': ledger_or_correspondence}
+        txru = await TxRollup.prepare(
+            txns, head.id if head is not None else None,
+            snapshot_interval=self.snapshot_interval,
+            include_balance_root=self.include_balance_root,
+            **kwargs
+        )
+
+        if type(ledger_or_correspondence) is Correspondence:
+            txru.id = txru.generate_id(txru.data)
+            auth_script = self.signer(txru, ledger_or_correspondence)
+            if isawaitable(auth_script):
+                auth_script = await auth_script
+            txru.auth_script = auth_script
+            vert(await txru.validate(), 'signed TxRollup is not valid')
+        await txru.save()
+
+        trimmed = 0
+        if self.trim:
+            trimmed = await self._trim(txru, ledger_or_correspondence)
+
+        metrics = self.metrics.setdefault(ledger_or_correspondence.id, {})
+        metrics['rollups'] = metrics.get('rollups', 0) + 1
+        metrics['rolled_up'] = metrics.get('rolled_up', 0) + len(txns)
+        metrics['trimmed'] = metrics.get('trimmed', 0) + trimmed
+        metrics['height'] = txru.height
+        metrics['last_rollup_at'] = time()
+        metrics['last_duration'] = metrics['last_rollup_at'] - start
+        return txru
+
+    async def _trim(
+            self, txru: TxRollup,
+            ledger_or_correspondence: Ledger|Correspondence
+        ) -> int:
+        """Trims the untrimmed TxRollups of the chain below the TxRollup
+            in order of height, then the TxRollup itself, since a chain
+            must be trimmed in order. Returns the number of Transactions
+            trimmed.
+        """
+        head = await TxRollupHead.find(ledger_or_correspondence.id)
+        start = 0
+        if head is not None and head.trimmed_height is not None:
+            start = head.trimmed_height + 1
+        column = 'ledger_id'
+        if type(ledger_or_correspondence) is Correspondence:
+            column = 'correspondence_id'
+        untrimmed = await TxRollup.query().equal(
+            column, ledger_or_correspondence.id
+        ).greater_or_equal('height', start).less('height', txru.height).order_by(
+            'height', 'asc'
+        ).get()
+        trimmed = 0
+        for rollup in [*untrimmed, txru]:
+            trimmed += await rollup.trim(segment_dir=self.segment_dir)
+        return trimmed
+
+    async def run_once(self) -> list[TxRollup]:
+        """Checks every watched Ledger and Correspondence once, creating
+            a TxRollup for each that is due, and updates the metrics.
+            The pending Transactions are only loaded for those that
+            appear due by `pending_count`. Returns the created
+            TxRollups.
+        """
+        rollups = []
+        for scope in list(self.watched.values()):
+            lag = await self.lag(scope)
+            if self._due(lag):
+                txns = await self.pending_transactions(scope)
+                if await self.due(scope, txns):
+                    rollups.append(await self.rollup(scope, txns))
+                    lag = await self.lag(scope)
+                else:
+                    lag = await self.lag(scope, txns)
+            self.metrics[scope.id].update({
+                'pending': lag['pending'],
+                'lag': lag['lag'],
+                'since_head': lag['since_head'],
+                'height': lag['height'],
+            })
+        return rollups
+
+    async def run(self, poll_interval: float = 1.0, stop: Event|None = None) -> None:
+        """Calls `run_once` every poll_interval seconds until the stop
+            Event is set. Meant to be run as a background task.
+        """
+        stop = stop or Event()
+        while not stop.is_set():
+            await self.run_once()
+            try:
+                await wait_for(stop.wait(), poll_interval)
+            except TimeoutError:
+                pass
@@ -0,0 +1,147 @@
+from __future__ import annotations
+from .pool import AsyncConnectionPool, _Binding, _PooledCursor, _pools, _retired
+from bookchain.helpers import _batches
+from bookchain.sharding import SHARDED_TABLES, ShardMap
+from sqloquent.errors import tert
+from typing import Any
+import aiosqlite
+
+
+class _ShardedCursor(_PooledCursor):
+    """Cursor that routes writes to the sharded tables to the shards of
+        their Ledgers as described by a `ShardMap`. Updates and deletes
+        are run only in the shards of the rows they match. Other
+        statements are run as by `_PooledCursor`; reads of the sharded
+        tables use the views of all shards.
+    """
+    def __init__(self, binding: _Binding, shard_map: ShardMap) -> None:
+        super().__init__(binding)
+        self.shard_map = shard_map
+        self._rowcount = None
+
+    @property
+    def rowcount(self) -> int:
+        if self._rowcount is None:
+            return super().rowcount
+        return self._rowcount
+
+    async def _fetch(self, sql: str, parameters: Any = ()) -> list:
+        async with self.connection.execute(sql, parameters) as cursor:
+            return await cursor.fetchall()
+
+    async def _account_ledgers(self, account_ids: list[str]) -> dict[str, str]:
+        """Returns a dict mapping the Account IDs to their Ledger IDs."""
+        ledgers = {}
+        for batch in _batches(list(set([a for a in account_ids if a]))):
+            ledgers.update(await self._fetch(
+                f'select id, ledger_id from accounts where id in '
+                f'({",".join(["?" for _ in batch])})',
+                batch
+            ))
+        return ledgers
+
+    async def execute(self, sql: str, parameters: Any = ()) -> _ShardedCursor:
+        if ShardMap.parse(sql) is None:
+            self._rowcount = None
+            return await super().execute(sql, parameters)
+        return await self.executemany(sql, [parameters])
+
+    async def executemany(self, sql: str, parameters: Any) -> _ShardedCursor:
+        write = ShardMap.parse(sql)
+        if write is None:
+            self._rowcount = None
+            return await super().executemany(sql, parameters)
+
+        cursor = await self._prepare(True)
+        kind, table, columns = write
+        parameters = list(parameters)
+        groups: dict[str, list] = {}
+        if kind == 'insert':
+            if columns is None:
+                columns = [
+                    r[1] for r in await self._fetch(f'pragma main.table_info({table})')
+                ]
+            rows = [dict(zip(columns, p)) for p in parameters]
+            account_ledgers = {}
+            if SHARDED_TABLES[table] == 'account_id':
+                account_ledgers = await self._account_ledgers(
+                    [row.get('account_id') for row in rows]
+                )
+            for row, params in zip(rows, parameters):
+                schema = self.shard_map.schema_for_row(table, row, account_ledgers)
+                groups.setdefault(schema, []).append(params)
+        elif ShardMap.routing_sql(sql) is None:
+            groups = {schema: parameters for schema in self.shard_map.schemas}
+        else:
+            query, offset = ShardMap.routing_sql(sql)
+            column = SHARDED_TABLES[table]
+            matches = [
+                [r[0] for r in await self._fetch(query, list(params)[offset:])]
+                for params in parameters
+            ]
+            account_ledgers = {}
+            if column == 'account_id':
+                account_ledgers = await self._account_ledgers(
+                    [v for values in matches for v in values]
+                )
+            for values, params in zip(matches, parameters):
+                schemas = set([
+                    self.shard_map.schema_for_row(table, {column: v}, account_ledgers)
+                    for v in values
+                ])
+                for schema in schemas:
+                    groups.setdefault(schema, []).append(params)
+
+        rowcount = 0
+        for schema, params in groups.items():
+            await cursor.executemany(ShardMap.qualify(sql, schema), params)
+            rowcount += max(cursor.rowcount, 0)
+        self._rowcount = rowcount
+        return self
+
+
+class AsyncShardedPool(AsyncConnectionPool):
+    """An `AsyncConnectionPool` of connections to the home database of a
+        `ShardMap` with the shards attached. Writes to the sharded
+        tables are routed to the shards of their Ledgers, and everything
+        written by the single writer connection within an outermost
+        `AsyncPooledContext` is committed atomically across the shards.
+    """
+    shard_map: ShardMap
+
+    def __init__(self, shard_map: ShardMap, size: int = 1) -> None:
+        """Raises TypeError or ValueError for invalid arguments."""
+        tert(type(shard_map) is ShardMap, 'shard_map must be ShardMap')
+        super().__init__(shard_map.home, size, shard_map.pragmas)
+        self.shard_map = shard_map
+
+    async def _setup_statements(self, connection: aiosqlite.Connection) -> list[str]:
+        """Returns the statements that attach the shards, apply the
+            pragmas, and create the views of the sharded tables.
+        """
+        async with connection.execute(
+            "select name from sqlite_master where type = 'table'"
+        ) as cursor:
+            tables = [r[0] for r in await cursor.fetchall()]
+        return self.shard_map.setup_statements(tables)
+
+    def _cursor(self, binding: _Binding) -> _ShardedCursor:
+        return _ShardedCursor(binding, self.shard_map)
+
+
+def configure_sharding(shard_map: ShardMap, size: int = 1) -> AsyncShardedPool:
+    """Configures the `AsyncShardedPool` used by `AsyncPooledContext`
+        for the home database of the ShardMap and returns it. An
+        existing pool with the same ShardMap and size is kept; a
+        replaced pool keeps its connections until `close_pools` is
+        awaited.
+    """
+    pool = AsyncShardedPool(shard_map, size)
+    existing = _pools.get(shard_map.home)
+    if existing is not None:
+        if type(existing) is AsyncShardedPool and existing.size == size \
+            and existing.shard_map == shard_map:
+            return existing
+        _retired.append(existing)
+    _pools[shard_map.home] = pool
+    return pool
@@ -0,0 +1,131 @@
+from __future__ import annotations
+from bookchain.helpers import _pragma_statements
+from contextvars import ContextVar
+from sqloquent.asyncql import AsyncSqlQueryBuilder, AsyncSqliteContext
+from sqloquent.errors import tert, vert
+from types import TracebackType
+from urllib.parse import quote
+import aiosqlite
+import os
+
+
+_snapshots: ContextVar[dict[str, AsyncSnapshot]] = ContextVar(
+    '_snapshots', default={}
+)
+
+
+def _snapshot_for(connection_info: str) -> AsyncSnapshot|None:
+    """Returns the AsyncSnapshot bound to the connection_info, if any."""
+    return _snapshots.get().get(connection_info)
+
+
+class AsyncSnapshot:
+    """A read-only connection to a database file in WAL journal mode
+        that holds a read transaction open, so every query sees the
+        database as it was when the AsyncSnapshot was entered and
+        writers are never blocked. Within the `async with` block, all
+        models using the connection_info (with `AsyncSnapshotContext` or
+        `AsyncPooledContext`) in the task and the tasks it gathers read
+        through the snapshot connection, and writes fail.
+    """
+    connection_info: str
+    pragmas: dict[str, int|str]
+    connection: aiosqlite.Connection|None
+
+    def __init__(
+            self, connection_info: str,
+            pragmas: dict[str, int|str]|None = None
+        ) -> None:
+        """The pragmas are applied to the snapshot connection, except
+            for journal_mode and synchronous. Raises TypeError or
+            ValueError for invalid arguments.
+        """
+        tert(type(connection_info) is str, 'connection_info must be str')
+        vert(connection_info not in ('', ':memory:'),
+            'connection_info must be a database file path')
+        pragmas = {
+            k: v for k, v in (pragmas or {}).items()
+            if k not in ('journal_mode', 'synchronous')
+        }
+        _pragma_statements(pragmas)
+        self.connection_info = connection_info
+        self.pragmas = pragmas
+        self.connection = None
+
+    async def __aenter__(self) -> AsyncSnapshot:
+        """Opens the snapshot connection, starts the read transaction,
+            and binds it to the connection_info. Raises ValueError if
+            the AsyncSnapshot is already open or the database is not in
+            WAL journal mode, e.g. if it is sharded.
+        """
+        vert(self.connection is None, 'snapshot is already open')
+        uri = f'file:{quote(os.path.abspath(self.connection_info))}?mode=ro'
+        connection = aiosqlite.connect(uri, uri=True, isolation_level=None)
+        # do not block interpreter exit if the snapshot is never exited
+        connection.daemon = True
+        await connection
+        try:
+            async with connection.execute('pragma journal_mode') as cursor:
+                mode = (await cursor.fetchone())[0]
+            vert(mode == 'wal', 'snapshots require a database in WAL journal mode')
+            for statement in _pragma_statements(self.pragmas):
+                await connection.execute(statement)
+            await connection.execute('begin')
+            async with connection.execute('select count(*) from sqlite_master') as cursor:
+                await cursor.fetchone()
+        except BaseException:
+            await connection.close()
+            raise
+        self.connection = connection
+        self._token = _snapshots.set({
+            **_snapshots.get(), self.connection_info: self
+        })
+        return self
+
+    async def __aexit__(
+            self, exc_type: type[BaseException] | None,
+            exc_value: BaseException | None,
+            traceback: TracebackType | None
+        ) -> None:
+        """Ends the read transaction, unbinds the snapshot, and closes
+            the connection.
+        """
+        _snapshots.reset(self._token)
+        try:
+            await self.connection.execute('rollback')
+        finally:
+            await self.connection.close()
+            self.connection = None
+
+
+class AsyncSnapshotContext(AsyncSqliteContext):
+    """sqloquent's AsyncSqliteContext, except that within an
+        `AsyncSnapshot` of the connection_info it returns a cursor of
+        the snapshot connection.
+    """
+    snapshot: AsyncSnapshot|None = None
+
+    async def __aenter__(self) -> aiosqlite.Cursor:
+        """Enter the context block and return the cursor."""
+        self.snapshot = _snapshot_for(self.connection_info)
+        if self.snapshot is None:
+            return await super().__aenter__()
+        self.cursor = await self.snapshot.connection.cursor()
+        return self.cursor
+
+    async def __aexit__(
+            self, exc_type: type[BaseException] | None,
+            exc_value: BaseException | None,
+            traceback: TracebackType | None
+        ) -> None:
+        """Exit the context block."""
+        if self.snapshot is None:
+            return await super().__aexit__(exc_type, exc_value, traceback)
+        await self.cursor.close()
+
+
+class AsyncSnapshotQueryBuilder(AsyncSqlQueryBuilder):
+    """Query builder that uses `AsyncSnapshotContext` by default."""
+    def __init__(self, *args, **kwargs) -> None:
+        kwargs.setdefault('context_manager', AsyncSnapshotContext)
+        super().__init__(*args, **kwargs)
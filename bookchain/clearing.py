@@ -0,0 +1,350 @@
+from __future__ import annotations
+from bookchain.models import Correspondence, Entry
+from bookchain.netting import payments_root, validate_payments
+from collections import deque
+from sqloquent.errors import tert, vert
+
+
+class ClearingGraph:
+    """An in-memory graph of Identities connected by Correspondences,
+        used to route and clear payments between Identities that do not
+        share a Correspondence. Each Correspondence contributes an edge
+        between each pair of its Identities. The credit available for
+        an Identity to pay through a Correspondence is its balance
+        (Nostro - Vostro) plus its credit limit (None for unlimited).
+        Routes are found by breadth-first search and cached by pair of
+        Identities; cached routes are re-checked against the current
+        balances, and the cache is invalidated only when the topology
+        changes.
+    """
+    default_limit: int|None
+    balances: dict[str, dict[str, int]]
+    limits: dict[str, dict[str, int|None]]
+    edges: dict[str, dict[str, set[str]]]
+    _routes: dict[tuple[str, str], list[str]|None]
+
+    def __init__(self, default_limit: int|None = 0) -> None:
+        """Raises TypeError for invalid default_limit."""
+        tert(default_limit is None or type(default_limit) is int,
+            'default_limit must be int or None')
+        self.default_limit = default_limit
+        self.balances = {}
+        self.limits = {}
+        self.edges = {}
+        self._routes = {}
+
+    def set_correspondence(
+            self, correspondence_id: str, balances: dict[str, int],
+            limits: dict[str, int|None]|None = None
+        ) -> None:
+        """Adds or updates a Correspondence with the balances of its
+            Identities (as returned by `Correspondence.balances`) and
+            the optional credit limits of its Identities. The route
+            cache is only invalidated if the Correspondence is new.
+        """
+        tert(type(correspondence_id) is str, 'correspondence_id must be str')
+        tert(type(balances) is dict and all([
+                type(k) is str and type(v) is int for k, v in balances.items()
+            ]), 'balances must be dict[str, int]')
+        tert(limits is None or type(limits) is dict, 'limits must be dict or None')
+        limits = limits or {}
+        is_new = correspondence_id not in self.balances or \
+            set(balances) != set(self.balances[correspondence_id])
+        if is_new and correspondence_id in self.balances:
+            self.remove_correspondence(correspondence_id)
+
+        self.balances[correspondence_id] = {**balances}
+        self.limits[correspondence_id] = {
+            identity_id: limits.get(identity_id, self.default_limit)
+            for identity_id in balances
+        }
+        if not is_new:
+            return
+
+        for identity_id in balances:
+            for other_id in balances:
+                if other_id == identity_id:
+                    continue
+                self.edges.setdefault(identity_id, {}).setdefault(
+                    other_id, set()
+                ).add(correspondence_id)
+        self._routes = {}
+
+    def copy(self) -> ClearingGraph:
+        """Returns a copy of the graph that can be modified without
+            changing this one.
+        """
+        graph = ClearingGraph(self.default_limit)
+        graph.balances = {k: {**v} for k, v in self.balances.items()}
+        graph.limits = {k: {**v} for k, v in self.limits.items()}
+        graph.edges = {
+            k: {other: {*cids} for other, cids in v.items()}
+            for k, v in self.edges.items()
+        }
+        graph._routes = {**self._routes}
+        return graph
+
+    def remove_correspondence(self, correspondence_id: str) -> None:
+        """Removes a Correspondence from the graph."""
+        balances = self.balances.pop(correspondence_id, {})
+        self.limits.pop(correspondence_id, None)
+        for identity_id in balances:
+            neighbors = self.edges.get(identity_id, {})
+            for other_id in balances:
+                neighbors.get(other_id, set()).discard(correspondence_id)
+                if other_id in neighbors and not neighbors[other_id]:
+                    del neighbors[other_id]
+            if identity_id in self.edges and not neighbors:
+                del self.edges[identity_id]
+        self._routes = {}
+
+    def credit(self, correspondence_id: str, identity_id: str) -> int|None:
+        """Returns the credit available to the Identity for paying
+            through the Correspondence, or None if it is unlimited.
+        """
+        limit = self.limits[correspondence_id][identity_id]
+        if limit is None:
+            return None
+        return max(self.balances[correspondence_id][identity_id] + limit, 0)
+
+    def _hop(self, payer_id: str, payee_id: str, amount: int) -> str|None:
+        """Returns the ID of the Correspondence with the most credit
+            available for the payer to pay the amount to the payee, or
+            None if there is not enough credit.
+        """
+        best, best_credit = None, -1
+        for cid in sorted(self.edges.get(payer_id, {}).get(payee_id, ())):
+            credit = self.credit(cid, payer_id)
+            if credit is None:
+                return cid
+            if credit >= amount and credit > best_credit:
+                best, best_credit = cid, credit
+        return best
+
+    def _search(self, payer_id: str, payee_id: str, amount: int|None) -> list[str]|None:
+        """Breadth-first search for the shortest path of Identities from
+            the payer to the payee. If amount is None, credit is ignored.
+        """
+        previous = {payer_id: None}
+        queue = deque([payer_id])
+        while queue:
+            current = queue.popleft()
+            if current == payee_id:
+                path = []
+                while current is not None:
+                    path.append(current)
+                    current = previous[current]
+                return path[::-1]
+            for neighbor in sorted(self.edges.get(current, {})):
+                if neighbor in previous:
+                    continue
+                if amount is not None and self._hop(current, neighbor, amount) is None:
+                    continue
+                previous[neighbor] = current
+                queue.append(neighbor)
+        return None
+
+    def find_route(
+            self, payer_id: str, payee_id: str, amount: int
+        ) -> list[tuple[str, str, str]]|None:
+        """Finds the shortest route with enough available credit for the
+            payer to pay the amount to the payee. Returns a list of
+            (payer ID, payee ID, Correspondence ID) hops, or None if
+            there is no such route.
+        """
+        tert(type(amount) is int, 'amount must be int')
+        vert(amount > 0, 'amount must be positive')
+        vert(payer_id != payee_id, 'payer and payee must differ')
+
+        key = (payer_id, payee_id)
+        if key not in self._routes:
+            self._routes[key] = self._search(payer_id, payee_id, None)
+        path = self._routes[key]
+        if path is None:
+            return None
+
+        hops = [
+            (path[i], path[i+1], self._hop(path[i], path[i+1], amount))
+            for i in range(len(path) - 1)
+        ]
+        if all([cid is not None for _, _, cid in hops]):
+            return hops
+
+        path = self._search(payer_id, payee_id, amount)
+        if path is None:
+            return None
+        return [
+            (path[i], path[i+1], self._hop(path[i], path[i+1], amount))
+            for i in range(len(path) - 1)
+        ]
+
+    def apply(self, hops: list[tuple[str, str, str]], amount: int) -> None:
+        """Applies a payment of the amount along the hops to the cached
+            balances.
+        """
+        for payer_id, payee_id, cid in hops:
+            self.balances[cid][payer_id] -= amount
+            self.balances[cid][payee_id] += amount
+
+    @staticmethod
+    def net_positions(payments: list[tuple[str, str, int]]) -> dict[str, int]:
+        """Returns the net position of each Identity in the payments,
+            omitting Identities with a net position of 0.
+        """
+        validate_payments(payments)
+        positions: dict[str, int] = {}
+        for payer_id, payee_id, amount in payments:
+            positions[payer_id] = positions.get(payer_id, 0) - amount
+            positions[payee_id] = positions.get(payee_id, 0) + amount
+        return {k: v for k, v in positions.items() if v != 0}
+
+    def clear(
+            self, payments: list[tuple[str, str, int]]
+        ) -> list[tuple[str, str, str, int]]:
+        """Clears a batch of (payer ID, payee ID, amount) payments across
+            the whole graph: obligations are first reduced to the net
+            position of each Identity, which cancels all cycles, and
+            then each net debtor is matched with net creditors and the
+            net amounts are routed through Correspondences with enough
+            available credit. The cached balances are updated. Returns
+            the list of (payer ID, payee ID, Correspondence ID, amount)
+            hops, summed per hop. Raises ValueError (and leaves the
+            balances unchanged) if a net amount cannot be routed.
+        """
+        positions = self.net_positions(payments)
+        debtors = sorted(
+            [[i, -p] for i, p in positions.items() if p < 0],
+            key=lambda d: (-d[1], d[0])
+        )
+        creditors = sorted(
+            [[i, p] for i, p in positions.items() if p > 0],
+            key=lambda c: (-c[1], c[0])
+        )
+
+        applied: list[tuple[list[tuple[str, str, str]], int]] = []
+        totals: dict[tuple[str, str, str], int] = {}
+        d, c = 0, 0
+        while d < len(debtors) and c < len(creditors):
+            debtor, creditor = debtors[d], creditors[c]
+            amount = min(debtor[1], creditor[1])
+            hops = self.find_route(debtor[0], creditor[0], amount)
+            if hops is None:
+                for undo_hops, undo_amount in applied:
+                    self.apply([(b, a, cid) for a, b, cid in undo_hops], undo_amount)
+                raise ValueError(
+                    f'no route with enough credit from {debtor[0]} to {creditor[0]}'
+                )
+            self.apply(hops, amount)
+            applied.append((hops, amount))
+            for hop in hops:
+                totals[hop] = totals.get(hop, 0) + amount
+            debtor[1] -= amount
+            creditor[1] -= amount
+            if debtor[1] == 0:
+                d += 1
+            if creditor[1] == 0:
+                c += 1
+
+        return [(a, b, cid, amount) for (a, b, cid), amount in totals.items()]
+
+
+class ClearingHouse:
+    """A ClearingHouse routes and clears payments between Identities
+        across chains of Correspondences. The Correspondences and the
+        balances of their Identities are loaded once into a cached
+        ClearingGraph. Clearing does not change the cached balances,
+        since the Transactions are only recorded once the caller has
+        signed and saved them; call `refresh` for each Correspondence
+        once its Transactions have been saved. Credit limits are read
+        from the 'credit_limits' dict (Identity ID to int or None) in
+        the details of each Correspondence, falling back to
+        default_limit.
+    """
+    graph: ClearingGraph
+    correspondences: dict[str, Correspondence]
+
+    def __init__(self, default_limit: int|None = 0) -> None:
+        """Raises TypeError for invalid default_limit."""
+        self.graph = ClearingGraph(default_limit)
+        self.correspondences = {}
+
+    def add(
+            self, correspondence: Correspondence,
+            limits: dict[str, int|None]|None = None
+        ) -> None:
+        """Adds a Correspondence to the graph, loading the balances of
+            its Identities. The limits override the 'credit_limits' in
+            the details of the Correspondence. Raises TypeError for an
+            invalid argument.
+        """
+        tert(type(correspondence) is Correspondence,
+            'correspondence must be a Correspondence')
+        balances = correspondence.balances()
+        self.correspondences[correspondence.id] = correspondence
+        self.graph.set_correspondence(
+            correspondence.id,
+            {
+                identity_id: balances.get(identity_id, 0)
+                for identity_id in correspondence.identity_ids.split(',')
+            },
+            limits if limits is not None else
+                correspondence.details.get('credit_limits', None)
+        )
+
+    def remove(self, correspondence: Correspondence) -> None:
+        """Removes a Correspondence from the graph."""
+        self.correspondences.pop(correspondence.id, None)
+        self.graph.remove_correspondence(correspondence.id)
+
+    def refresh(self, correspondence: Correspondence|None = None) -> None:
+        """Reloads the balances of a Correspondence, or of all the
+            Correspondences if none is provided.
+        """
+        if correspondence is not None:
+            return self.add(correspondence)
+        for correspondence in list(self.correspondences.values()):
+            self.add(correspondence)
+
+    def find_route(
+            self, payer_id: str, payee_id: str, amount: int
+        ) -> list[tuple[str, str, Correspondence]]|None:
+        """Finds the shortest route with enough available credit for the
+            payer to pay the amount to the payee. Returns a list of
+            (payer ID, payee ID, Correspondence) hops, or None if there
+            is no such route.
+        """
+        hops = self.graph.find_route(payer_id, payee_id, amount)
+        if hops is None:
+            return None
+        return [(a, b, self.correspondences[cid]) for a, b, cid in hops]
+
+    def clear(
+            self, payments: list[tuple[str, str, int]], txn_nonce: bytes
+        ) -> list[tuple[Correspondence, list[Entry], list[Entry], dict[str, bytes]]]:
+        """Nets a batch of (payer ID, payee ID, amount) payments across
+            the whole graph (cancelling cyclic obligations), routes the
+            net amounts, and prepares the entries for each hop with
+            `Correspondence.settle_payments`. Returns a list of tuples
+            of the Correspondence, the two lists of entries, and the
+            Transaction details, which additionally include the
+            'clearing_root' committing to the original payments. The
+            payments are routed on a copy of the graph, so the cached
+            balances are unchanged until the Correspondences are
+            refreshed after the Transactions are saved. Raises
+            ValueError if a net amount cannot be routed.
+        """
+        hops = self.graph.copy().clear(payments)
+        clearing_root = payments_root(payments)
+        by_correspondence: dict[str, list[tuple[str, str, int]]] = {}
+        for payer_id, payee_id, cid, amount in hops:
+            by_correspondence.setdefault(cid, []).append((payer_id, payee_id, amount))
+
+        settlements = []
+        for cid in sorted(by_correspondence):
+            correspondence = self.correspondences[cid]
+            for entries1, entries2, details in correspondence.settle_payments(
+                by_correspondence[cid], txn_nonce
+            ):
+                details['clearing_root'] = clearing_root
+                settlements.append((correspondence, entries1, entries2, details))
+        return settlements
@@ -1,4 +1,5 @@
 from datetime import datetime
+from sqloquent.errors import tert, vert
 
 
 def parse_timestamp(timestamp: str) -> int|None:
@@ -49,3 +50,40 @@ def parse_timestamp(timestamp: str) -> int|None:
             continue
 
     return None
+
+def _insert_sql(table: str, columns: tuple[str], ignore: bool = False) -> str:
+    """Returns the SQL for inserting rows of the given columns, ignoring
+        rows that already exist if ignore is True.
+    """
+    return (
+        f'insert {"or ignore " if ignore else ""}into {table} '
+        f'({",".join(columns)}) values ({",".join(["?" for _ in columns])})'
+    )
+
+def _batches(items: list, size: int = 500) -> list[list]:
+    """Splits a list into batches to stay under the SQLite parameter limit."""
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+DEFAULT_PRAGMAS: dict[str, int|str] = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,
+    'temp_store': 'memory',
+    'cache_size': -16000,
+    'mmap_size': 134217728,
+}
+
+def _pragma_statements(pragmas: dict[str, int|str]) -> list[str]:
+    """Returns the SQL statements for setting the pragmas. Raises
+        TypeError or ValueError for invalid pragmas.
+    """
+    tert(type(pragmas) is dict, 'pragmas must be dict[str, int|str]')
+    statements = []
+    for name, value in pragmas.items():
+        tert(type(name) is str and type(value) in (int, str),
+            'pragmas must be dict[str, int|str]')
+        vert(name.isidentifier(), f'invalid pragma name: {name}')
+        vert(type(value) is int or value.isidentifier(),
+            f'invalid value for pragma {name}: {value}')
+        statements.append(f'pragma {name} = {value}')
+    return statements
@@ -0,0 +1,249 @@
+from __future__ import annotations
+from bookchain.helpers import _batches
+from sqloquent.errors import tert, vert
+import os
+import sqlite3
+
+
+_engines: dict[str, MemoryEngine] = {}
+_CHANGES = '_bookchain_changes'
+_BASE = '_bookchain_base'
+
+
+def get_engine(connection_info: str) -> MemoryEngine|None:
+    """Returns the open MemoryEngine with the connection_info, if any."""
+    return _engines.get(connection_info)
+
+def _open(connection_info: str) -> sqlite3.Connection:
+    """Opens a connection to a database file or a MemoryEngine."""
+    engine = get_engine(connection_info)
+    return engine.connect() if engine else sqlite3.connect(connection_info)
+
+
+class MemoryEngine:
+    """An in-memory copy of a database forked from a database file (or
+        another MemoryEngine), for running simulations through the
+        models without touching the disk. The copy includes the schema
+        and the indexes on the columns of every model, so queries and
+        the raw SQL of the models run unchanged. Set the
+        connection_info of the models to the `connection_info` of the
+        engine with `set_connection_info` to use it. Every row inserted,
+        updated, or deleted after the fork is tracked by triggers, so
+        the changes can be read with `diff` and written back with
+        `apply`. The first change to a row also records the row as it
+        was at the fork, so `apply` can refuse to overwrite rows that
+        were changed in the target since. The database lives until
+        `close` is called.
+    """
+    source: str
+    connection_info: str
+    _keeper: sqlite3.Connection|None
+
+    def __init__(self, source: str) -> None:
+        """Forks the database file (or MemoryEngine connection_info) at
+            source. Raises TypeError or ValueError for an invalid
+            source.
+        """
+        tert(type(source) is str, 'source must be str')
+        vert(get_engine(source) is not None or os.path.isfile(source),
+            'source must be a database file path or MemoryEngine connection_info')
+        self.source = source
+        self.connection_info = (
+            f'file:/bookchain-memory-{os.urandom(8).hex()}?vfs=memdb'
+        )
+        self._keeper = self.connect()
+        connection = _open(source)
+        try:
+            # unlike a backup, the copy is never in WAL mode, which the
+            # memdb VFS cannot open
+            connection.execute('vacuum into ?', [self.connection_info])
+        finally:
+            connection.close()
+        self._keeper.execute(f'drop table if exists {_CHANGES}')
+        self._keeper.execute(
+            f'create table {_CHANGES} (tbl text, id text, primary key (tbl, id))'
+        )
+        for table in self.tables():
+            columns = [
+                r[1] for r in self._keeper.execute(f'pragma table_info("{table}")')
+            ]
+            self._keeper.execute(f'drop table if exists "{_BASE}_{table}"')
+            self._keeper.execute(
+                f'create table "{_BASE}_{table}" as select * from "{table}" where 0'
+            )
+            self._keeper.execute(
+                f'create unique index "{_BASE}_{table}_id" on "{_BASE}_{table}" (id)'
+            )
+            self._keeper.executescript(''.join([
+                f'drop trigger if exists {_CHANGES}_{table}_{event}; '
+                f'create trigger {_CHANGES}_{table}_{event} '
+                f'after {event} on "{table}" begin '
+                # keep the row as it was at the fork on its first change
+                + (
+                    f'insert or ignore into "{_BASE}_{table}" select '
+                    f'{",".join([f"old.{c}" for c in columns])} where not exists '
+                    f"(select 1 from {_CHANGES} where tbl = '{table}' and id = old.id); "
+                    if 'old' in rows else ''
+                )
+                + ''.join([
+                    f"insert or ignore into {_CHANGES} values ('{table}', {row}.id); "
+                    for row in rows
+                ])
+                + 'end;'
+                for event, rows in (
+                    ('insert', ['new']), ('update', ['old', 'new']), ('delete', ['old']),
+                )
+            ]))
+        self._keeper.commit()
+        _engines[self.connection_info] = self
+
+    def connect(self) -> sqlite3.Connection:
+        """Opens a connection to the in-memory database. Readers wait
+            up to the busy timeout for a writer to commit rather than
+            seeing its uncommitted writes.
+        """
+        return sqlite3.connect(self.connection_info, uri=True)
+
+    def fork(self) -> MemoryEngine:
+        """Returns a new MemoryEngine forked from this one."""
+        return MemoryEngine(self.connection_info)
+
+    def tables(self) -> list[str]:
+        """Returns the tables whose rows are tracked: every table with
+            an id column except the migrations table and the tables of
+            the engine.
+        """
+        vert(self._keeper is not None, 'engine is closed')
+        return [
+            name for (name,) in self._keeper.execute(
+                "select name from sqlite_master where type = 'table' "
+                "and name not like 'sqlite_%' and name != 'migrations' "
+                "and name not like '\\_bookchain\\_%' escape '\\'"
+            ).fetchall()
+            if 'id' in [
+                r[1] for r in self._keeper.execute(f'pragma table_info("{name}")')
+            ]
+        ]
+
+    def diff(self) -> dict[str, dict[str, dict|None]]:
+        """Returns the rows changed since the fork (or the last `apply`)
+            as a dict mapping each table to a dict mapping the row IDs
+            to the current rows, or to None for deleted rows.
+        """
+        vert(self._keeper is not None, 'engine is closed')
+        changes: dict[str, list[str]] = {}
+        for table, id in self._keeper.execute(
+            f'select tbl, id from {_CHANGES} order by tbl, id'
+        ).fetchall():
+            changes.setdefault(table, []).append(id)
+
+        diff = {}
+        for table, ids in changes.items():
+            diff[table] = {id: None for id in ids}
+            for batch in _batches(ids):
+                cursor = self._keeper.execute(
+                    f'select * from "{table}" where id in '
+                    f'({",".join(["?" for _ in batch])})',
+                    batch
+                )
+                columns = [c[0] for c in cursor.description]
+                for row in cursor.fetchall():
+                    row = dict(zip(columns, row))
+                    diff[table][row['id']] = row
+        return diff
+
+    def apply(self, target: str|None = None) -> int:
+        """Writes the changes since the fork (or the last `apply`) to the
+            target database file or MemoryEngine connection_info
+            (default the source) in one transaction, then starts
+            tracking changes anew. Changed rows replace the rows with
+            the same IDs in the target, and deleted rows are deleted
+            from it. Returns the number of rows written or deleted.
+            Raises ValueError and writes nothing if any of the rows was
+            changed in the target since the fork.
+        """
+        target = self.source if target is None else target
+        tert(type(target) is str, 'target must be str')
+        diff = self.diff()
+        connection = _open(target)
+        count = 0
+        try:
+            connection.execute('begin immediate')
+            conflicts = [
+                f'{table}:{id}' for table, rows in diff.items()
+                for id in self._conflicts(connection, table, list(rows))
+            ]
+            vert(not conflicts,
+                f'rows changed in the target since the fork: {", ".join(conflicts)}')
+            for table, rows in diff.items():
+                for batch in _batches(list(rows)):
+                    connection.execute(
+                        f'delete from "{table}" where id in '
+                        f'({",".join(["?" for _ in batch])})',
+                        batch
+                    )
+                changed = [row for row in rows.values() if row is not None]
+                if changed:
+                    columns = list(changed[0])
+                    connection.executemany(
+                        f'insert into "{table}" ({",".join(columns)}) '
+                        f'values ({",".join(["?" for _ in columns])})',
+                        [[row[c] for c in columns] for row in changed]
+                    )
+                count += len(rows)
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        self._keeper.execute(f'delete from {_CHANGES}')
+        for table in self.tables():
+            self._keeper.execute(f'delete from "{_BASE}_{table}"')
+        self._keeper.commit()
+        return count
+
+    def _conflicts(
+            self, connection: sqlite3.Connection, table: str, ids: list[str]
+        ) -> list[str]:
+        """Returns the IDs of the rows of the table that differ in the
+            target connection from the rows at the fork.
+        """
+        conflicts = []
+        for batch in _batches(ids):
+            placeholders = ",".join(["?" for _ in batch])
+            cursor = self._keeper.execute(
+                f'select * from "{_BASE}_{table}" where id in ({placeholders})',
+                batch
+            )
+            columns = [c[0] for c in cursor.description]
+            base = {
+                row['id']: row for row in
+                [dict(zip(columns, r)) for r in cursor.fetchall()]
+            }
+            cursor = connection.execute(
+                f'select * from "{table}" where id in ({placeholders})', batch
+            )
+            columns = [c[0] for c in cursor.description]
+            current = {
+                row['id']: row for row in
+                [dict(zip(columns, r)) for r in cursor.fetchall()]
+            }
+            conflicts.extend([
+                id for id in batch
+                if (id in base) != (id in current)
+                or (id in base and any(
+                    base[id][c] != current[id].get(c) for c in base[id]
+                ))
+            ])
+        return conflicts
+
+    def close(self) -> None:
+        """Closes the engine; the database is freed once every other
+            connection to it is closed.
+        """
+        if self._keeper is None:
+            return
+        _engines.pop(self.connection_info, None)
+        self._keeper.close()
+        self._keeper = None
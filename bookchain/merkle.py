@@ -0,0 +1,216 @@
+from bookchain.enums import EntryType
+from hashlib import sha256
+from sqloquent.errors import vert
+import packify
+
+
+_empty_node = b'\x00' * 32
+
+
+def _key(account_id: str) -> bytes:
+    return sha256(account_id.encode('utf-8')).digest()
+
+def _bit(key: bytes, depth: int) -> int:
+    return (key[depth // 8] >> (7 - depth % 8)) & 1
+
+def _leaf_hash(key: bytes, balance: tuple[EntryType, int]) -> bytes:
+    value = packify.pack((balance[0].value, balance[1]))
+    return sha256(b'\x00' + key + value).digest()
+
+def _node_hash(left: bytes, right: bytes) -> bytes:
+    return sha256(b'\x01' + left + right).digest()
+
+def _subtree(leaves: list[tuple[bytes, bytes]], depth: int) -> bytes:
+    if len(leaves) == 0:
+        return _empty_node
+    if len(leaves) == 1:
+        return leaves[0][1]
+    left = [leaf for leaf in leaves if not _bit(leaf[0], depth)]
+    right = [leaf for leaf in leaves if _bit(leaf[0], depth)]
+    return _node_hash(_subtree(left, depth + 1), _subtree(right, depth + 1))
+
+def _leaves(balances: dict[str, tuple[EntryType, int]]) -> list[tuple[bytes, bytes]]:
+    leaves = []
+    for account_id, balance in balances.items():
+        key = _key(account_id)
+        leaves.append((key, _leaf_hash(key, balance)))
+    return leaves
+
+def calculate_balance_root(balances: dict[str, tuple[EntryType, int]]) -> str:
+    """Calculates the hex root of the sparse Merkle tree of the given
+        balances. Leaves are keyed by the sha256 of the account ID; a
+        subtree containing a single leaf is represented by the leaf
+        hash, and an empty subtree by 32 null bytes, so a tree of n
+        leaves takes about 2n hashes to build and a proof contains
+        about log2(n) sibling hashes.
+    """
+    return _subtree(_leaves(balances), 0).hex()
+
+def prove_balance(
+        balances: dict[str, tuple[EntryType, int]], account_id: str
+    ) -> bytes:
+    """Creates a proof that the balance of the given account is
+        committed to in the sparse Merkle tree of the given balances.
+        Raises ValueError if the account has no balance.
+    """
+    vert(account_id in balances, 'account_id must have a balance')
+    key = _key(account_id)
+    leaves = _leaves(balances)
+    siblings = []
+    depth = 0
+    while len(leaves) > 1:
+        same = [leaf for leaf in leaves if _bit(leaf[0], depth) == _bit(key, depth)]
+        other = [leaf for leaf in leaves if _bit(leaf[0], depth) != _bit(key, depth)]
+        sibling = _subtree(other, depth + 1)
+        siblings.append(b'' if sibling == _empty_node else sibling)
+        leaves = same
+        depth += 1
+    return packify.pack(siblings)
+
+def verify_balance_proof(
+        root: str|bytes, account_id: str,
+        balance: tuple[EntryType, int], proof: bytes
+    ) -> bool:
+    """Verifies a proof that the given account balance is committed
+        to in the sparse Merkle tree with the given root.
+    """
+    root = bytes.fromhex(root) if type(root) is str else root
+    try:
+        siblings = packify.unpack(proof)
+    except Exception:
+        return False
+    if type(siblings) is not list or len(siblings) > 256:
+        return False
+    if not all(type(s) is bytes and len(s) in (0, 32) for s in siblings):
+        return False
+
+    key = _key(account_id)
+    node = _leaf_hash(key, balance)
+    for depth in reversed(range(len(siblings))):
+        sibling = siblings[depth] or _empty_node
+        if _bit(key, depth):
+            node = _node_hash(sibling, node)
+        else:
+            node = _node_hash(node, sibling)
+    return node == root
+
+def _mmr_leaf_hash(rollup_id: str) -> bytes:
+    return sha256(b'\x00' + bytes.fromhex(rollup_id)).digest()
+
+def _mmr_bag(peaks: list[bytes], size: int) -> bytes:
+    return sha256(b'\x02' + size.to_bytes(8, 'big') + b''.join(peaks)).digest()
+
+def _mmr_mountains(size: int) -> list[tuple[int, int]]:
+    """Returns the (first leaf index, number of leaves) of each mountain
+        of an MMR of the given size, from left to right.
+    """
+    mountains = []
+    start = 0
+    for bit in reversed(range(size.bit_length())):
+        if size & (1 << bit):
+            mountains.append((start, 1 << bit))
+            start += 1 << bit
+    return mountains
+
+def mmr_append(peaks: list[bytes], size: int, rollup_id: str) -> list[bytes]:
+    """Appends a TxRollup ID to a Merkle Mountain Range of the given
+        size (number of leaves) with the given peaks (from left to
+        right) and returns the new peaks. Takes at most log2(size)
+        hashes.
+    """
+    vert(len(peaks) == bin(size).count('1'), 'peaks do not match size')
+    peaks = [*peaks, _mmr_leaf_hash(rollup_id)]
+    height = 0
+    while size & (1 << height):
+        right = peaks.pop()
+        left = peaks.pop()
+        peaks.append(_node_hash(left, right))
+        height += 1
+    return peaks
+
+def mmr_peaks(rollup_ids: list[str]) -> list[bytes]:
+    """Calculates the peaks of the Merkle Mountain Range of the given
+        TxRollup IDs, ordered by height.
+    """
+    peaks = []
+    for size, rollup_id in enumerate(rollup_ids):
+        peaks = mmr_append(peaks, size, rollup_id)
+    return peaks
+
+def mmr_root(peaks: list[bytes], size: int) -> str:
+    """Returns the hex root of a Merkle Mountain Range, which commits
+        to the peaks and the number of leaves.
+    """
+    vert(len(peaks) == bin(size).count('1'), 'peaks do not match size')
+    return _mmr_bag(peaks, size).hex()
+
+def mmr_mountain(size: int, index: int) -> tuple[int, int]:
+    """Returns the (first leaf index, number of leaves) of the mountain
+        containing the leaf at the given index in a Merkle Mountain
+        Range of the given size. Raises ValueError for invalid index.
+    """
+    vert(0 <= index < size, 'index out of range')
+    for start, count in _mmr_mountains(size):
+        if start <= index < start + count:
+            return (start, count)
+
+def prove_mmr_inclusion(
+        peaks: list[bytes], size: int, index: int, mountain_ids: list[str]
+    ) -> bytes:
+    """Creates a proof that the leaf at the given index is committed to
+        in the Merkle Mountain Range with the given peaks and size. Only
+        the TxRollup IDs of the mountain containing the leaf (see
+        `mmr_mountain`) are needed. The proof contains the index, the
+        size, about log2(size) sibling hashes, and the other peaks.
+        Raises ValueError for invalid arguments.
+    """
+    vert(len(peaks) == bin(size).count('1'), 'peaks do not match size')
+    start, count = mmr_mountain(size, index)
+    vert(len(mountain_ids) == count, 'mountain_ids do not match the mountain')
+    nodes = [_mmr_leaf_hash(rollup_id) for rollup_id in mountain_ids]
+    position = index - start
+    siblings = []
+    while len(nodes) > 1:
+        siblings.append(nodes[position ^ 1])
+        nodes = [_node_hash(nodes[i], nodes[i+1]) for i in range(0, len(nodes), 2)]
+        position //= 2
+    peak_index = [s for s, _ in _mmr_mountains(size)].index(start)
+    vert(nodes[0] == peaks[peak_index], 'mountain_ids do not match the peaks')
+    return packify.pack((index, size, siblings, peaks))
+
+def verify_mmr_inclusion(
+        root: str|bytes, rollup_id: str, proof: bytes, index: int|None = None
+    ) -> bool:
+    """Verifies a proof that the given TxRollup ID is committed to in
+        the Merkle Mountain Range with the given root. If index is
+        provided (i.e. the height of the TxRollup), the proof must also
+        be for that leaf index.
+    """
+    root = bytes.fromhex(root) if type(root) is str else root
+    try:
+        proven_index, size, siblings, peaks = packify.unpack(proof)
+        start, count = mmr_mountain(size, proven_index)
+    except Exception:
+        return False
+    if index is not None and index != proven_index:
+        return False
+    index = proven_index
+    if type(siblings) is not list or type(peaks) is not list:
+        return False
+    if len(siblings) != count.bit_length() - 1 or len(peaks) != bin(size).count('1'):
+        return False
+    if not all(type(s) is bytes and len(s) == 32 for s in [*siblings, *peaks]):
+        return False
+
+    node = _mmr_leaf_hash(rollup_id)
+    position = index - start
+    for sibling in siblings:
+        if position & 1:
+            node = _node_hash(sibling, node)
+        else:
+            node = _node_hash(node, sibling)
+        position //= 2
+    peak_index = [s for s, _ in _mmr_mountains(size)].index(start)
+    if node != peaks[peak_index]:
+        return False
+    return _mmr_bag(peaks, size) == root
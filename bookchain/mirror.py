@@ -0,0 +1,132 @@
+from __future__ import annotations
+from sqloquent.errors import tert, vert
+from socket import socket
+from typing import Awaitable, Callable
+import packify
+import struct
+
+
+_headers_marker = 'txru_headers'
+_request_marker = 'txru_request'
+
+
+def encode_request(scope_id: str, from_height: int, limit: int) -> bytes:
+    """Encodes a request for the TxRollup headers of the chain of the
+        given Ledger or Correspondence ID starting at from_height.
+    """
+    tert(type(scope_id) is str, 'scope_id must be str')
+    tert(type(from_height) is int and from_height >= 0,
+        'from_height must be a non-negative int')
+    tert(type(limit) is int and limit > 0, 'limit must be a positive int')
+    return packify.pack((_request_marker, scope_id, from_height, limit))
+
+def decode_request(data: bytes) -> tuple[str, int, int]:
+    """Decodes a request into the scope ID, from_height, and limit.
+        Raises ValueError for an invalid request.
+    """
+    try:
+        request = packify.unpack(data)
+    except Exception:
+        raise ValueError('invalid request')
+    vert(type(request) is tuple and len(request) == 4 and
+        request[0] == _request_marker, 'invalid request')
+    _, scope_id, from_height, limit = request
+    vert(type(scope_id) is str and type(from_height) is int and
+        type(limit) is int and from_height >= 0 and limit > 0,
+        'invalid request')
+    return (scope_id, from_height, limit)
+
+def encode_headers(scope_id: str, headers: list[dict]) -> bytes:
+    """Encodes a range of TxRollup headers (the dicts returned by
+        `TxRollup.public`) of the chain of the given Ledger or
+        Correspondence ID. The headers must be sorted by height.
+    """
+    tert(type(scope_id) is str, 'scope_id must be str')
+    tert(type(headers) is list and all([type(h) is dict for h in headers]),
+        'headers must be list[dict]')
+    return packify.pack((_headers_marker, scope_id, headers))
+
+def decode_headers(data: bytes) -> tuple[str, list[dict]]:
+    """Decodes a range of TxRollup headers into the scope ID and the
+        list of header dicts. Raises ValueError for invalid data.
+    """
+    try:
+        decoded = packify.unpack(data)
+    except Exception:
+        raise ValueError('invalid headers')
+    vert(type(decoded) is tuple and len(decoded) == 3 and
+        decoded[0] == _headers_marker, 'invalid headers')
+    _, scope_id, headers = decoded
+    vert(type(scope_id) is str and type(headers) is list and
+        all([type(h) is dict for h in headers]), 'invalid headers')
+    return (scope_id, headers)
+
+
+class InProcessTransport:
+    """Stand-in transport that passes each request directly to the
+        handler, e.g. `TxRollup.serve_headers` of the source database.
+        If the handler is a coroutine function, `request` returns an
+        awaitable.
+    """
+    handler: Callable[[bytes], bytes|Awaitable[bytes]]
+
+    def __init__(self, handler: Callable[[bytes], bytes|Awaitable[bytes]]) -> None:
+        tert(callable(handler), 'handler must be callable')
+        self.handler = handler
+
+    def request(self, data: bytes) -> bytes|Awaitable[bytes]:
+        """Sends the request to the handler and returns its response."""
+        return self.handler(data)
+
+
+class SocketTransport:
+    """Stand-in transport over a connected stream socket (e.g. one
+        end of `socket.socketpair()` or a local unix socket). Each
+        message is framed with a 4-byte big-endian length prefix. The
+        other end is served with `SocketTransport.serve`.
+    """
+    sock: socket
+
+    def __init__(self, sock: socket) -> None:
+        self.sock = sock
+
+    @staticmethod
+    def send_frame(sock: socket, data: bytes) -> None:
+        """Sends a length-prefixed frame."""
+        sock.sendall(struct.pack('>I', len(data)) + data)
+
+    @staticmethod
+    def recv_frame(sock: socket) -> bytes|None:
+        """Receives a length-prefixed frame. Returns None if the
+            connection was closed.
+        """
+        def recv_exact(size: int) -> bytes|None:
+            data = b''
+            while len(data) < size:
+                chunk = sock.recv(size - len(data))
+                if not chunk:
+                    return None
+                data += chunk
+            return data
+        prefix = recv_exact(4)
+        if prefix is None:
+            return None
+        return recv_exact(struct.unpack('>I', prefix)[0])
+
+    def request(self, data: bytes) -> bytes:
+        """Sends the request and waits for the response. Raises
+            ConnectionError if the connection was closed.
+        """
+        self.send_frame(self.sock, data)
+        response = self.recv_frame(self.sock)
+        if response is None:
+            raise ConnectionError('connection closed')
+        return response
+
+    @classmethod
+    def serve(cls, sock: socket, handler: Callable[[bytes], bytes]) -> None:
+        """Answers requests on the socket with the handler until the
+            connection is closed. Meant to be run in a thread.
+        """
+        while (data := cls.recv_frame(sock)) is not None:
+            cls.send_frame(sock, handler(data))
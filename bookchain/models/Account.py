@@ -1,5 +1,6 @@
 from __future__ import annotations
 from .Entry import Entry
+from .TxRollupHead import TxRollupHead
 from bookchain.enums import AccountType, EntryType
 from sqloquent import HashedModel, RelatedModel, RelatedCollection, Default
 from sqloquent.interfaces import QueryBuilderProtocol
@@ -115,13 +116,29 @@ class Account(HashedModel):
             conditions['type'] = conditions['type'].value
         return super().query(conditions, connection_info)
 
+    def _descendant_correspondence_ids(self) -> list[str]:
+        """Returns the Correspondence IDs of the sub-accounts."""
+        ids = []
+        for acct in self.children:
+            acct: Account
+            ids.append(acct.correspondence_id)
+            ids.extend(acct._descendant_correspondence_ids())
+        return ids
+
     def balance(self, include_sub_accounts: bool = True,
-                rolled_up_balances: dict[str, tuple[EntryType, int]] = {}) -> int:
+                rolled_up_balances: dict[str, tuple[EntryType, int]]|None = None) -> int:
         """Tally all entries for this account. Includes the balances of
-            all sub-accounts if include_sub_accounts is True. To get an
-            accurate balance, pass in the balances from the most recent
-            TxRollup.
+            all sub-accounts if include_sub_accounts is True. Unless
+            rolled_up_balances is passed, the balances of the most
+            recent trimmed TxRollups of the chains of the Ledger and of
+            the Correspondences of the Accounts are used as the starting
+            balances.
         """
+        if rolled_up_balances is None:
+            scope_ids = [self.ledger_id, self.correspondence_id]
+            if include_sub_accounts:
+                scope_ids.extend(self._descendant_correspondence_ids())
+            rolled_up_balances = TxRollupHead.get_rolled_up_balances(*scope_ids)
         totals = {
             EntryType.CREDIT: 0,
             EntryType.DEBIT: 0,
@@ -3,12 +3,27 @@ from .Account import Account, AccountType
 from .Entry import Entry, EntryType
 from .Identity import Identity
 from .Ledger import Ledger
+from .TxRollupHead import TxRollupHead
+from bookchain.helpers import _batches, _insert_sql
+from bookchain.netting import net_payments, payments_root, validate_payments
 from sqloquent import HashedModel, RelatedCollection
 from sqloquent.errors import tert, vert
 import packify
+import tapescript
 
 
 _empty_dict = packify.pack({})
+_balances_sql = (
+    'with recursive tree(id, root) as ('
+    f'select id, id from {Account.table} where correspondence_id = ? and type in (?, ?) '
+    f'union all select a.id, tree.root from {Account.table} a '
+    'join tree on a.parent_id = tree.id) '
+    f'select tree.id, l.identity_id, e.type, sum(e.amount) from tree '
+    f'join {Account.table} r on r.id = tree.root '
+    f'join {Ledger.table} l on l.id = r.ledger_id '
+    f'left join {Entry.table} e on e.account_id = tree.id '
+    'group by tree.id, e.type'
+)
 
 
 class Correspondence(HashedModel):
@@ -27,15 +42,18 @@ class Correspondence(HashedModel):
     id_column: str = 'id'
     columns: tuple[str] = (
         'id', 'identity_ids', 'ledger_ids', 'details', 'signatures',
-        'description'
+        'description', 'equity_account_ids',
+    )
+    columns_excluded_from_hash: tuple[str] = (
+        'signatures', 'description', 'equity_account_ids',
     )
-    columns_excluded_from_hash: tuple[str] = ('signatures', 'description')
     id: str
     identity_ids: str
     ledger_ids: str
     details: bytes
     signatures: bytes|None
     description: str|None
+    equity_account_ids: str|None
     identities: RelatedCollection
     ledgers: RelatedCollection
     rollups: RelatedCollection
@@ -79,35 +97,75 @@ class Correspondence(HashedModel):
         """Returns the txru_lock directly from the details field."""
         return self.details.get('txru_lock', None)
 
-    def get_accounts(self, reload: bool = True) -> dict[str, dict[AccountType, Account]]:
+    def get_txru_lock(self, reload: bool = False) -> bytes|None:
+        """Returns the txru_lock from the details field if one was set.
+            Otherwise, returns an n-of-n multisig lock made from the
+            pubkeys of the Identities, or None if not all Identities
+            have a pubkey (in which case TxRollups for this
+            Correspondence are authorized by default).
+        """
+        txru_lock = self.txru_lock
+        if txru_lock is not None:
+            return txru_lock
+        if reload:
+            self.identities().reload()
+        pubkeys = [identity.pubkey for identity in self.identities]
+        if not all([pk and len(pk) > 0 for pk in pubkeys]):
+            return None
+        return tapescript.make_multisig_lock(pubkeys, len(pubkeys)).bytes
+
+    def get_accounts(self, reload: bool = False) -> dict[str, dict[AccountType, Account]]:
         """Loads the relevant nostro and vostro Accounts for the
             Identities that are part of the Correspondence, as well as
             the equity Accounts for each Identity, returning a dict of
-            the form { identity.id: { AccountType: Account }}.
+            the form { identity.id: { AccountType: Account }}. The
+            Accounts are loaded with one query each for the Ledgers, the
+            correspondent Accounts, and the equity Accounts, which are
+            looked up by the IDs in the non-hashed equity_account_ids
+            column or, if it is not set, by the 'General Equity' name
+            prefix. Once every Identity has all three Accounts, the
+            result is kept on the Correspondence and returned by later
+            calls until reload=True is passed.
         """
-        if reload:
-            self.ledgers().reload()
-            self.accounts().reload()
-            self.identities().reload()
+        if not reload:
+            cached = self.__dict__.get('_accounts', None)
+            if cached is not None:
+                return {k: {**v} for k, v in cached.items()}
 
+        ledger_ids = self.data['ledger_ids'].split(',')
+        ledgers: dict[str, Ledger] = {
+            ledger.id: ledger
+            for ledger in Ledger.query().is_in('id', ledger_ids).get()
+        }
         accounts = {
-            identity.id: {}
-            for identity in self.identities
+            identity_id: {}
+            for identity_id in self.data['identity_ids'].split(',')
         }
-        for acct in self.accounts:
+        for acct in Account.query().equal('correspondence_id', self.id).get():
+            acct: Account
+            if acct.ledger_id not in ledgers:
+                continue
+            acct.ledger = ledgers[acct.ledger_id]
+            if acct.type in (AccountType.NOSTRO_ASSET, AccountType.VOSTRO_LIABILITY):
+                accounts[acct.ledger.identity_id][acct.type] = acct
+
+        equity_ids = [
+            i for i in (self.data.get('equity_account_ids', None) or '').split(',') if i
+        ]
+        if equity_ids:
+            equity = Account.query().is_in('id', equity_ids).get()
+        else:
+            equity = self._general_equity_query(ledger_ids).get()
+        for acct in equity:
             acct: Account
-            if acct.type is AccountType.NOSTRO_ASSET:
-                accounts[acct.ledger.identity_id][AccountType.NOSTRO_ASSET] = acct
-            if acct.type is AccountType.VOSTRO_LIABILITY:
-                accounts[acct.ledger.identity_id][AccountType.VOSTRO_LIABILITY] = acct
-        for ledger in self.ledgers:
-            ledger: Ledger
-            acct = ledger.accounts().query().equal(
-                type=AccountType.EQUITY.value
-            ).starts_with(name='General Equity').first()
-            if acct is not None:
-                accounts[ledger.identity_id][acct.type] = acct
+            if acct.ledger_id not in ledgers:
+                continue
+            acct.ledger = ledgers[acct.ledger_id]
+            accounts[acct.ledger.identity_id].setdefault(AccountType.EQUITY, acct)
 
+        if all([len(accts) == 3 for accts in accounts.values()]):
+            self._accounts = accounts
+            accounts = {k: {**v} for k, v in accounts.items()}
         return accounts
 
     def setup_accounts(
@@ -116,44 +174,173 @@ class Correspondence(HashedModel):
         """Takes a dict mapping Identity ID to tapescript locking
             scripts. Returns a dict of Accounts necessary for setting up
             the credit Correspondence of form
-            { identity.id: { AccountType: Account }}.
+            { identity.id: { AccountType: Account }}. For more than two
+            Identities, only the Accounts for the last counterparty of
+            each Identity are included; use `setup_many` to create the
+            Accounts for every pair. The IDs of the 'General Equity'
+            Accounts of the Ledgers are stored in equity_account_ids.
         """
-        accounts = {}
         self.identities().reload()
+        ledgers = {
+            ledger.identity_id: ledger
+            for ledger in Ledger.query().is_in(
+                'id', self.data['ledger_ids'].split(',')
+            ).get()
+        }
+        accounts = {}
         for identity1 in self.identities:
             identity1: Identity
             for identity2 in [i for i in self.identities if i.id != identity1.id]:
-                identity1.ledgers().reload()
-                ledger = [l for l in identity1.ledgers if l.id in self.ledger_ids][0]
                 identity2: Identity
-                nostro = Account({
-                    'name': f'Receivable from (Nostro with) {identity2.name} ({identity2.id})',
-                    'type': AccountType.NOSTRO_ASSET.value,
-                    'ledger_id': ledger.id,
-                    'correspondence_id': self.id,
-                })
-                nostro.details = identity2.id
-                nostro.locking_scripts = {
-                    EntryType.CREDIT: locking_scripts[identity1.id],
-                    EntryType.DEBIT: locking_scripts[identity2.id],
-                }
-                vostro = Account({
-                    'name': f'Payable to (Vostro for) {identity2.name} ({identity2.id})',
-                    'type': AccountType.VOSTRO_LIABILITY.value,
-                    'ledger_id': ledger.id,
-                    'correspondence_id': self.id,
-                })
-                vostro.details = identity2.id
-                vostro.locking_scripts = {
-                    EntryType.CREDIT: locking_scripts[identity1.id],
-                    EntryType.DEBIT: locking_scripts[identity2.id],
-                }
+                nostro, vostro = self._pair_accounts(
+                    self.id, identity1.id, identity2, ledgers[identity1.id],
+                    locking_scripts
+                )
                 accounts[identity1.id] = {
                     AccountType.NOSTRO_ASSET: nostro,
                     AccountType.VOSTRO_LIABILITY: vostro,
                 }
+
+        equity_ids = self._equity_account_ids([l.id for l in ledgers.values()])
+        if len(equity_ids) == len(ledgers):
+            equity_account_ids = ','.join(sorted(equity_ids.values()))
+            self.update({'equity_account_ids': equity_account_ids})
+            self.data['equity_account_ids'] = equity_account_ids
+        self.__dict__.pop('_accounts', None)
         return accounts
 
+    @staticmethod
+    def _pair_accounts(
+            correspondence_id: str, identity1_id: str, identity2: Identity,
+            ledger: Ledger, locking_scripts: dict[str, bytes]
+        ) -> tuple[Account, Account]:
+        """Returns the unsaved Nostro and Vostro Accounts on the Ledger
+            of the first Identity for its correspondence with the second.
+        """
+        nostro = Account({
+            'name': f'Receivable from (Nostro with) {identity2.name} ({identity2.id})',
+            'type': AccountType.NOSTRO_ASSET.value,
+            'ledger_id': ledger.id,
+            'correspondence_id': correspondence_id,
+        })
+        nostro.details = identity2.id
+        nostro.locking_scripts = {
+            EntryType.CREDIT: locking_scripts[identity1_id],
+            EntryType.DEBIT: locking_scripts[identity2.id],
+        }
+        vostro = Account({
+            'name': f'Payable to (Vostro for) {identity2.name} ({identity2.id})',
+            'type': AccountType.VOSTRO_LIABILITY.value,
+            'ledger_id': ledger.id,
+            'correspondence_id': correspondence_id,
+        })
+        vostro.details = identity2.id
+        vostro.locking_scripts = {
+            EntryType.CREDIT: locking_scripts[identity1_id],
+            EntryType.DEBIT: locking_scripts[identity2.id],
+        }
+        return nostro, vostro
+
+    @staticmethod
+    def _general_equity_query(ledger_ids: list[str]):
+        """Returns a query for the 'General Equity' Accounts of the
+            Ledgers.
+        """
+        return Account.query().is_in('ledger_id', ledger_ids).equal(
+            type=AccountType.EQUITY.value
+        ).starts_with(name='General Equity')
+
+    @classmethod
+    def _equity_account_ids(cls, ledger_ids: list[str]) -> dict[str, str]:
+        """Returns a dict mapping Ledger ID to the ID of its first
+            'General Equity' Account, querying the Ledgers in batches.
+        """
+        equity_ids = {}
+        for batch in _batches(ledger_ids):
+            for acct in cls._general_equity_query(batch).order_by('id').get():
+                equity_ids.setdefault(acct.ledger_id, acct.id)
+        return equity_ids
+
+    @classmethod
+    def setup_many(
+            cls, ledger_groups: list[list[Ledger]],
+            locking_scripts: dict[str, bytes], details: dict|None = None
+        ) -> list[Correspondence]:
+        """Onboards many Correspondences at once. Each group of Ledgers
+            (one per Identity) becomes a Correspondence whose details
+            contain the locking scripts of its Identities (and any other
+            details provided), with Nostro and Vostro Accounts for every
+            pair of its Identities. The Identities are loaded with one
+            query, and the Correspondences and Accounts are inserted in
+            a single database transaction; records that already exist
+            are skipped, so onboarding can be rerun. The IDs of the
+            'General Equity' Accounts are stored in equity_account_ids.
+            Returns the Correspondences. Raises TypeError or ValueError
+            for invalid arguments.
+        """
+        tert(type(ledger_groups) is list and all([
+                type(g) in (list, tuple) and all([type(l) is Ledger for l in g])
+                for g in ledger_groups
+            ]), 'ledger_groups must be list[list[Ledger]]')
+        tert(type(locking_scripts) is dict, 'locking_scripts must be dict[str, bytes]')
+        tert(details is None or type(details) is dict, 'details must be dict or None')
+        for group in ledger_groups:
+            identity_ids = [l.identity_id for l in group]
+            vert(len(set(identity_ids)) == len(group) > 1,
+                'each group must have Ledgers of at least 2 distinct Identities')
+            for identity_id in identity_ids:
+                vert(type(locking_scripts.get(identity_id, None)) is bytes,
+                    f'missing locking script for identity {identity_id}')
+
+        identity_ids = list(set([l.identity_id for g in ledger_groups for l in g]))
+        identities: dict[str, Identity] = {
+            identity.id: identity
+            for batch in _batches(identity_ids)
+            for identity in Identity.query().is_in('id', batch).get()
+        }
+        vert(len(identities) == len(identity_ids), 'all Identities must exist')
+
+        equity_ids = cls._equity_account_ids(
+            list(set([l.id for g in ledger_groups for l in g]))
+        )
+
+        correspondences: list[Correspondence] = []
+        accounts: list[Account] = []
+        for group in ledger_groups:
+            correspondence = cls({
+                'identity_ids': ','.join(sorted([l.identity_id for l in group])),
+                'ledger_ids': ','.join(sorted([l.id for l in group])),
+            })
+            correspondence.details = {
+                **(details or {}),
+                'locking_scripts': {
+                    l.identity_id: locking_scripts[l.identity_id] for l in group
+                },
+            }
+            if all([l.id in equity_ids for l in group]):
+                correspondence.data['equity_account_ids'] = ','.join(
+                    sorted([equity_ids[l.id] for l in group])
+                )
+            correspondence.id = cls.generate_id(correspondence.data)
+            correspondences.append(correspondence)
+            for ledger in group:
+                for other in [l for l in group if l.identity_id != ledger.identity_id]:
+                    accounts.extend(cls._pair_accounts(
+                        correspondence.id, ledger.identity_id,
+                        identities[other.identity_id], ledger, locking_scripts
+                    ))
+        for account in accounts:
+            account.id = Account.generate_id(account.data)
+
+        query = cls.query()
+        with query.context_manager(query.connection_info) as cursor:
+            for model, records in ((cls, correspondences), (Account, accounts)):
+                cursor.executemany(
+                    _insert_sql(model.table, model.columns, ignore=True),
+                    [tuple([r.data.get(c, None) for c in model.columns]) for r in records]
+                )
+        return correspondences
+
     def pay_correspondent(
             self, payer: Identity, payee: Identity, amount: int, txn_nonce: bytes
         ) -> tuple[list[Entry], list[Entry]]:
@@ -168,12 +355,22 @@ class Correspondence(HashedModel):
              f'payee ({payee.name}, {payee.id}) not in correspondence identities')
 
         accts = self.get_accounts()
-        payer_nostro_acct = accts[payer.id][AccountType.NOSTRO_ASSET]
-        payer_vostro_acct = accts[payer.id][AccountType.VOSTRO_LIABILITY]
-        payee_nostro_acct = accts[payee.id][AccountType.NOSTRO_ASSET]
-        payee_vostro_acct = accts[payee.id][AccountType.VOSTRO_LIABILITY]
-        payer_equity_acct = accts[payer.id][AccountType.EQUITY]
-        payee_equity_acct = accts[payee.id][AccountType.EQUITY]
+        return self._payment_entries(accts, payer.id, payee.id, amount, txn_nonce)
+
+    @staticmethod
+    def _payment_entries(
+            accts: dict[str, dict[AccountType, Account]], payer_id: str,
+            payee_id: str, amount: int, txn_nonce: bytes
+        ) -> tuple[list[Entry], list[Entry]]:
+        """Builds the two lists of entries of `pay_correspondent` from
+            the Accounts returned by `get_accounts`.
+        """
+        payer_nostro_acct = accts[payer_id][AccountType.NOSTRO_ASSET]
+        payer_vostro_acct = accts[payer_id][AccountType.VOSTRO_LIABILITY]
+        payee_nostro_acct = accts[payee_id][AccountType.NOSTRO_ASSET]
+        payee_vostro_acct = accts[payee_id][AccountType.VOSTRO_LIABILITY]
+        payer_equity_acct = accts[payer_id][AccountType.EQUITY]
+        payee_equity_acct = accts[payee_id][AccountType.EQUITY]
 
         payer_equity_entry = Entry({
             'nonce': txn_nonce,
@@ -224,25 +421,73 @@ class Correspondence(HashedModel):
             [payer_equity_entry, payee_equity_entry, payer_vostro_entry, payee_nostro_entry],
         )
 
+    def settle_payments(
+            self, payments: list[tuple[str, str, int]], txn_nonce: bytes
+        ) -> list[tuple[list[Entry], list[Entry], dict[str, bytes]]]:
+        """Nets a batch of (payer ID, payee ID, amount) payments between
+            the correspondents and prepares the entries for one payment
+            of the net amount per pair of Identities, using a single
+            Account lookup. Returns a list of tuples of the two lists of
+            entries (as in `pay_correspondent`) and the Transaction
+            details committing to the full payment list: the Merkle
+            root of the payments (see `bookchain.netting`) and the
+            number of payments. Raises TypeError or ValueError for
+            invalid payments.
+        """
+        validate_payments(payments)
+        identity_ids = self.identity_ids.split(',')
+        vert(all([p[0] in identity_ids and p[1] in identity_ids for p in payments]),
+            'all payers and payees must be correspondence identities')
+        details = {
+            'payments_root': payments_root(payments),
+            'payments_count': len(payments).to_bytes(8, 'big'),
+        }
+        nets = net_payments(payments)
+        if len(nets) == 0:
+            return []
+        accts = self.get_accounts()
+        return [
+            (
+                *self._payment_entries(accts, payer_id, payee_id, amount, txn_nonce),
+                {**details},
+            )
+            for payer_id, payee_id, amount in nets
+        ]
+
     def balances(
-            self, rolled_up_balances: dict[str, tuple[EntryType, int]] = {}
+            self, rolled_up_balances: dict[str, tuple[EntryType, int]]|None = None
         ) -> dict[str, int]:
         """Returns the balances of the correspondents as a dict mapping
             str Identity ID to signed int (equal to Nostro - Vostro).
+            Unless rolled_up_balances is passed, the balances of the
+            most recent trimmed TxRollups of the chains of the
+            Correspondence and its Ledgers are used as the starting
+            balances. The Nostro and Vostro Accounts (and their
+            sub-accounts) are tallied with a single grouped aggregate
+            query over the entries.
         """
-        accts = self.get_accounts()
-        accts = [a for accts in accts.values() for a in accts.values()]
+        if rolled_up_balances is None:
+            rolled_up_balances = TxRollupHead.get_rolled_up_balances(
+                self.id, *self.data['ledger_ids'].split(',')
+            )
+        query = Account.query()
+        with query.context_manager(query.connection_info) as cursor:
+            cursor.execute(_balances_sql, (
+                self.id, AccountType.NOSTRO_ASSET.value,
+                AccountType.VOSTRO_LIABILITY.value,
+            ))
+            rows = cursor.fetchall()
+
+        # Nostro - Vostro equals debits - credits across both accounts
         balances = {}
-        for acct in accts:
-            acct.ledger().reload()
-            if acct.ledger.identity_id not in balances:
-                balances[acct.ledger.identity_id] = 0
-            if acct.type is AccountType.NOSTRO_ASSET:
-                balances[acct.ledger.identity_id] += acct.balance(
-                    rolled_up_balances=rolled_up_balances
-                )
-            if acct.type is AccountType.VOSTRO_LIABILITY:
-                balances[acct.ledger.identity_id] -= acct.balance(
-                    rolled_up_balances=rolled_up_balances
-                )
+        for acct_id, identity_id, entry_type, amount in rows:
+            balances[identity_id] = balances.get(identity_id, 0)
+            if entry_type is not None:
+                amount = amount if entry_type == EntryType.DEBIT.value else -amount
+                balances[identity_id] += amount
+        for acct_id, identity_id in set([(r[0], r[1]) for r in rows]):
+            if acct_id in rolled_up_balances:
+                entry_type, amount = rolled_up_balances[acct_id]
+                amount = amount if entry_type is EntryType.DEBIT else -amount
+                balances[identity_id] += amount
         return balances
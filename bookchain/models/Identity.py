@@ -1,5 +1,7 @@
 from __future__ import annotations
 from .Account import Account, AccountType
+from .Ledger import Ledger
+from bookchain.helpers import _batches
 from sqloquent import HashedModel, RelatedCollection
 import packify
 
@@ -42,18 +44,76 @@ class Identity(HashedModel):
         }
 
     def correspondents(self, reload: bool = False) -> list[Identity]:
-        """Get the correspondents for this Identity."""
+        """Get the correspondents for this Identity. The counterparty
+            Identities of all the Correspondences are loaded with a
+            single (batched) query.
+        """
         if reload:
             self.correspondences().reload()
 
-        correspondents = []
-        for correspondence in self.correspondences:
-            if reload:
-                correspondence.identities().reload()
-            for identity in correspondence.identities:
-                if identity.id != self.id:
-                    correspondents.append(identity)
-        return correspondents
+        ids = [
+            identity_id
+            for correspondence in self.correspondences
+            for identity_id in correspondence.identity_ids.split(',')
+            if identity_id != self.id
+        ]
+        identities = {
+            identity.id: identity
+            for batch in _batches(list(set(ids)))
+            for identity in Identity.query().is_in('id', batch).get()
+        }
+        return [identities[i] for i in ids if i in identities]
+
+    def load_correspondents(
+            self, reload: bool = False
+        ) -> dict[str, tuple[Identity, list[Account]]]:
+        """Eagerly loads the counterparty Identities of all the
+            Correspondences of this Identity and the Nostro and Vostro
+            Accounts of each relationship (on both sides) with a
+            constant number of (batched) queries. Returns a dict mapping
+            counterparty Identity ID to a tuple of the Identity and the
+            list of Accounts.
+        """
+        if reload:
+            self.correspondences().reload()
+
+        correspondence_ids = [c.id for c in self.correspondences]
+        ledger_ids = list(set([
+            ledger_id
+            for correspondence in self.correspondences
+            for ledger_id in correspondence.ledger_ids.split(',')
+        ]))
+        identities = self.correspondents()
+        ledgers: dict[str, str] = {
+            ledger.id: ledger.identity_id
+            for batch in _batches(ledger_ids)
+            for ledger in Ledger.query().is_in('id', batch).get()
+        }
+        accounts: list[Account] = [
+            account
+            for batch in _batches(correspondence_ids)
+            for account in Account.query().is_in('correspondence_id', batch).is_in(
+                'type', [AccountType.NOSTRO_ASSET.value, AccountType.VOSTRO_LIABILITY.value]
+            ).get()
+        ]
+        return self._group_correspondent_accounts(identities, ledgers, accounts)
+
+    def _group_correspondent_accounts(
+            self, identities: list[Identity], ledgers: dict[str, str],
+            accounts: list[Account]
+        ) -> dict[str, tuple[Identity, list[Account]]]:
+        """Groups the Nostro and Vostro Accounts by counterparty using
+            the map of Ledger ID to owner Identity ID.
+        """
+        result = {identity.id: (identity, []) for identity in identities}
+        for account in accounts:
+            owner_id = ledgers.get(account.ledger_id, None)
+            counterparty_id = account.details
+            if owner_id == self.id and counterparty_id in result:
+                result[counterparty_id][1].append(account)
+            elif counterparty_id == self.id and owner_id in result:
+                result[owner_id][1].append(account)
+        return result
 
     def get_correspondent_accounts(
             self, correspondent: Identity, reload: bool = False
@@ -6,7 +6,7 @@ from .Entry import Entry, EntryType
 from .Identity import Identity
 from ..helpers import parse_timestamp
 from bookchain.enums import AccountType
-from sqloquent import HashedModel, RelatedCollection
+from sqloquent import HashedModel, RelatedCollection, RelatedModel
 from sqloquent.errors import vert, tert
 import packify
 
@@ -19,16 +19,18 @@ class Transaction(HashedModel):
         recorded on the Ledgers of the Identities that are party to the
         Transaction. Any Entry for an Account that has a locking_script
         will require a valid tapscript unlocking script to be recorded
-        in the auth_scripts dict of the Transaction.
+        in the auth_scripts dict of the Transaction. The rollup_id is
+        set when the Transaction is committed to a saved TxRollup; it is
+        not hashed, and Transactions without one are pending.
     """
     connection_info: str = ''
     table: str = 'transactions'
     id_column: str = 'id'
     columns: tuple[str] = (
         'id', 'entry_ids', 'ledger_ids', 'timestamp', 'details', 'auth_scripts',
-        'description',
+        'description', 'rollup_id',
     )
-    columns_excluded_from_hash: tuple[str] = ('auth_scripts', 'description',)
+    columns_excluded_from_hash: tuple[str] = ('auth_scripts', 'description', 'rollup_id',)
     id: str
     entry_ids: str
     ledger_ids: str
@@ -36,9 +38,11 @@ class Transaction(HashedModel):
     details: bytes
     auth_scripts: bytes
     description: str|None
+    rollup_id: str|None
     entries: RelatedCollection
     ledgers: RelatedCollection
     rollups: RelatedCollection
+    rollup: RelatedModel
 
     # override automatic properties
     @property
@@ -276,8 +280,9 @@ class Transaction(HashedModel):
         """Archive the Transaction. If it has already been archived,
             return the existing ArchivedTransaction.
         """
-        archived_txn_id = ArchivedTransaction.generate_id({**self.data})
+        data = {c: self.data.get(c, None) for c in ArchivedTransaction.columns}
+        archived_txn_id = ArchivedTransaction.generate_id({**data})
         try:
-            return ArchivedTransaction.insert({**self.data})
+            return ArchivedTransaction.insert(data)
         except Exception as e:
             return ArchivedTransaction.find(archived_txn_id)
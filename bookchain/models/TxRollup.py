@@ -3,7 +3,29 @@ from .Correspondence import Correspondence
 from .Entry import Entry, ArchivedEntry
 from .Ledger import Ledger
 from .Transaction import Transaction, ArchivedTransaction
+from .TrimmedRecord import TrimmedRecord
+from .TxRollupHead import TxRollupHead
 from bookchain.enums import EntryType
+from bookchain.helpers import _batches, _insert_sql
+from bookchain.merkle import (
+    calculate_balance_root,
+    mmr_append,
+    mmr_mountain,
+    mmr_peaks,
+    mmr_root,
+    prove_balance,
+    prove_mmr_inclusion,
+    verify_balance_proof,
+    verify_mmr_inclusion,
+)
+from bookchain.mirror import (
+    decode_headers,
+    decode_request,
+    encode_headers,
+    encode_request,
+)
+from bookchain.segments import ArchiveSegment, SegmentWriter
+from concurrent.futures import ProcessPoolExecutor
 from merkleasy import Tree
 from sqloquent import (
     DeletedModel,
@@ -14,11 +36,45 @@ from sqloquent import (
 )
 from sqloquent.errors import tert, vert
 from time import time
+from typing import Any, Generator
+import os
 import packify
 import tapescript
 
 
 _empty_dict = packify.pack({})
+_delta_marker = 'delta'
+
+
+def _calculate_tx_root(tx_ids: list[str]) -> str:
+    """Calculates the Merkle root of the sorted transaction IDs."""
+    leaves = [bytes.fromhex(txn_id) for txn_id in sorted(tx_ids)]
+    while len(leaves) < 2:
+        leaves = [b'\x00'*32, *leaves]
+    return Tree.from_leaves(leaves).root.hex()
+
+def _verify_rollups(
+        rollups: list[dict], txru_lock: bytes|None = None
+    ) -> int|None:
+    """Verifies the IDs, tx_roots, and auth scripts of a batch of
+        TxRollup data dicts without touching the database. Returns the
+        height of the first invalid TxRollup or None if all are valid.
+        Used by `TxRollup.verify_chain` in worker processes.
+    """
+    for data in rollups:
+        if TxRollup.generate_id({**data}) != data['id']:
+            return data['height']
+        tx_ids = [i for i in (data.get('tx_ids', None) or '').split(',') if i]
+        if data.get('tx_ids', None) is not None:
+            if _calculate_tx_root(tx_ids) != data['tx_root']:
+                return data['height']
+        if data.get('auth_script', None) is not None and txru_lock is not None:
+            if not tapescript.run_auth_scripts(
+                [data['auth_script'], txru_lock],
+                {'sigfield1': bytes.fromhex(data['id'])}
+            ):
+                return data['height']
+    return None
 
 
 class TxRollup(HashedModel):
@@ -41,14 +97,24 @@ class TxRollup(HashedModel):
         Transaction can only be proven using the Merkle tree of the
         TxRollup in which it was committed and only if the full list of
         tx_ids is saved, but the proof can be verified by mirrors that
-        have only the tx_root.
+        have only the tx_root. Optionally, a TxRollup can store only the
+        balance changes of its own Transactions (delta-encoded) with a
+        full snapshot of balances every `snapshot_interval` heights;
+        the ID commits to whichever is stored, and the cumulative
+        balances at any height are committed to transitively through
+        the parent_id links back to the nearest snapshot. A TxRollup can
+        also commit to a balance_root: the root of a sparse Merkle tree
+        of its cumulative balances keyed by account ID, which allows
+        mirrors to verify the balance of a single account with a proof
+        of about log2(n) hashes.
     """
     connection_info: str = ''
     table: str = 'txn_rollups'
     id_column: str = 'id'
     columns: tuple[str] = (
         'id', 'height', 'parent_id', 'tx_ids', 'tx_root', 'correspondence_id',
-        'ledger_id', 'balances', 'timestamp', 'auth_script', 'description'
+        'ledger_id', 'balances', 'timestamp', 'auth_script', 'description',
+        'balance_root',
     )
     columns_excluded_from_hash: tuple[str] = ('tx_ids', 'auth_script', 'description')
     id: str
@@ -62,12 +128,27 @@ class TxRollup(HashedModel):
     timestamp: str
     auth_script: bytes|None
     description: str|None
+    balance_root: str|None
     correspondence: RelatedModel
     ledger: RelatedModel
     transactions: RelatedCollection
     parent: RelatedModel
     child: RelatedModel
 
+    @classmethod
+    def preimage(cls, data: dict) -> bytes:
+        """Get the preimage of the sha256 id. The balance_root is left
+            out of the preimage when it is not set so that TxRollups
+            without a balance_root keep the IDs they had before the
+            column was added.
+        """
+        preimage = super().preimage(data)
+        if data.get('balance_root', None) is not None:
+            return preimage
+        preimage: dict = packify.unpack(preimage)
+        preimage.pop('balance_root', None)
+        return packify.pack(preimage)
+
     def public(self) -> dict:
         """Returns the public data for mirroring this TxRollup. Excludes
             the tx_ids.
@@ -81,9 +162,11 @@ class TxRollup(HashedModel):
     def tx_ids(self) -> list[str]:
         """A list of transaction IDs. Setting causes the ids to be
             sorted, then combined into a Merkle Tree, the root of which
-            is used to set `self.tx_root`.
+            is used to set `self.tx_root`. Empty for TxRollups imported
+            from mirrored headers, which do not contain the tx_ids.
         """
-        return self.data.get('tx_ids', '').split(',')
+        tx_ids = self.data.get('tx_ids', None)
+        return tx_ids.split(',') if tx_ids else []
     @tx_ids.setter
     def tx_ids(self, val: list[str]):
         if type(val) is not list:
@@ -91,17 +174,36 @@ class TxRollup(HashedModel):
         # sort the ids, join into a comma-separated string
         val.sort()
         self.data['tx_ids'] = ','.join(val)
-        # convert to bytes and build a merkle tree
-        val = [bytes.fromhex(txn_id) for txn_id in val]
-        while len(val) < 2:
-            val = [b'\x00'*32, *val]
-        tree = Tree.from_leaves(val)
-        self.data['tx_root'] = tree.root.hex()
+        self.data['tx_root'] = _calculate_tx_root(val)
+
+    @property
+    def is_mirror(self) -> bool:
+        """True if this TxRollup was imported from a mirrored header
+            (see `import_headers`), which does not contain the tx_ids,
+            so its Transactions are not available locally.
+        """
+        return self.id is not None and self.data.get('tx_ids', None) is None
+
+    @property
+    def is_delta(self) -> bool:
+        """True if the balances are delta-encoded, i.e. they contain only
+            the balance changes from the Transactions of this TxRollup
+            rather than a full snapshot of the balances.
+        """
+        balances = packify.unpack(self.data.get('balances', None) or _empty_dict)
+        return type(balances) is tuple and balances[0] == _delta_marker
 
     @property
     def balances(self) -> dict[str, tuple[EntryType, int]]:
-        """A dict mapping account IDs to tuple[EntryType, int] balances."""
-        balances: dict = packify.unpack(self.data.get('balances', _empty_dict))
+        """A dict mapping account IDs to tuple[EntryType, int] balances.
+            For delta-encoded TxRollups, these are only the balance
+            changes from the Transactions of this TxRollup; use
+            `resolve_balances` to get the cumulative balances. Setting
+            stores a full snapshot; use `balance_deltas` to store deltas.
+        """
+        balances = packify.unpack(self.data.get('balances', None) or _empty_dict)
+        if type(balances) is tuple:
+            balances = balances[1]
         return {
             k: (EntryType(v[0]), v[1])
             for k, v in balances.items()
@@ -124,10 +226,39 @@ class TxRollup(HashedModel):
         }
         self.data['balances'] = packify.pack(val)
 
+    @property
+    def balance_deltas(self) -> dict[str, tuple[EntryType, int]]:
+        """A dict mapping account IDs to the tuple[EntryType, int]
+            balance changes from the Transactions of this TxRollup.
+            Setting stores the balances delta-encoded. Raises ValueError
+            when read from a TxRollup that is not delta-encoded.
+        """
+        vert(self.is_delta, 'TxRollup balances are not delta-encoded')
+        return self.balances
+    @balance_deltas.setter
+    def balance_deltas(self, val: dict[str, tuple[EntryType, int]]):
+        self.balances = val
+        self.data['balances'] = packify.pack(
+            (_delta_marker, packify.unpack(self.data['balances']))
+        )
+
+    def get_sigfields(self) -> dict[str, bytes]:
+        """Returns the sigfields for signing and verifying the
+            auth_script of the tx rollup: the ID as sigfield1. The
+            auth_script is excluded from the ID, so it does not change
+            when the tx rollup is signed.
+        """
+        return {'sigfield1': bytes.fromhex(self.id or self.generate_id(self.data))}
+
     @property
     def tree(self) -> Tree:
-        """A merkle tree of the transaction IDs."""
-        return Tree.from_leaves([bytes.fromhex(txn_id) for txn_id in self.tx_ids])
+        """A merkle tree of the transaction IDs, padded with null leaves
+            like the tx_root when there are fewer than 2.
+        """
+        leaves = [bytes.fromhex(txn_id) for txn_id in self.tx_ids if txn_id]
+        while len(leaves) < 2:
+            leaves = [b'\x00'*32, *leaves]
+        return Tree.from_leaves(leaves)
 
     def prove_txn_inclusion(self, txn_id: str|bytes) -> bytes:
         """Proves that a transaction is included in the tx rollup."""
@@ -139,6 +270,27 @@ class TxRollup(HashedModel):
         txn_id = bytes.fromhex(txn_id) if type(txn_id) is str else txn_id
         return Tree.verify(bytes.fromhex(self.tx_root), txn_id, proof)
 
+    def prove_balance(self, account_id: str) -> bytes:
+        """Proves the cumulative balance of an account against the
+            balance_root of the tx rollup. Raises ValueError if the tx
+            rollup has no balance_root or the account has no balance.
+        """
+        vert(self.balance_root is not None, 'tx rollup has no balance_root')
+        return prove_balance(self.resolve_balances(), account_id)
+
+    @classmethod
+    def verify_balance_proof(
+            cls, root: str|bytes, account_id: str,
+            balance: tuple[EntryType, int], proof: bytes
+        ) -> bool:
+        """Verifies that the balance of an account is committed to in
+            a balance_root. Raises TypeError for invalid balance.
+        """
+        tert(type(balance) is tuple and len(balance) == 2 and
+            type(balance[0]) is EntryType and type(balance[1]) is int,
+            'balance must be a tuple[EntryType, int]')
+        return verify_balance_proof(root, account_id, balance, proof)
+
     @classmethod
     def calculate_balances(
         cls, txns: list[Transaction],
@@ -171,7 +323,9 @@ class TxRollup(HashedModel):
     @classmethod
     def prepare(cls, txns: list[Transaction], parent_id: str|None = None,
                 correspondence: Correspondence|None = None,
-                ledger: Ledger|None = None, reload: bool = False
+                ledger: Ledger|None = None, reload: bool = False,
+                snapshot_interval: int|None = None,
+                include_balance_root: bool = False
                 ) -> TxRollup:
         """Prepare a tx rollup by checking that all txns are for the
             accounts of the given correspondence or belong to the same
@@ -184,8 +338,16 @@ class TxRollup(HashedModel):
             a TxRollup chain already exists for the given ledger or
             correspondence when no parent is provided. The Transaction
             IDs are sorted and combined into a Merkle Tree, the root of
-            which is used to set the `tx_root` property.
+            which is used to set the `tx_root` property. If
+            snapshot_interval is provided, the balances are stored
+            delta-encoded except at heights that are a multiple of
+            snapshot_interval, at which a full snapshot is stored. If
+            include_balance_root is True, the root of the sparse Merkle
+            tree of the cumulative balances is set as the balance_root.
         """
+        tert(snapshot_interval is None or
+            (type(snapshot_interval) is int and snapshot_interval > 0),
+            'snapshot_interval must be a positive int or None')
         tert(all([type(t) is Transaction for t in txns]),
             'txns must be a list of Transaction objects')
         tert(type(correspondence) is Correspondence or correspondence is None,
@@ -232,23 +394,29 @@ class TxRollup(HashedModel):
             # if there is a parent, get its balances and set the height
             parent: TxRollup|None = TxRollup.find(parent_id)
             vert(parent is not None, 'parent must exist')
-            balances = parent.balances
             txru.height = parent.height + 1
-            vert(parent.child().query().count() == 0, 'parent already has a child')
+            if snapshot_interval is None or txru.height % snapshot_interval == 0:
+                balances = parent.resolve_balances()
+            # only the head of the chain can be a parent
+            head = cls._head_record(*parent._scope())
+            vert(head is None or head.rollup_id == parent.id, 'parent already has a child')
         else:
             # if there is no parent, ensure there is no other chain
             if ledger is not None:
-                vert(TxRollup.query().equal('ledger_id', ledger.id).count() == 0,
+                vert(cls._head_record(ledger.id, 'ledger_id') is None,
                     'the given ledger already has a TxRollup chain')
             elif correspondence is not None:
-                vert(TxRollup.query().equal('correspondence_id', correspondence.id).count() == 0,
+                vert(cls._head_record(correspondence.id, 'correspondence_id') is None,
                     'the given correspondence already has a TxRollup chain')
 
         # aggregate balances from txn entries
         balances = cls.calculate_balances(txns, balances, reload=reload)
 
         txru.parent_id = parent_id
-        txru.balances = balances
+        if snapshot_interval is None or txru.height % snapshot_interval == 0:
+            txru.balances = balances
+        else:
+            txru.balance_deltas = balances
         txru.timestamp = str(time())
         if correspondence is not None:
             txru.correspondence_id = correspondence.id
@@ -256,6 +424,8 @@ class TxRollup(HashedModel):
             if len(txns) > 0 and ledger is None:
                 ledger: Ledger = txns[0].entries[0].account.ledger
             txru.ledger_id = ledger.id
+        if include_balance_root:
+            txru.balance_root = calculate_balance_root(txru.resolve_balances())
         return txru
 
     def validate(self, reload: bool = False) -> bool:
@@ -263,7 +433,8 @@ class TxRollup(HashedModel):
             the balances are correct; and that the height is 1 + the
             height of the parent tx rollup (if one exists); and that
             there is no other chain for the relevant ledger or
-            correspondence when no parent is provided.
+            correspondence when no parent is provided; and that the
+            balance_root (if one is set) matches the balances.
         """
         authorized = True
         balances = {}
@@ -273,37 +444,34 @@ class TxRollup(HashedModel):
         if self.parent_id is not None:
             parent: TxRollup|None = TxRollup.find(self.parent_id)
             vert(parent is not None, 'parent must exist')
-            balances = parent.balances
-            parent.child().reload()
+            if not self.is_delta:
+                balances = parent.resolve_balances()
             self_id = self.id or self.generate_id(self.data)
-            if parent.child.id is not None:
-                if parent.child.id != self_id:
-                    return False
+            head = TxRollup._head_record(*parent._scope())
+            if head is None or head.rollup_id not in (parent.id, self_id):
+                # the parent has a child, which must be this TxRollup
+                parent.child().reload()
+                if parent.child.id is not None:
+                    if parent.child.id != self_id:
+                        return False
 
         if self.correspondence_id is not None:
             correspondence: Correspondence = Correspondence.find(self.correspondence_id)
-            correspondence.identities().reload()
             # either the txru_lock has been set and fulfilled, or both
-            # identities have signed independently
-            txru_lock = correspondence.txru_lock
-            if txru_lock is None:
-                pubkeys = [identity.pubkey for identity in correspondence.identities]
-                # if not all identities have a pubkey and the txru_lock
-                # is not set, then the txru is authorized by default
-                if not all([len(pk) > 0 for pk in pubkeys]):
-                    authorized = True
-                else:
-                    txru_lock = tapescript.make_multisig_lock(pubkeys, len(pubkeys)).bytes
+            # identities have signed independently; if not all identities
+            # have a pubkey and the txru_lock is not set, then the txru is
+            # authorized by default
+            txru_lock = correspondence.get_txru_lock(reload=True)
 
             if self.auth_script is not None and txru_lock is not None:
                 authorized = tapescript.run_auth_scripts(
                     [self.auth_script, txru_lock],
-                    {'sigfield1': self.id}
+                    self.get_sigfields()
                 )
 
         # validate the height
         if parent is None:
-            if self.height != 0:
+            if self.height != 0 or self.is_delta:
                 return False
         else:
             if parent.height + 1 != self.height:
@@ -312,72 +480,681 @@ class TxRollup(HashedModel):
         # ensure there is no other chain
         if parent is None:
             self_id = self.id or self.generate_id(self.data)
-            if self.correspondence_id is not None:
-                if TxRollup.query().equal(
-                    'correspondence_id',
-                    self.correspondence_id
-                ).not_equal('id', self_id).count() > 0:
-                    return False
-            elif self.ledger_id is not None:
-                if TxRollup.query().equal(
-                    'ledger_id',
-                    self.ledger_id
-                ).not_equal('id', self_id).count() > 0:
-                    return False
-            elif len(self.tx_ids) > 0:
+            scope_id, scope_column = self._scope()
+            if scope_id is None and len(self.tx_ids) > 0:
                 txn = Transaction.find(self.tx_ids[0])
                 if txn is not None:
                     txn.entries().reload()
                     if len(txn.entries) > 0:
                         txn.entries[0].account().reload()
-                        ledger_id = txn.entries[0].account.ledger_id
-                        if TxRollup.query().equal(
-                            'ledger_id',
-                            ledger_id
-                        ).not_equal('id', self_id).count() > 0:
-                            return False
-
-        # recalculate the balances
-        balances = self.calculate_balances(self.transactions, balances, reload=reload)
-
-        # compare the recalculated balances to the stored balances
-        for acct_id, (entry_type, amount) in balances.items():
-            if acct_id not in self.balances:
-                return False
-            if self.balances[acct_id][0] != entry_type:
-                return False
-            if self.balances[acct_id][1] != amount:
+                        scope_id = txn.entries[0].account.ledger_id
+            if scope_id is not None:
+                head = TxRollup._head_record(scope_id, scope_column)
+                if head is not None and head.rollup_id != self_id:
+                    # the existing chain must have been started by this TxRollup
+                    if TxRollup.query().equal(scope_column, scope_id).equal(
+                        'height', 0
+                    ).not_equal('id', self_id).count() > 0:
+                        return False
+
+        # recalculate the balances and compare them to the stored
+        # balances; mirrored TxRollups do not have their Transactions
+        if not self.is_mirror:
+            balances = self.calculate_balances(self.transactions, balances, reload=reload)
+            for acct_id, (entry_type, amount) in balances.items():
+                if acct_id not in self.balances:
+                    return False
+                if self.balances[acct_id][0] != entry_type:
+                    return False
+                if self.balances[acct_id][1] != amount:
+                    return False
+
+        # compare the balance_root to the cumulative balances
+        if self.balance_root is not None:
+            balances = self.resolve_balances()
+            if calculate_balance_root(balances) != self.balance_root:
                 return False
 
         return authorized
 
-    def trim(self, archive: bool = True) -> int:
+    def resolve_balances(self) -> dict[str, tuple[EntryType, int]]:
+        """Returns the cumulative balances at the height of this
+            TxRollup. For delta-encoded TxRollups, the balance deltas
+            are applied to the balances of the nearest snapshot in the
+            chain, loading the ancestors in batches of 64.
+            Raises ValueError if the chain is broken.
+        """
+        if not self.is_delta:
+            return self.balances
+
+        deltas = [self.balances]
+        parent_id = self.parent_id
+        scope_id, scope_column = self._scope()
+        snapshot = None
+        query = TxRollup.query().equal(scope_column, scope_id).less(
+            'height', self.height
+        ).order_by('height', 'desc')
+        offset = 0
+        while snapshot is None:
+            ancestors = query.skip(offset).take(64)
+            vert(len(ancestors) > 0, 'TxRollup chain is broken')
+            for txru in ancestors:
+                txru: TxRollup
+                vert(txru.id == parent_id, 'TxRollup chain is broken')
+                if not txru.is_delta:
+                    snapshot = txru.balances
+                    break
+                deltas.append(txru.balances)
+                parent_id = txru.parent_id
+            offset += 64
+
+        # apply the deltas in ascending order of height
+        net_credits: dict[str, int] = {}
+        for balances in [snapshot, *reversed(deltas)]:
+            for acct_id, (entry_type, amount) in balances.items():
+                if entry_type is EntryType.DEBIT:
+                    amount = -amount
+                net_credits[acct_id] = net_credits.get(acct_id, 0) + amount
+        return {
+            acct_id: (EntryType.CREDIT, net) if net >= 0 else (EntryType.DEBIT, -net)
+            for acct_id, net in net_credits.items()
+        }
+
+    def _scope(self) -> tuple[str|None, str]:
+        """Returns the ID of the Correspondence or Ledger whose chain
+            this TxRollup belongs to and the name of the column in which
+            it is stored.
+        """
+        if self.correspondence_id is not None:
+            return (self.correspondence_id, 'correspondence_id')
+        return (self.ledger_id, 'ledger_id')
+
+    @classmethod
+    def _head_record(cls, scope_id: str|None, scope_column: str) -> TxRollupHead|None:
+        """Returns the TxRollupHead for the chain of the given Ledger or
+            Correspondence ID. If a chain exists without a TxRollupHead
+            (e.g. one created before TxRollupHeads were introduced), the
+            TxRollupHead is created from its highest TxRollup.
+        """
+        if scope_id is None:
+            return None
+        head = TxRollupHead.find(scope_id)
+        if head is not None:
+            return head
+        txru: TxRollup|None = cls.query().equal(scope_column, scope_id).order_by(
+            'height', 'desc'
+        ).first()
+        if txru is None:
+            return None
+        return txru._update_head()
+
+    def _update_head(self) -> TxRollupHead|None:
+        """Creates the TxRollupHead for this TxRollup's chain or advances
+            it to this TxRollup if this TxRollup is higher than the
+            current head.
+        """
+        scope_id, _ = self._scope()
+        if scope_id is None:
+            return None
+        head: TxRollupHead|None = TxRollupHead.find(scope_id)
+        if head is None:
+            ledger_ids = self.ledger_id
+            if self.correspondence_id is not None:
+                correspondence = Correspondence.find(self.correspondence_id)
+                ledger_ids = correspondence.data['ledger_ids'] if correspondence else ''
+            return TxRollupHead.insert({
+                'id': scope_id,
+                'rollup_id': self.id,
+                'height': self.height,
+                'ledger_ids': ledger_ids,
+                'mmr_peaks': self._chain_peaks(None),
+            })
+        if self.height > head.height:
+            head.update({
+                'rollup_id': self.id,
+                'height': self.height,
+                'mmr_peaks': self._chain_peaks(head),
+            })
+        return head
+
+    def _chain_peaks(self, head: TxRollupHead|None) -> bytes|None:
+        """Returns the packed peaks of the Merkle Mountain Range of the
+            TxRollup IDs of the chain up to this TxRollup. If this
+            TxRollup is the child of the head, it is appended to the
+            peaks of the head; otherwise, the peaks are recalculated
+            from the chain. Returns None if the chain is broken.
+        """
+        if head is not None and head.mmr_peaks is not None and \
+            self.height == head.height + 1 and self.parent_id == head.rollup_id:
+            return packify.pack(
+                mmr_append(packify.unpack(head.mmr_peaks), head.height + 1, self.id)
+            )
+        scope_id, scope_column = self._scope()
+        rollups = TxRollup.query().equal(scope_column, scope_id).less_or_equal(
+            'height', self.height
+        ).order_by('height', 'asc').get()
+        if [r.height for r in rollups] != list(range(self.height + 1)):
+            return None
+        return packify.pack(mmr_peaks([r.id for r in rollups]))
+
+    @classmethod
+    def _chain_mmr(
+            cls, scope_id: str|None, scope_column: str
+        ) -> tuple[list[bytes], int]:
+        """Returns the peaks and size of the Merkle Mountain Range of
+            the chain of the given Ledger or Correspondence ID,
+            calculating them if the TxRollupHead predates them. Raises
+            ValueError if there is no chain or the chain is broken.
+        """
+        head = cls._head_record(scope_id, scope_column)
+        vert(head is not None, 'no TxRollup chain found')
+        if head.mmr_peaks is None:
+            txru = cls.find(head.rollup_id)
+            vert(txru is not None, 'TxRollup chain is broken')
+            head.update({'mmr_peaks': txru._chain_peaks(None)})
+        vert(head.mmr_peaks is not None, 'TxRollup chain is broken')
+        return (packify.unpack(head.mmr_peaks), head.height + 1)
+
+    @classmethod
+    def head_for(
+            cls, ledger_or_correspondence: Ledger|Correspondence
+        ) -> TxRollup|None:
+        """Returns the most recent TxRollup in the chain of the given
+            Ledger or Correspondence using its TxRollupHead, or None if
+            there is no chain. Raises TypeError for invalid argument.
+        """
+        tert(type(ledger_or_correspondence) in (Ledger, Correspondence),
+            'ledger_or_correspondence must be a Ledger or Correspondence')
+        scope_column = 'ledger_id'
+        if type(ledger_or_correspondence) is Correspondence:
+            scope_column = 'correspondence_id'
+        head = cls._head_record(ledger_or_correspondence.id, scope_column)
+        if head is None:
+            return None
+        return cls.find(head.rollup_id)
+
+    @classmethod
+    def chain_root(
+            cls, ledger_or_correspondence: Ledger|Correspondence
+        ) -> str|None:
+        """Returns the root of the Merkle Mountain Range of the IDs of
+            the TxRollups in the chain of the given Ledger or
+            Correspondence, or None if there is no chain. Raises
+            TypeError for invalid argument or ValueError if the chain
+            is broken.
+        """
+        tert(type(ledger_or_correspondence) in (Ledger, Correspondence),
+            'ledger_or_correspondence must be a Ledger or Correspondence')
+        scope_column = 'ledger_id'
+        if type(ledger_or_correspondence) is Correspondence:
+            scope_column = 'correspondence_id'
+        if cls._head_record(ledger_or_correspondence.id, scope_column) is None:
+            return None
+        peaks, size = cls._chain_mmr(ledger_or_correspondence.id, scope_column)
+        return mmr_root(peaks, size)
+
+    @classmethod
+    def prove_rollup_in_chain(cls, rollup_id: str) -> bytes:
+        """Proves that the TxRollup with the given ID is part of its
+            chain against the current `chain_root`. The proof contains
+            about log2(n) hashes, and only the TxRollups in the same
+            mountain of the Merkle Mountain Range are loaded. Raises
+            ValueError if the TxRollup does not exist or the chain is
+            broken.
+        """
+        txru: TxRollup|None = cls.find(rollup_id)
+        vert(txru is not None, 'TxRollup not found')
+        scope_id, scope_column = txru._scope()
+        peaks, size = cls._chain_mmr(scope_id, scope_column)
+        start, count = mmr_mountain(size, txru.height)
+        mountain = cls.query().equal(scope_column, scope_id).greater_or_equal(
+            'height', start
+        ).less('height', start + count).order_by('height', 'asc').get()
+        return prove_mmr_inclusion(
+            peaks, size, txru.height, [r.id for r in mountain]
+        )
+
+    @classmethod
+    def verify_rollup_in_chain(
+            cls, root: str|bytes, rollup_id: str, proof: bytes,
+            height: int|None = None
+        ) -> bool:
+        """Verifies that a TxRollup ID (at the given height, if
+            provided) is committed to in a chain_root. Combined with
+            `verify_txn_inclusion_proof`, this proves that a Transaction
+            is part of the chain. Does not touch the database.
+        """
+        return verify_mmr_inclusion(root, rollup_id, proof, height)
+
+    def save(self, /, *, suppress_events: bool = False) -> TxRollup:
+        """Save the TxRollup, then update the TxRollupHead of its chain
+            and set the rollup_id of the committed Transactions.
+        """
+        super().save(suppress_events=suppress_events)
+        self._update_head()
+        self.mark_transactions()
+        return self
+
+    def mark_transactions(self) -> int:
+        """Sets the rollup_id of the Transactions committed to in this
+            tx rollup, which removes them from the pending Transactions.
+            Called by `save`; only needs to be called directly for tx
+            rollups saved by earlier versions. Returns the number of
+            Transactions updated.
+        """
+        rollup_id = self.id or self.generate_id(self.data)
+        updated = 0
+        for batch in _batches([i for i in self.tx_ids if i]):
+            updated += Transaction.query().is_in('id', batch).update(
+                {'rollup_id': rollup_id}
+            )
+        return updated
+
+    @classmethod
+    def verify_chain(
+            cls, ledger_or_correspondence: Ledger|Correspondence,
+            max_workers: int|None = None, batch_size: int = 256
+        ) -> tuple[bool, int|None]:
+        """Verifies the entire TxRollup chain of the given Ledger or
+            Correspondence. The chain is loaded in one query; the
+            heights and parent linkage are checked in bulk; and the IDs,
+            tx_roots, and auth scripts are verified in batches of
+            batch_size using a process pool of max_workers processes
+            (or inline if the chain fits in a single batch). Balances
+            are not recalculated since the Transactions may have been
+            trimmed; use `validate` for that. Returns (True, None) if
+            the chain is valid or (False, height) for the lowest height
+            at which the chain is invalid. Raises TypeError for invalid
+            arguments.
+        """
+        tert(type(ledger_or_correspondence) in (Ledger, Correspondence),
+            'ledger_or_correspondence must be a Ledger or Correspondence')
+        tert(type(batch_size) is int and batch_size > 0,
+            'batch_size must be a positive int')
+
+        txru_lock = None
+        if type(ledger_or_correspondence) is Correspondence:
+            query = cls.query().equal('correspondence_id', ledger_or_correspondence.id)
+            txru_lock = ledger_or_correspondence.get_txru_lock(reload=True)
+        else:
+            query = cls.query().equal('ledger_id', ledger_or_correspondence.id)
+        rollups = [txru.data for txru in query.order_by('height', 'asc').get()]
+
+        # check the heights and parent linkage
+        bad_height = None
+        for i, data in enumerate(rollups):
+            parent_id = rollups[i-1]['id'] if i > 0 else None
+            if data['height'] != i or data['parent_id'] != parent_id:
+                bad_height = i
+                break
+
+        # verify ids, tx_roots, and auth scripts of the linked rollups
+        rollups = rollups[:bad_height]
+        batches = [
+            rollups[i:i+batch_size]
+            for i in range(0, len(rollups), batch_size)
+        ]
+        if len(batches) > 1:
+            with ProcessPoolExecutor(max_workers) as executor:
+                results = executor.map(
+                    _verify_rollups, batches, [txru_lock]*len(batches)
+                )
+                results = list(results)
+        else:
+            results = [_verify_rollups(batch, txru_lock) for batch in batches]
+
+        bad_heights = [h for h in results if h is not None]
+        if bad_height is not None:
+            bad_heights.append(bad_height)
+        if len(bad_heights):
+            return (False, min(bad_heights))
+        return (True, None)
+
+    @classmethod
+    def _header_range(
+            cls, scope_id: str, from_height: int, limit: int
+        ) -> list[TxRollup]:
+        """Returns up to limit TxRollups of the chain of the given
+            Ledger or Correspondence ID starting at from_height.
+        """
+        for scope_column in ('ledger_id', 'correspondence_id'):
+            rollups = cls.query().equal(scope_column, scope_id).greater_or_equal(
+                'height', from_height
+            ).order_by('height', 'asc').take(limit)
+            if len(rollups):
+                return rollups
+        return []
+
+    @classmethod
+    def export_headers(
+            cls, ledger_or_correspondence: Ledger|Correspondence,
+            from_height: int = 0, limit: int = 256
+        ) -> bytes:
+        """Encodes the public data of up to limit TxRollups of the chain
+            of the given Ledger or Correspondence, starting at
+            from_height, for mirroring. Raises TypeError for invalid
+            arguments.
+        """
+        tert(type(ledger_or_correspondence) in (Ledger, Correspondence),
+            'ledger_or_correspondence must be a Ledger or Correspondence')
+        encode_request(ledger_or_correspondence.id, from_height, limit)
+        rollups = cls._header_range(ledger_or_correspondence.id, from_height, limit)
+        return encode_headers(
+            ledger_or_correspondence.id, [txru.public() for txru in rollups]
+        )
+
+    @classmethod
+    def serve_headers(cls, request: bytes) -> bytes:
+        """Answers a header request from a mirror (see `sync_headers`)
+            with the encoded public data of the requested TxRollups.
+            Raises ValueError for an invalid request.
+        """
+        scope_id, from_height, limit = decode_request(request)
+        rollups = cls._header_range(scope_id, from_height, limit)
+        return encode_headers(scope_id, [txru.public() for txru in rollups])
+
+    @classmethod
+    def import_headers(
+            cls, data: bytes, ledger_or_correspondence: Ledger|Correspondence,
+            txru_lock: bytes|None = None
+        ) -> int:
+        """Verifies and saves a range of mirrored TxRollup headers
+            encoded by `export_headers` or `serve_headers`. The range
+            must continue the local chain of the Ledger or
+            Correspondence: the heights and parent IDs are checked
+            against the local head, and the IDs and auth scripts are
+            verified in one batch (using the txru_lock of the
+            Correspondence if none is provided) before any are saved
+            in a single database transaction. If a txru_lock is used,
+            every header must have an auth_script that unlocks it.
+            Ledger chains have no txru_lock by default, so their headers
+            are only verified by their hash chain: the head ID should be
+            checked against a trusted source (e.g. with `chain_root`)
+            unless a txru_lock is provided. The headers do not contain
+            the tx_ids, so the tx_roots cannot be checked; the imported
+            TxRollups are validated without their Transactions (see
+            `is_mirror`). Returns the number of TxRollups imported.
+            Raises TypeError for invalid arguments or ValueError for
+            invalid headers.
+        """
+        tert(type(ledger_or_correspondence) in (Ledger, Correspondence),
+            'ledger_or_correspondence must be a Ledger or Correspondence')
+        scope_id, headers = decode_headers(data)
+        vert(scope_id == ledger_or_correspondence.id,
+            'headers are for a different chain')
+        if len(headers) == 0:
+            return 0
+
+        scope_column, other_column = ('ledger_id', 'correspondence_id')
+        if type(ledger_or_correspondence) is Correspondence:
+            scope_column, other_column = ('correspondence_id', 'ledger_id')
+            if txru_lock is None:
+                txru_lock = ledger_or_correspondence.get_txru_lock(reload=True)
+
+        head = cls.head_for(ledger_or_correspondence)
+        height = head.height + 1 if head is not None else 0
+        parent_id = head.id if head is not None else None
+        for header in headers:
+            vert(header.get(scope_column, None) == scope_id and
+                header.get(other_column, None) is None and
+                header.get('height', None) == height and
+                header.get('parent_id', None) == parent_id and
+                (txru_lock is None or header.get('auth_script', None) is not None),
+                f'invalid TxRollup header at height {height}')
+            height += 1
+            parent_id = header.get('id', None)
+
+        bad_height = _verify_rollups(headers, txru_lock)
+        vert(bad_height is None, f'invalid TxRollup header at height {bad_height}')
+
+        rows = [tuple([header.get(c, None) for c in cls.columns]) for header in headers]
+        query = cls.query()
+        with query.context_manager(query.connection_info) as cursor:
+            cursor.executemany(_insert_sql(cls.table, cls.columns, ignore=True), rows)
+        cls(headers[-1])._update_head()
+        return len(headers)
+
+    @classmethod
+    def sync_headers(
+            cls, transport: Any, ledger_or_correspondence: Ledger|Correspondence,
+            batch_size: int = 256, txru_lock: bytes|None = None
+        ) -> int:
+        """Mirrors the TxRollup headers of the chain of the given Ledger
+            or Correspondence from a source through the transport (see
+            `bookchain.mirror`), requesting batch_size headers at a time
+            starting after the local head, so an interrupted sync resumes
+            where it stopped. Returns the number of TxRollups imported.
+            Raises ValueError for invalid headers.
+        """
+        tert(type(batch_size) is int and batch_size > 0,
+            'batch_size must be a positive int')
+        imported = 0
+        while True:
+            head = cls.head_for(ledger_or_correspondence)
+            from_height = head.height + 1 if head is not None else 0
+            response = transport.request(
+                encode_request(ledger_or_correspondence.id, from_height, batch_size)
+            )
+            count = cls.import_headers(response, ledger_or_correspondence, txru_lock)
+            imported += count
+            if count < batch_size:
+                return imported
+
+    def trim(
+            self, archive: bool = True, chunk_size: int = 250,
+            segment_dir: str|None = None
+        ) -> int:
         """Trims the transactions and entries committed to in this tx
             rollup. Returns the number of transactions trimmed. If
             archive is True, the transactions and entries are archived
-            before being deleted. Raises ValueError if the tx rollup is
-            not valid.
+            before being deleted. The transactions are trimmed in chunks
+            of chunk_size: the transactions and entries of each chunk
+            are loaded in bulk, archived with `insert or ignore`, saved
+            as DeletedModels with a bulk insert (mapped to this tx
+            rollup with TrimmedRecords if the trimmed_records table
+            exists), and deleted with `in` lists, all committed at once
+            per chunk. Model events are not invoked for the trimmed
+            records. If archive is True and segment_dir is provided, the
+            transactions and entries are archived to an ArchiveSegment
+            file in that directory (see `archive_segment`) instead of
+            the ArchivedTransaction and ArchivedEntry tables, and no
+            DeletedModels are saved: the segment holds the records, and
+            TrimmedRecords only map their IDs to this tx rollup. The chain
+            must be trimmed in order, since the balances of the most
+            recent trimmed tx rollup are used as starting balances.
+            Raises ValueError if the tx rollup is not valid or its
+            parent has not been trimmed; raises TypeError for invalid
+            chunk_size.
         """
+        tert(type(chunk_size) is int and chunk_size > 0,
+            'chunk_size must be a positive int')
         vert(self.validate(), 'tx rollup is not valid')
-        self.transactions().reload()
-        txns = self.transactions
-        for txn in txns:
-            txn: Transaction
-            txn.entries().reload()
-            for e in txn.entries:
-                e: Entry
-                if archive:
-                    e.archive()
-                e.delete()
+        head = None
+        if TxRollupHead._table_exists():
+            head = TxRollup._head_record(*self._scope())
+        if head is not None and self.height > 0:
+            # the rolled-up balances are only correct if the chain is
+            # trimmed in order
+            vert(head.trimmed_height is not None and
+                head.trimmed_height >= self.height - 1,
+                'the parent tx rollup must be trimmed first')
+        segmented = archive and segment_dir is not None
+        if segmented:
+            segment = self.archive_segment(segment_dir, chunk_size)
+            segment.close()
+            archive = False
+        tx_ids = [i for i in self.tx_ids if i]
+        track = TrimmedRecord._table_exists()
+        trimmed = 0
+        for chunk in _batches(tx_ids, chunk_size):
+            trimmed += self._trim_chunk(chunk, archive, track, segmented)
+
+        # advance the trimmed head of the chain
+        if head is not None and TxRollup.find(self.id) is not None:
+            if head.trimmed_height is None or self.height > head.trimmed_height:
+                head.update({'trimmed_rollup_id': self.id, 'trimmed_height': self.height})
+        return trimmed
+
+    def archive_segment(
+            self, directory: str, chunk_size: int = 250
+        ) -> ArchiveSegment:
+        """Archives the transactions and entries committed to in this
+            tx rollup into an immutable, compressed ArchiveSegment file
+            in the directory and returns it. The transactions and their
+            entries are loaded and written in chunks of chunk_size. If
+            the segment already exists, it is returned unchanged. The
+            transactions are not trimmed; use
+            `trim(segment_dir=directory)` for that. Raises TypeError
+            for invalid chunk_size.
+        """
+        tert(type(chunk_size) is int and chunk_size > 0,
+            'chunk_size must be a positive int')
+        rollup_id = self.id or self.generate_id(self.data)
+        path = os.path.join(directory, ArchiveSegment.filename(rollup_id))
+        if os.path.exists(path):
+            return ArchiveSegment(path)
+        writer = SegmentWriter(directory, rollup_id, self.tx_root)
+        try:
+            for batch in _batches([i for i in self.tx_ids if i], chunk_size):
+                transactions = []
+                for txn in Transaction.query().is_in('id', batch).get():
+                    data = {c: txn.data.get(c, None) for c in ArchivedTransaction.columns}
+                    data['id'] = ArchivedTransaction.generate_id({**data})
+                    transactions.append(data)
+                entry_ids = [
+                    eid
+                    for txn in transactions
+                    for eid in (txn['entry_ids'] or '').split(',')
+                    if eid
+                ]
+                entries = []
+                for entry_batch in _batches(entry_ids):
+                    for entry in Entry.query().is_in('id', entry_batch).get():
+                        data = {c: entry.data.get(c, None) for c in ArchivedEntry.columns}
+                        data['id'] = ArchivedEntry.generate_id({**data})
+                        entries.append(data)
+                writer.add(transactions, entries)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.finish()
+
+    def load_segment(self, directory: str) -> ArchiveSegment|None:
+        """Opens the ArchiveSegment of this tx rollup in the directory.
+            Returns None if there is no segment. Raises ValueError if
+            the segment does not verify against the tx_root.
+        """
+        rollup_id = self.id or self.generate_id(self.data)
+        path = os.path.join(directory, ArchiveSegment.filename(rollup_id))
+        if not os.path.exists(path):
+            return None
+        segment = ArchiveSegment(path)
+        if not segment.verify(self.tx_root):
+            segment.close()
+            raise ValueError('segment does not match the tx_root')
+        return segment
+
+    def _trim_chunk(
+            self, tx_ids: list[str], archive: bool, track: bool = False,
+            segmented: bool = False
+        ) -> int:
+        """Archives (if archive is True) and deletes a chunk of the
+            Transactions and their Entries in a single database
+            transaction. If track is True, a TrimmedRecord mapping each
+            DeletedModel to this tx rollup is inserted as well. If
+            segmented is True, the records are in an ArchiveSegment, so
+            no DeletedModels are saved and the TrimmedRecords map the
+            IDs of the Transactions and Entries instead. Returns the
+            number of Transactions trimmed.
+        """
+        txns: list[Transaction] = Transaction.query().is_in('id', tx_ids).get()
+        if len(txns) == 0:
+            return 0
+        entry_ids = [
+            eid
+            for txn in txns
+            for eid in (txn.data.get('entry_ids', None) or '').split(',')
+            if eid
+        ]
+        entries: list[Entry] = []
+        for batch in _batches(entry_ids):
+            entries.extend(Entry.query().is_in('id', batch).get())
+
+        timestamp = str(int(time()))
+        rollup_id = self.id or self.generate_id(self.data)
+        deleted_rows = [] if segmented else [
+            (
+                DeletedModel.generate_id(), model.__class__.__name__, model.id,
+                packify.pack(model.data), timestamp,
+            )
+            for model in [*entries, *txns]
+        ]
+
+        trimmed_rows = [(row[0], rollup_id) for row in deleted_rows]
+        if segmented:
+            trimmed_rows = [(model.id, rollup_id) for model in [*entries, *txns]]
+
+        query = Transaction.query()
+        with query.context_manager(query.connection_info) as cursor:
             if archive:
-                txn.archive()
-            txn.delete()
+                for model, records in (
+                    (ArchivedEntry, entries), (ArchivedTransaction, txns)
+                ):
+                    rows = []
+                    for record in records:
+                        data = {**record.data}
+                        data['id'] = model.generate_id(data)
+                        rows.append(tuple([data.get(c, None) for c in model.columns]))
+                    cursor.executemany(
+                        _insert_sql(model.table, model.columns, ignore=True), rows
+                    )
+            if len(deleted_rows):
+                cursor.executemany(
+                    _insert_sql(DeletedModel.table, DeletedModel.columns), deleted_rows
+                )
+            if track:
+                cursor.executemany(
+                    _insert_sql(TrimmedRecord.table, TrimmedRecord.columns),
+                    trimmed_rows
+                )
+            for model, ids in ((Entry, [e.id for e in entries]), (Transaction, tx_ids)):
+                for batch in _batches(ids):
+                    cursor.execute(
+                        f'delete from {model.table} where id in '
+                        f'({",".join(["?" for _ in batch])})',
+                        batch
+                    )
         return len(txns)
 
+    def _trimmed_query(self, model_class: str) -> SqlQueryBuilder|None:
+        """Returns a query builder for the DeletedModels of the given
+            model class trimmed by this tx rollup, using an indexed
+            subquery over the TrimmedRecords of this tx rollup. Returns
+            None if the trimmed_records table does not exist or has no
+            TrimmedRecords for this tx rollup.
+        """
+        rollup_id = self.id or self.generate_id(self.data)
+        if not TrimmedRecord._table_exists():
+            return None
+        if TrimmedRecord.query({'rollup_id': rollup_id}).count() == 0:
+            return None
+        query = DeletedModel.query({'model_class': model_class})
+        query.clauses.append(
+            f'id in (select id from {TrimmedRecord.table} where rollup_id = ?)'
+        )
+        query.params.append(rollup_id)
+        return query
+
     def trimmed_transactions(self) -> SqlQueryBuilder:
-        """Returns a query builder for DeletedModels containing the trimmed
-            transactions committed to in this tx rollup.
+        """Returns a query builder for DeletedModels containing the
+            trimmed transactions committed to in this tx rollup. If no
+            TrimmedRecords exist for this tx rollup (e.g. it was trimmed
+            by an earlier version), the DeletedModels are looked up by
+            record_id instead.
         """
+        query = self._trimmed_query(Transaction.__name__)
+        if query is not None:
+            return query
         return DeletedModel.query({'model_class': Transaction.__name__}).is_in(
             'record_id', self.tx_ids
         )
@@ -385,20 +1162,124 @@ class TxRollup(HashedModel):
     def trimmed_entries(self) -> SqlQueryBuilder:
         """Returns a query builder for DeletedModels containing the
             trimmed entries from trimmed transactions committed to in
-            this tx rollup.
+            this tx rollup. If no TrimmedRecords exist for this tx
+            rollup (e.g. it was trimmed by an earlier version), the
+            DeletedModels are looked up by record_id instead.
         """
-        txns = [
-            Transaction(packify.unpack(item.record))
+        query = self._trimmed_query(Entry.__name__)
+        if query is not None:
+            return query
+        entry_ids = [
+            eid
             for item in self.trimmed_transactions().get()
+            for eid in (packify.unpack(item.record).get('entry_ids', None) or '').split(',')
+            if eid
         ]
-        return DeletedModel.query({'model_class': Entry.__name__}).is_in(
-            'record_id',
-            [
+        query = DeletedModel.query({'model_class': Entry.__name__})
+        if len(entry_ids) == 0:
+            # no trimmed transactions, so match nothing
+            return query.is_null('id')
+        return query.is_in('record_id', entry_ids)
+
+    def trimmed_transaction_chunks(
+            self, chunk_size: int = 500
+        ) -> Generator[list[DeletedModel], None, None]:
+        """Yields lists of up to chunk_size DeletedModels containing
+            the trimmed transactions committed to in this tx rollup,
+            using the TrimmedRecords of this tx rollup if they exist or
+            else looking them up by record_id chunk_size at a time.
+            Raises TypeError for invalid chunk_size.
+        """
+        tert(type(chunk_size) is int and chunk_size > 0,
+            'chunk_size must be a positive int')
+        query = self._trimmed_query(Transaction.__name__)
+        if query is not None:
+            for chunk in query.chunk(chunk_size):
+                yield chunk
+            return
+        for batch in _batches([i for i in self.tx_ids if i], chunk_size):
+            chunk = DeletedModel.query({
+                'model_class': Transaction.__name__
+            }).is_in('record_id', batch).get()
+            if len(chunk):
+                yield chunk
+
+    def trimmed_entry_chunks(
+            self, chunk_size: int = 500
+        ) -> Generator[list[DeletedModel], None, None]:
+        """Yields lists of up to chunk_size DeletedModels containing
+            the trimmed entries from trimmed transactions committed to
+            in this tx rollup, using the TrimmedRecords of this tx
+            rollup if they exist or else looking them up by record_id
+            from each chunk of trimmed transactions. Raises TypeError
+            for invalid chunk_size.
+        """
+        tert(type(chunk_size) is int and chunk_size > 0,
+            'chunk_size must be a positive int')
+        query = self._trimmed_query(Entry.__name__)
+        if query is not None:
+            for chunk in query.chunk(chunk_size):
+                yield chunk
+            return
+        for txns in self.trimmed_transaction_chunks(chunk_size):
+            entry_ids = [
+                eid
+                for item in txns
+                for eid in (packify.unpack(item.record).get('entry_ids', None) or '').split(',')
+                if eid
+            ]
+            for batch in _batches(entry_ids, chunk_size):
+                chunk = DeletedModel.query({
+                    'model_class': Entry.__name__
+                }).is_in('record_id', batch).get()
+                if len(chunk):
+                    yield chunk
+
+    def reindex_trimmed(self) -> int:
+        """Inserts the missing TrimmedRecords for the DeletedModels of
+            the Transactions and Entries trimmed by this tx rollup,
+            which are looked up by record_id. Only needed for records
+            trimmed by earlier versions or before the trimmed_records
+            table was created. The DeletedModels are not modified.
+            Returns the number of TrimmedRecords inserted. Raises
+            ValueError if the trimmed_records table does not exist.
+        """
+        vert(TrimmedRecord._table_exists(), 'trimmed_records table does not exist')
+        rollup_id = self.id or self.generate_id(self.data)
+        tx_ids = [i for i in self.tx_ids if i]
+        inserted = 0
+        for batch in _batches(tx_ids):
+            txns = DeletedModel.query({'model_class': Transaction.__name__}).is_in(
+                'record_id', batch
+            ).get()
+            entry_ids = [
                 eid
                 for txn in txns
-                for eid in txn.entry_ids.split(',')
+                for eid in (packify.unpack(txn.record).get('entry_ids', None) or '').split(',')
+                if eid
             ]
-        )
+            entries = []
+            for entry_batch in _batches(entry_ids):
+                entries.extend(DeletedModel.query({'model_class': Entry.__name__}).is_in(
+                    'record_id', entry_batch
+                ).get())
+
+            ids = [item.id for item in [*txns, *entries]]
+            existing = set()
+            for id_batch in _batches(ids):
+                existing.update(
+                    r.id for r in TrimmedRecord.query().is_in('id', id_batch).get()
+                )
+            rows = [(id, rollup_id) for id in ids if id not in existing]
+            if len(rows) == 0:
+                continue
+            query = TrimmedRecord.query()
+            with query.context_manager(query.connection_info) as cursor:
+                cursor.executemany(
+                    _insert_sql(TrimmedRecord.table, TrimmedRecord.columns), rows
+                )
+            inserted += len(rows)
+        return inserted
 
     def archived_transactions(self) -> SqlQueryBuilder:
         """Returns a query builder for ArchivedTransactions committed
@@ -408,13 +1289,71 @@ class TxRollup(HashedModel):
 
     def archived_entries(self) -> SqlQueryBuilder:
         """Returns a query builder for ArchivedEntries committed to
-            in this tx rollup.
-        """
-        return ArchivedEntry.query().is_in(
-            'id',
-            [
-                e.id
-                for txn in self.archived_transactions().get()
-                for e in txn.entries
+            in this tx rollup. The entry IDs are read from the
+            entry_ids column of the ArchivedTransactions, which are
+            loaded in batches before the query builder is returned. For
+            tx rollups with very many entries, `archived_entry_chunks`
+            keeps each query bounded.
+        """
+        entry_ids = []
+        for batch in _batches([i for i in self.tx_ids if i]):
+            for txn in ArchivedTransaction.query().is_in('id', batch).get():
+                entry_ids.extend([
+                    eid
+                    for eid in (txn.data.get('entry_ids', None) or '').split(',')
+                    if eid
+                ])
+        return ArchivedEntry.query().is_in('id', entry_ids)
+
+    def archived_entry_chunks(
+            self, chunk_size: int = 500
+        ) -> Generator[list[ArchivedEntry], None, None]:
+        """Yields lists of the ArchivedEntries committed to in this tx
+            rollup, loading the ArchivedTransactions of chunk_size
+            Transactions at a time and then their ArchivedEntries.
+            Raises TypeError for invalid chunk_size.
+        """
+        tert(type(chunk_size) is int and chunk_size > 0,
+            'chunk_size must be a positive int')
+        tx_ids = [i for i in self.tx_ids if i]
+        for batch in _batches(tx_ids, chunk_size):
+            txns = ArchivedTransaction.query().is_in('id', batch).get()
+            entry_ids = [
+                eid
+                for txn in txns
+                for eid in (txn.data.get('entry_ids', None) or '').split(',')
+                if eid
             ]
-        )
+            for entry_batch in _batches(entry_ids):
+                entries = ArchivedEntry.query().is_in('id', entry_batch).get()
+                if len(entries):
+                    yield entries
+
+    def archived_transactions_with_entries(self) -> list[ArchivedTransaction]:
+        """Returns the ArchivedTransactions committed to in this tx
+            rollup with their `entries` relations already loaded, using
+            one query per batch of ArchivedTransactions and one per batch
+            of ArchivedEntries.
+        """
+        txns: list[ArchivedTransaction] = []
+        for batch in _batches([i for i in self.tx_ids if i]):
+            txns.extend(ArchivedTransaction.query().is_in('id', batch).get())
+        entry_ids = [
+            eid
+            for txn in txns
+            for eid in (txn.data.get('entry_ids', None) or '').split(',')
+            if eid
+        ]
+        entries = {}
+        for batch in _batches(entry_ids):
+            for e in ArchivedEntry.query().is_in('id', batch).get():
+                entries[e.id] = e
+        for txn in txns:
+            relation = txn.entries()
+            relation.secondary = [
+                entries[eid]
+                for eid in (txn.data.get('entry_ids', None) or '').split(',')
+                if eid in entries
+            ]
+            relation.secondary_to_add = []
+        return txns
@@ -0,0 +1,86 @@
+from __future__ import annotations
+from bookchain.enums import EntryType
+from sqloquent import SqlModel, RelatedModel
+
+
+class TxRollupHead(SqlModel):
+    """A TxRollupHead is a mutable pointer to the most recent TxRollup
+        in the chain of a Ledger or Correspondence, keyed by the ID of
+        the Ledger or Correspondence. It also points to the most recent
+        TxRollup whose Transactions have been trimmed, the balances of
+        which are the starting balances for the remaining Entries of
+        the Accounts on the covered Ledgers. It also stores the peaks of
+        the Merkle Mountain Range of the TxRollup IDs of the chain. It
+        is maintained by `TxRollup.save` and `TxRollup.trim` and is not
+        hashed.
+    """
+    connection_info: str = ''
+    table: str = 'rollup_heads'
+    id_column: str = 'id'
+    columns: tuple[str] = (
+        'id', 'rollup_id', 'height', 'trimmed_rollup_id', 'trimmed_height',
+        'ledger_ids', 'mmr_peaks',
+    )
+    id: str
+    rollup_id: str
+    height: int
+    trimmed_rollup_id: str|None
+    trimmed_height: int|None
+    ledger_ids: str
+    mmr_peaks: bytes|None
+    rollup: RelatedModel
+    trimmed_rollup: RelatedModel
+    _tables: dict[str, bool] = {}
+
+    @classmethod
+    def _table_exists(cls) -> bool:
+        """Returns True if the rollup_heads table exists. The table is
+            looked up once per connection_info until `set_connection_info`
+            is called again. Returns False without querying if no
+            connection_info is set.
+        """
+        if not cls.connection_info:
+            return False
+        if cls.connection_info not in cls._tables:
+            query = cls.query()
+            with query.context_manager(query.connection_info) as cursor:
+                cursor.execute(
+                    "select count(*) from sqlite_master where type = 'table' and name = ?",
+                    [cls.table]
+                )
+                cls._tables[cls.connection_info] = (cursor.fetchone())[0] > 0
+        return cls._tables[cls.connection_info]
+
+    @classmethod
+    def get_rolled_up_balances(
+            cls, *scope_ids: str|None
+        ) -> dict[str, tuple[EntryType, int]]:
+        """Returns the balances of the most recent trimmed TxRollup of
+            the chains of the given Ledger and Correspondence IDs,
+            combined into a single dict mapping account IDs to tuples of
+            EntryType and int balances. The TxRollupHeads are looked up
+            by ID, and no TxRollup is loaded if none of the chains has
+            been trimmed. Returns an empty dict if the rollup_heads
+            table does not exist, e.g. in databases that do not use
+            TxRollups.
+        """
+        scope_ids = list(set([s for s in scope_ids if s]))
+        if not scope_ids or not cls._table_exists():
+            return {}
+        heads = cls.query().is_in('id', scope_ids).not_null(
+            'trimmed_rollup_id'
+        ).get()
+
+        net_credits: dict[str, int] = {}
+        for head in heads:
+            head.trimmed_rollup().reload()
+            balances = head.trimmed_rollup.resolve_balances()
+            for acct_id, (entry_type, amount) in balances.items():
+                if entry_type is EntryType.DEBIT:
+                    amount = -amount
+                net_credits[acct_id] = net_credits.get(acct_id, 0) + amount
+
+        return {
+            acct_id: (EntryType.CREDIT, net) if net >= 0 else (EntryType.DEBIT, -net)
+            for acct_id, net in net_credits.items()
+        }
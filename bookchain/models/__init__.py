@@ -8,14 +8,28 @@ from .Customer import Customer
 from .Entry import Entry
 from .Identity import Identity
 from .Ledger import Ledger
+from .RollupSigningSession import RollupSigningSession
 from .Transaction import Transaction
+from .TrimmedRecord import TrimmedRecord
 from .TxRollup import TxRollup
+from .TxRollupHead import TxRollupHead
 from .Vendor import Vendor
+from .memory import MemoryContext, MemoryQueryBuilder
+from .pool import PooledContext, PooledQueryBuilder, configure_pool, close_pools
+from .sharding import (
+    ShardedContext, ShardedCursor, ShardedQueryBuilder,
+    configure_sharding, get_shard_map,
+)
+from .snapshot import Snapshot, SnapshotContext, SnapshotQueryBuilder
 from bookchain.enums import AccountType, EntryType, LedgerType
+from bookchain.helpers import DEFAULT_PRAGMAS
+from bookchain.memory import MemoryEngine, get_engine
+from bookchain.sharding import SHARD_PRAGMAS, ShardMap
 from sqloquent import (
     contains, within, has_many, belongs_to, has_one,
-    DeletedModel, Attachment,
+    DeletedModel, Attachment, SqlQueryBuilder,
 )
+from sqloquent.errors import vert
 from typing import Callable
 import sqloquent.tools
 
@@ -57,6 +71,7 @@ Ledger.rollups = within(Ledger, TxRollup, 'ledger_id')
 
 TxRollup.transactions = contains(TxRollup, Transaction, 'tx_ids')
 Transaction.rollups = within(Transaction, TxRollup, 'tx_ids')
+Transaction.rollup = belongs_to(Transaction, TxRollup, 'rollup_id')
 
 TxRollup.parent = belongs_to(TxRollup, TxRollup, 'parent_id')
 TxRollup.child = has_one(TxRollup, TxRollup, 'parent_id')
@@ -64,6 +79,11 @@ TxRollup.child = has_one(TxRollup, TxRollup, 'parent_id')
 TxRollup.correspondence = belongs_to(TxRollup, Correspondence, 'correspondence_id')
 Correspondence.rollups = within(Correspondence, TxRollup, 'correspondence_id')
 
+TxRollupHead.rollup = belongs_to(TxRollupHead, TxRollup, 'rollup_id')
+TxRollupHead.trimmed_rollup = belongs_to(TxRollupHead, TxRollup, 'trimmed_rollup_id')
+
+TrimmedRecord.rollup = belongs_to(TrimmedRecord, TxRollup, 'rollup_id')
+
 ArchivedEntry.transactions = within(ArchivedEntry, ArchivedTransaction, 'entry_ids')
 ArchivedTransaction.entries = contains(ArchivedTransaction, ArchivedEntry, 'entry_ids')
 
@@ -74,25 +94,67 @@ ArchivedTransaction.ledgers = contains(ArchivedTransaction, Ledger, 'ledger_ids'
 Ledger.archived_transactions = within(Ledger, ArchivedTransaction, 'ledger_ids')
 
 
-def set_connection_info(db_file_path: str):
+_added_columns: list[tuple[type, str, str]] = [
+    (Transaction, 'rollup_id', 'text'),
+    (TxRollup, 'balance_root', 'text'),
+    (TxRollupHead, 'mmr_peaks', 'blob'),
+    (Correspondence, 'equity_account_ids', 'text'),
+]
+
+
+def set_connection_info(
+        db_file_path: str, reuse_connections: bool = False,
+        pragmas: dict[str, int|str]|None = None,
+        shards: list[str]|ShardMap|None = None, snapshots: bool = False
+    ):
     """Set the connection info for all models to use the specified
-        sqlite3 database file path.
+        sqlite3 database file path. If reuse_connections is True, all
+        models use `PooledContext`, which keeps one long-lived
+        connection per thread configured with the pragmas (default
+        `DEFAULT_PRAGMAS`); otherwise, each operation opens its own
+        connection as before. If shards (a list of database file paths
+        or a `ShardMap` with db_file_path as its home) are provided,
+        Ledgers and their records are stored in the shards and all
+        models use `ShardedContext`, which also reuses connections;
+        the pragmas then default to `SHARD_PRAGMAS`. Call `close_pools`
+        to close the reused connections of the current thread. With
+        reuse_connections, or if snapshots is True, the bookchain models
+        read through the connection of a `Snapshot` of db_file_path
+        within its `with` block; with snapshots alone, sqloquent's
+        shared DeletedModel and Attachment keep sqloquent's
+        SqlQueryBuilder. If db_file_path is the
+        connection_info of an open `MemoryEngine`, all models use
+        `MemoryContext` instead.
     """
-    Account.connection_info = db_file_path
-    AccountCategory.connection_info = db_file_path
-    Correspondence.connection_info = db_file_path
-    Currency.connection_info = db_file_path
-    Customer.connection_info = db_file_path
-    Entry.connection_info = db_file_path
-    Identity.connection_info = db_file_path
-    Ledger.connection_info = db_file_path
-    Transaction.connection_info = db_file_path
-    TxRollup.connection_info = db_file_path
-    ArchivedTransaction.connection_info = db_file_path
-    ArchivedEntry.connection_info = db_file_path
-    Vendor.connection_info = db_file_path
-    DeletedModel.connection_info = db_file_path
-    Attachment.connection_info = db_file_path
+    query_builder_class = SqlQueryBuilder
+    if get_engine(db_file_path) is not None:
+        query_builder_class = MemoryQueryBuilder
+    elif shards is not None:
+        if type(shards) is not ShardMap:
+            shards = ShardMap(db_file_path, shards, pragmas=pragmas)
+        vert(shards.home == db_file_path, 'shards.home must be db_file_path')
+        configure_sharding(shards)
+        query_builder_class = ShardedQueryBuilder
+    elif reuse_connections:
+        configure_pool(db_file_path, pragmas)
+        query_builder_class = PooledQueryBuilder
+    elif snapshots:
+        query_builder_class = SnapshotQueryBuilder
+
+    for model in (
+        Account, AccountCategory, Correspondence, Currency, Customer,
+        Entry, Identity, Ledger, Transaction, TrimmedRecord, TxRollup,
+        TxRollupHead, ArchivedTransaction, ArchivedEntry, Vendor,
+    ):
+        model.connection_info = db_file_path
+        model.query_builder_class = query_builder_class
+    for model in (DeletedModel, Attachment):
+        model.connection_info = db_file_path
+        model.query_builder_class = (
+            SqlQueryBuilder if query_builder_class is SnapshotQueryBuilder
+            else query_builder_class
+        )
+    TxRollupHead._tables.clear()
 
 def get_migrations() -> dict[str, str]:
     """Returns a dict mapping model names to migration file content strs."""
@@ -108,7 +170,9 @@ def get_migrations() -> dict[str, str]:
         Identity,
         Ledger,
         Transaction,
+        TrimmedRecord,
         TxRollup,
+        TxRollupHead,
         Vendor,
     ]
     migrations = {}
@@ -135,5 +199,34 @@ def publish_migrations(
             f.write(m)
 
 def automigrate(migration_folder_path: str, db_file_path: str):
-    """Executes the sqloquent automigrate tool."""
+    """Executes the sqloquent automigrate tool, then adds any missing
+        columns to existing tables with `upgrade_schema`.
+    """
     sqloquent.tools.automigrate(migration_folder_path, db_file_path)
+    upgrade_schema(db_file_path)
+    TxRollupHead._tables.pop(db_file_path, None)
+
+def upgrade_schema(db_file_path: str) -> list[str]:
+    """Adds the nullable, indexed columns that later versions added to
+        existing tables (e.g. the rollup_id column of transactions) to
+        a database created by an earlier version. Tables that do not
+        exist are skipped; they are created by `automigrate`, which
+        also calls this. Returns the added columns as 'table.column'
+        strs.
+    """
+    added = []
+    with sqloquent.SqliteContext(db_file_path) as cursor:
+        for model, column, column_type in _added_columns:
+            cursor.execute(f'pragma table_info("{model.table}")')
+            existing = [row[1] for row in cursor.fetchall()]
+            if len(existing) == 0 or column in existing:
+                continue
+            cursor.execute(
+                f'alter table "{model.table}" add column "{column}" {column_type}'
+            )
+            cursor.execute(
+                f'create index if not exists idx_{model.table}_{column} '
+                f'on "{model.table}" ("{column}")'
+            )
+            added.append(f'{model.table}.{column}')
+    return added
@@ -0,0 +1,36 @@
+from __future__ import annotations
+from .pool import PooledContext
+from bookchain.memory import MemoryEngine, get_engine
+from sqloquent import SqlQueryBuilder
+from sqloquent.errors import vert
+import sqlite3
+import threading
+
+
+class MemoryContext(PooledContext):
+    """Context manager that keeps one long-lived connection per thread
+        to the `MemoryEngine` with the connection_info. Nested contexts
+        share the connection, and the outermost context commits or rolls
+        back when it exits.
+    """
+    _thread_local = threading.local()
+
+    def _profile(self) -> MemoryEngine:
+        """Returns the MemoryEngine the connection is opened to. Raises
+            ValueError if no MemoryEngine with the connection_info is
+            open.
+        """
+        engine = get_engine(self.connection_info)
+        vert(engine is not None, f'no memory engine open for {self.connection_info}')
+        return engine
+
+    def _connect(self, profile: MemoryEngine) -> sqlite3.Connection:
+        """Opens a connection to the in-memory database."""
+        return profile.connect()
+
+
+class MemoryQueryBuilder(SqlQueryBuilder):
+    """Query builder that uses `MemoryContext` by default."""
+    def __init__(self, *args, **kwargs) -> None:
+        kwargs.setdefault('context_manager', MemoryContext)
+        super().__init__(*args, **kwargs)
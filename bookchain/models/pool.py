@@ -0,0 +1,146 @@
+from __future__ import annotations
+from .snapshot import Snapshot, _snapshot_for
+from bookchain.helpers import DEFAULT_PRAGMAS, _pragma_statements
+from sqloquent import SqlQueryBuilder
+from sqloquent.errors import tert, vert
+from types import TracebackType
+import sqlite3
+import threading
+
+
+_pragmas: dict[str, dict[str, int|str]] = {}
+
+
+class PooledContext:
+    """Context manager for sqlite that keeps one long-lived connection
+        per thread and database file, configured with the pragmas set
+        with `configure_pool` when it is opened. Nested contexts share
+        the connection, and the outermost context commits or rolls back
+        when it exits. The connection is reopened if the pragmas are
+        changed and is closed by `close_pools` or when the thread ends.
+        Within a `Snapshot` of the database file, the snapshot
+        connection is used instead.
+    """
+    _thread_local = threading.local()
+
+    connection: sqlite3.Connection
+    cursor: sqlite3.Cursor
+    connection_info: str
+    snapshot: Snapshot|None = None
+
+    def __init__(self, connection_info: str = '') -> None:
+        """Raises TypeError for non-str connection_info."""
+        if not connection_info and hasattr(self, 'connection_info'):
+            connection_info = self.connection_info
+        tert(type(connection_info) is str, 'connection_info must be str')
+        self.connection_info = connection_info
+
+    @classmethod
+    def _local(cls) -> threading.local:
+        local = cls._thread_local
+        if not hasattr(local, 'connections'):
+            local.connections = {}
+            local.depths = {}
+        return local
+
+    def _profile(self) -> dict[str, int|str]:
+        """Returns the configuration the connection is opened with.
+            Raises ValueError if no pool is configured for the
+            connection_info.
+        """
+        vert(self.connection_info in _pragmas,
+            f'no pool configured for {self.connection_info}')
+        return _pragmas[self.connection_info]
+
+    def _connect(self, profile: dict[str, int|str]) -> sqlite3.Connection:
+        """Opens a connection and applies the pragmas."""
+        connection = sqlite3.connect(self.connection_info)
+        for statement in _pragma_statements(profile):
+            connection.execute(statement)
+        return connection
+
+    def _cursor(self, connection: sqlite3.Connection) -> sqlite3.Cursor:
+        return connection.cursor()
+
+    def __enter__(self) -> sqlite3.Cursor:
+        """Enter the context block and return a cursor. Raises
+            ValueError if no pool is configured for the connection_info.
+        """
+        self.snapshot = _snapshot_for(self.connection_info)
+        if self.snapshot is not None:
+            self.cursor = self.snapshot.connection.cursor()
+            return self.cursor
+
+        local = self._local()
+        profile = self._profile()
+        depth = local.depths.get(self.connection_info, 0)
+        connection, opened_with = local.connections.get(
+            self.connection_info, (None, None)
+        )
+
+        if connection is not None and depth == 0 and opened_with != profile:
+            connection.close()
+            connection = None
+        if connection is None:
+            connection = self._connect(profile)
+            local.connections[self.connection_info] = (connection, profile)
+
+        local.depths[self.connection_info] = depth + 1
+        self.connection = connection
+        self.cursor = self._cursor(connection)
+        return self.cursor
+
+    def __exit__(
+            self, exc_type: type[BaseException] | None,
+            exc_value: BaseException | None,
+            traceback: TracebackType | None
+        ) -> None:
+        """Exit the context block. The outermost context commits or
+            rolls back; the connection is kept open.
+        """
+        if self.snapshot is not None:
+            self.cursor.close()
+            return
+
+        local = self._local()
+        local.depths[self.connection_info] -= 1
+        self.cursor.close()
+        if local.depths[self.connection_info] > 0:
+            return
+        if exc_type is not None:
+            self.connection.rollback()
+        else:
+            self.connection.commit()
+
+
+class PooledQueryBuilder(SqlQueryBuilder):
+    """Query builder that uses `PooledContext` by default."""
+    def __init__(self, *args, **kwargs) -> None:
+        kwargs.setdefault('context_manager', PooledContext)
+        super().__init__(*args, **kwargs)
+
+
+def configure_pool(
+        connection_info: str, pragmas: dict[str, int|str]|None = None
+    ) -> None:
+    """Configures `PooledContext` to keep a long-lived connection per
+        thread to the database file, applying the pragmas (default
+        `DEFAULT_PRAGMAS`). Raises TypeError or ValueError for invalid
+        arguments.
+    """
+    tert(type(connection_info) is str, 'connection_info must be str')
+    vert(connection_info not in ('', ':memory:'),
+        'connection_info must be a database file path')
+    pragmas = {**DEFAULT_PRAGMAS} if pragmas is None else {**pragmas}
+    _pragma_statements(pragmas)
+    _pragmas[connection_info] = pragmas
+
+def close_pools() -> None:
+    """Closes the connections of the current thread that are not in
+        use. Connections are reopened as needed.
+    """
+    for context in (PooledContext, *PooledContext.__subclasses__()):
+        local = context._local()
+        for connection_info in list(local.connections):
+            if local.depths.get(connection_info, 0) == 0:
+                local.connections.pop(connection_info)[0].close()
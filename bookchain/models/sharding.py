@@ -0,0 +1,181 @@
+from __future__ import annotations
+from .pool import PooledContext
+from bookchain.helpers import _batches
+from bookchain.sharding import SHARDED_TABLES, ShardMap
+from sqloquent import SqlQueryBuilder
+from sqloquent.errors import tert, vert
+from typing import Any
+import sqlite3
+import threading
+
+
+_shard_maps: dict[str, ShardMap] = {}
+
+
+class ShardedCursor:
+    """Cursor that routes writes to the sharded tables to the shards of
+        their Ledgers as described by a `ShardMap`. Updates and deletes
+        are run only in the shards of the rows they match. Other
+        statements are run unchanged; reads of the sharded tables use
+        the views of all shards.
+    """
+    def __init__(self, shard_map: ShardMap, cursor: sqlite3.Cursor) -> None:
+        self.shard_map = shard_map
+        self.cursor = cursor
+        self._rowcount = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        return self.cursor.connection
+
+    @property
+    def rowcount(self) -> int:
+        return self.cursor.rowcount if self._rowcount is None else self._rowcount
+
+    @property
+    def lastrowid(self) -> int|None:
+        return self.cursor.lastrowid
+
+    def _account_ledgers(self, account_ids: list[str]) -> dict[str, str]:
+        """Returns a dict mapping the Account IDs to their Ledger IDs."""
+        ledgers = {}
+        for batch in _batches(list(set([a for a in account_ids if a]))):
+            ledgers.update(self.connection.execute(
+                f'select id, ledger_id from accounts where id in '
+                f'({",".join(["?" for _ in batch])})',
+                batch
+            ).fetchall())
+        return ledgers
+
+    def execute(self, sql: str, parameters: Any = ()) -> ShardedCursor:
+        if ShardMap.parse(sql) is None:
+            self._rowcount = None
+            self.cursor.execute(sql, parameters)
+            return self
+        return self.executemany(sql, [parameters])
+
+    def executemany(self, sql: str, parameters: Any) -> ShardedCursor:
+        write = ShardMap.parse(sql)
+        if write is None:
+            self._rowcount = None
+            self.cursor.executemany(sql, parameters)
+            return self
+
+        kind, table, columns = write
+        parameters = list(parameters)
+        groups: dict[str, list] = {}
+        if kind == 'insert':
+            if columns is None:
+                columns = [
+                    r[1] for r in self.connection.execute(
+                        f'pragma main.table_info({table})'
+                    ).fetchall()
+                ]
+            rows = [dict(zip(columns, p)) for p in parameters]
+            account_ledgers = {}
+            if SHARDED_TABLES[table] == 'account_id':
+                account_ledgers = self._account_ledgers(
+                    [row.get('account_id') for row in rows]
+                )
+            for row, params in zip(rows, parameters):
+                schema = self.shard_map.schema_for_row(table, row, account_ledgers)
+                groups.setdefault(schema, []).append(params)
+        elif ShardMap.routing_sql(sql) is None:
+            groups = {schema: parameters for schema in self.shard_map.schemas}
+        else:
+            query, offset = ShardMap.routing_sql(sql)
+            column = SHARDED_TABLES[table]
+            matches = [
+                [r[0] for r in self.connection.execute(query, list(params)[offset:]).fetchall()]
+                for params in parameters
+            ]
+            account_ledgers = {}
+            if column == 'account_id':
+                account_ledgers = self._account_ledgers(
+                    [v for values in matches for v in values]
+                )
+            for values, params in zip(matches, parameters):
+                schemas = set([
+                    self.shard_map.schema_for_row(table, {column: v}, account_ledgers)
+                    for v in values
+                ])
+                for schema in schemas:
+                    groups.setdefault(schema, []).append(params)
+
+        rowcount = 0
+        for schema, params in groups.items():
+            self.cursor.executemany(ShardMap.qualify(sql, schema), params)
+            rowcount += max(self.cursor.rowcount, 0)
+        self._rowcount = rowcount
+        return self
+
+    def executescript(self, sql: str) -> ShardedCursor:
+        self._rowcount = None
+        self.cursor.executescript(sql)
+        return self
+
+    def fetchone(self) -> Any:
+        return self.cursor.fetchone()
+
+    def fetchall(self) -> Any:
+        return self.cursor.fetchall()
+
+    def close(self) -> None:
+        self.cursor.close()
+
+
+class ShardedContext(PooledContext):
+    """Context manager that keeps one long-lived connection per thread
+        to the home database of the `ShardMap` configured for the
+        connection_info with `configure_sharding`, with the shards
+        attached, and returns a `ShardedCursor`. Nested contexts share
+        the connection, so everything written within the outermost
+        context is committed atomically across the shards when it
+        exits.
+    """
+    _thread_local = threading.local()
+
+    def _profile(self) -> ShardMap:
+        """Returns the ShardMap the connection is opened with. Raises
+            ValueError if no ShardMap is configured for the
+            connection_info.
+        """
+        vert(self.connection_info in _shard_maps,
+            f'no shards configured for {self.connection_info}')
+        return _shard_maps[self.connection_info]
+
+    def _connect(self, profile: ShardMap) -> sqlite3.Connection:
+        """Opens a connection to the home database, attaches the shards,
+            and creates the views of the sharded tables.
+        """
+        connection = sqlite3.connect(self.connection_info)
+        tables = [
+            r[0] for r in connection.execute(
+                "select name from sqlite_master where type = 'table'"
+            ).fetchall()
+        ]
+        for statement in profile.setup_statements(tables):
+            connection.execute(statement)
+        return connection
+
+    def _cursor(self, connection: sqlite3.Connection) -> ShardedCursor:
+        return ShardedCursor(self._profile(), connection.cursor())
+
+
+class ShardedQueryBuilder(SqlQueryBuilder):
+    """Query builder that uses `ShardedContext` by default."""
+    def __init__(self, *args, **kwargs) -> None:
+        kwargs.setdefault('context_manager', ShardedContext)
+        super().__init__(*args, **kwargs)
+
+
+def configure_sharding(shard_map: ShardMap) -> None:
+    """Configures `ShardedContext` to use the ShardMap for its home
+        database file. Raises TypeError for an invalid shard_map.
+    """
+    tert(type(shard_map) is ShardMap, 'shard_map must be ShardMap')
+    _shard_maps[shard_map.home] = shard_map
+
+def get_shard_map(connection_info: str) -> ShardMap|None:
+    """Returns the ShardMap configured for the home database file."""
+    return _shard_maps.get(connection_info)
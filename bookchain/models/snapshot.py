@@ -0,0 +1,124 @@
+from __future__ import annotations
+from bookchain.helpers import _pragma_statements
+from contextvars import ContextVar
+from sqloquent import SqlQueryBuilder, SqliteContext
+from sqloquent.errors import tert, vert
+from types import TracebackType
+from urllib.parse import quote
+import os
+import sqlite3
+
+
+_snapshots: ContextVar[dict[str, Snapshot]] = ContextVar('_snapshots', default={})
+
+
+def _snapshot_for(connection_info: str) -> Snapshot|None:
+    """Returns the Snapshot bound to the connection_info, if any."""
+    return _snapshots.get().get(connection_info)
+
+
+class Snapshot:
+    """A read-only connection to a database file in WAL journal mode
+        that holds a read transaction open, so every query sees the
+        database as it was when the Snapshot was entered and writers
+        are never blocked. Within the `with` block, all models using the
+        connection_info (with `SnapshotContext` or `PooledContext`) read
+        through the snapshot connection, and writes fail. The binding is
+        per thread (and per asyncio task), so parallel reports open one
+        Snapshot each.
+    """
+    connection_info: str
+    pragmas: dict[str, int|str]
+    connection: sqlite3.Connection|None
+
+    def __init__(
+            self, connection_info: str,
+            pragmas: dict[str, int|str]|None = None
+        ) -> None:
+        """The pragmas are applied to the snapshot connection, except
+            for journal_mode and synchronous. Raises TypeError or
+            ValueError for invalid arguments.
+        """
+        tert(type(connection_info) is str, 'connection_info must be str')
+        vert(connection_info not in ('', ':memory:'),
+            'connection_info must be a database file path')
+        pragmas = {
+            k: v for k, v in (pragmas or {}).items()
+            if k not in ('journal_mode', 'synchronous')
+        }
+        _pragma_statements(pragmas)
+        self.connection_info = connection_info
+        self.pragmas = pragmas
+        self.connection = None
+
+    def __enter__(self) -> Snapshot:
+        """Opens the snapshot connection, starts the read transaction,
+            and binds it to the connection_info. Raises ValueError if
+            the Snapshot is already open or the database is not in WAL
+            journal mode, e.g. if it is sharded.
+        """
+        vert(self.connection is None, 'snapshot is already open')
+        uri = f'file:{quote(os.path.abspath(self.connection_info))}?mode=ro'
+        connection = sqlite3.connect(uri, uri=True, isolation_level=None)
+        try:
+            mode = connection.execute('pragma journal_mode').fetchone()[0]
+            vert(mode == 'wal', 'snapshots require a database in WAL journal mode')
+            for statement in _pragma_statements(self.pragmas):
+                connection.execute(statement)
+            connection.execute('begin')
+            connection.execute('select count(*) from sqlite_master').fetchone()
+        except BaseException:
+            connection.close()
+            raise
+        self.connection = connection
+        self._token = _snapshots.set({
+            **_snapshots.get(), self.connection_info: self
+        })
+        return self
+
+    def __exit__(
+            self, exc_type: type[BaseException] | None,
+            exc_value: BaseException | None,
+            traceback: TracebackType | None
+        ) -> None:
+        """Ends the read transaction, unbinds the snapshot, and closes
+            the connection.
+        """
+        _snapshots.reset(self._token)
+        try:
+            self.connection.execute('rollback')
+        finally:
+            self.connection.close()
+            self.connection = None
+
+
+class SnapshotContext(SqliteContext):
+    """sqloquent's SqliteContext, except that within a `Snapshot` of the
+        connection_info it returns a cursor of the snapshot connection.
+    """
+    snapshot: Snapshot|None = None
+
+    def __enter__(self) -> sqlite3.Cursor:
+        """Enter the context block and return the cursor."""
+        self.snapshot = _snapshot_for(self.connection_info)
+        if self.snapshot is None:
+            return super().__enter__()
+        self.cursor = self.snapshot.connection.cursor()
+        return self.cursor
+
+    def __exit__(
+            self, exc_type: type[BaseException] | None,
+            exc_value: BaseException | None,
+            traceback: TracebackType | None
+        ) -> None:
+        """Exit the context block."""
+        if self.snapshot is None:
+            return super().__exit__(exc_type, exc_value, traceback)
+        self.cursor.close()
+
+
+class SnapshotQueryBuilder(SqlQueryBuilder):
+    """Query builder that uses `SnapshotContext` by default."""
+    def __init__(self, *args, **kwargs) -> None:
+        kwargs.setdefault('context_manager', SnapshotContext)
+        super().__init__(*args, **kwargs)
@@ -0,0 +1,74 @@
+from hashlib import sha256
+from merkleasy import Tree
+from sqloquent.errors import tert, vert
+import packify
+
+
+def _payment_leaf(index: int, payment: tuple[str, str, int]) -> bytes:
+    return sha256(packify.pack((index, *payment))).digest()
+
+def _payments_tree(payments: list[tuple[str, str, int]]) -> Tree:
+    leaves = [_payment_leaf(i, p) for i, p in enumerate(payments)]
+    while len(leaves) < 2:
+        leaves = [b'\x00'*32, *leaves]
+    return Tree.from_leaves(leaves)
+
+def validate_payments(payments: list[tuple[str, str, int]]) -> None:
+    """Raises TypeError unless payments is a list of (payer ID, payee
+        ID, amount) tuples, or ValueError if any amount is not positive
+        or any payer is also the payee.
+    """
+    tert(type(payments) is list and all([
+            type(p) is tuple and len(p) == 3 and type(p[0]) is str and
+            type(p[1]) is str and type(p[2]) is int
+            for p in payments
+        ]), 'payments must be list[tuple[str, str, int]]')
+    vert(all([p[2] > 0 for p in payments]), 'payment amounts must be positive')
+    vert(all([p[0] != p[1] for p in payments]), 'payer and payee must differ')
+
+def net_payments(
+        payments: list[tuple[str, str, int]]
+    ) -> list[tuple[str, str, int]]:
+    """Nets a list of (payer ID, payee ID, amount) payments by pair of
+        Identities in a single pass, returning one (payer ID, payee ID,
+        net amount) tuple for each pair with a non-zero net position,
+        sorted by pair.
+    """
+    validate_payments(payments)
+    nets: dict[tuple[str, str], int] = {}
+    for payer, payee, amount in payments:
+        if payer < payee:
+            nets[(payer, payee)] = nets.get((payer, payee), 0) + amount
+        else:
+            nets[(payee, payer)] = nets.get((payee, payer), 0) - amount
+    return [
+        (a, b, net) if net > 0 else (b, a, -net)
+        for (a, b), net in sorted(nets.items())
+        if net != 0
+    ]
+
+def payments_root(payments: list[tuple[str, str, int]]) -> bytes:
+    """Returns the Merkle root committing to the full, ordered list of
+        netted payments.
+    """
+    validate_payments(payments)
+    return _payments_tree(payments).root
+
+def prove_payment(payments: list[tuple[str, str, int]], index: int) -> bytes:
+    """Proves that the payment at the given index is committed to in
+        the `payments_root` of the payments.
+    """
+    validate_payments(payments)
+    vert(0 <= index < len(payments), 'index out of range')
+    return _payments_tree(payments).prove(_payment_leaf(index, payments[index]))
+
+def verify_payment(
+        root: bytes, index: int, payment: tuple[str, str, int], proof: bytes
+    ) -> bool:
+    """Verifies that a payment at the given index is committed to in a
+        `payments_root`.
+    """
+    try:
+        return Tree.verify(root, _payment_leaf(index, payment), proof)
+    except Exception:
+        return False
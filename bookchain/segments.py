@@ -0,0 +1,288 @@
+from __future__ import annotations
+from bookchain.models.ArchivedEntry import ArchivedEntry
+from bookchain.models.ArchivedTransaction import ArchivedTransaction
+from merkleasy import Tree
+from mmap import mmap, ACCESS_READ
+from sqloquent.errors import tert, vert
+import os
+import packify
+import struct
+import zlib
+
+
+_magic = b'BCSEG\x02'
+
+
+class ArchiveSegment:
+    """An immutable, compressed segment file containing the archived
+        Transactions and Entries of a single TxRollup. The records are
+        written in chunks, and each column of each chunk is stored
+        separately as a zlib-compressed packify list, with the Entries
+        of each chunk sorted by account ID and indexed by account ID.
+        The tx_root of the TxRollup is stored in the trailing header
+        for verification. The file is memory-mapped for reads and
+        columns are only decompressed when accessed.
+    """
+    path: str
+    rollup_id: str
+    tx_root: str
+    txn_count: int
+    entry_count: int
+
+    def __init__(self, path: str) -> None:
+        """Open the segment file at the given path. Raises ValueError
+            if the file is not a valid segment file.
+        """
+        tert(type(path) is str, 'path must be str')
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap(self._file.fileno(), 0, access=ACCESS_READ)
+            vert(self._mmap[:len(_magic)] == _magic, 'not a segment file')
+            end = len(self._mmap) - 4
+            header_size = struct.unpack('>I', self._mmap[end:])[0]
+            header: dict = packify.unpack(self._mmap[end - header_size:end])
+        except Exception:
+            self._file.close()
+            raise
+        self._columns: dict[str, list[tuple[int, int]]] = header['columns']
+        self._cache: dict[tuple[str, int], list|dict] = {}
+        self.rollup_id = header['rollup_id']
+        self.tx_root = header['tx_root']
+        self.txn_count = header['txn_count']
+        self.entry_count = header['entry_count']
+
+    def __enter__(self) -> ArchiveSegment:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the memory map and the underlying file."""
+        self._mmap.close()
+        self._file.close()
+
+    @staticmethod
+    def filename(rollup_id: str) -> str:
+        """Returns the file name of the segment for a TxRollup ID."""
+        return f'{rollup_id}.seg'
+
+    @classmethod
+    def write(
+            cls, directory: str, rollup_id: str, tx_root: str,
+            transactions: list[dict], entries: list[dict]
+        ) -> ArchiveSegment:
+        """Writes the transaction and entry records (dicts of the
+            ArchivedTransaction and ArchivedEntry columns) of a TxRollup
+            to a new segment file in the directory as a single chunk and
+            returns the opened ArchiveSegment. If the segment already
+            exists, it is opened instead: segments are never rewritten.
+            Use `SegmentWriter` to write the records in chunks.
+        """
+        tert(type(directory) is str, 'directory must be str')
+        path = os.path.join(directory, cls.filename(rollup_id))
+        if os.path.exists(path):
+            return cls(path)
+        writer = SegmentWriter(directory, rollup_id, tx_root)
+        writer.add(transactions, entries)
+        return writer.finish()
+
+    @property
+    def chunk_count(self) -> int:
+        """The number of chunks in the segment."""
+        return len(self._columns['txn.id'])
+
+    def _chunk(self, name: str, chunk: int) -> list|dict:
+        """Returns the decompressed values of a column of a chunk."""
+        if (name, chunk) not in self._cache:
+            offset, size = self._columns[name][chunk]
+            self._cache[(name, chunk)] = packify.unpack(
+                zlib.decompress(self._mmap[offset:offset + size])
+            )
+        return self._cache[(name, chunk)]
+
+    def column(self, name: str) -> list|dict:
+        """Returns the decompressed values of a column of all chunks,
+            e.g. 'entry.amount' or 'txn.id'. Raises ValueError for
+            unknown column.
+        """
+        vert(name in self._columns, 'unknown column')
+        if name == 'index.account_id':
+            return self._chunk(name, 0)
+        return [
+            value
+            for chunk in range(len(self._columns[name]))
+            for value in self._chunk(name, chunk)
+        ]
+
+    def entries(self, account_id: str|None = None) -> list[dict]:
+        """Returns the archived entry records, optionally only those
+            for the given account ID using the account ID index, which
+            only decompresses the chunks containing the account's
+            entries.
+        """
+        if account_id is None:
+            ranges = [
+                (chunk, 0, len(self._chunk('entry.id', chunk)))
+                for chunk in range(self.chunk_count)
+            ]
+        else:
+            ranges = self.column('index.account_id').get(account_id, [])
+        entries = []
+        for chunk, start, end in ranges:
+            columns = {
+                c: self._chunk(f'entry.{c}', chunk) for c in ArchivedEntry.columns
+            }
+            entries.extend([
+                {c: columns[c][i] for c in ArchivedEntry.columns}
+                for i in range(start, end)
+            ])
+        return entries
+
+    def transactions(self) -> list[dict]:
+        """Returns the archived transaction records."""
+        transactions = []
+        for chunk in range(self.chunk_count):
+            transactions.extend(self._chunk_transactions(chunk))
+        return transactions
+
+    def _chunk_transactions(self, chunk: int) -> list[dict]:
+        """Returns the archived transaction records of a chunk."""
+        columns = {
+            c: self._chunk(f'txn.{c}', chunk) for c in ArchivedTransaction.columns
+        }
+        return [
+            {c: columns[c][i] for c in ArchivedTransaction.columns}
+            for i in range(len(columns['id']))
+        ]
+
+    def verify(self, tx_root: str|None = None) -> bool:
+        """Verifies the content of the segment one chunk at a time:
+            each archived transaction and entry ID must match the hash
+            of its record, the entries must be exactly those referenced
+            by the transactions, and the Merkle root of the transaction
+            IDs must match the tx_root stored in the segment and, if
+            provided, the given tx_root of the TxRollup.
+        """
+        if tx_root is not None and tx_root != self.tx_root:
+            return False
+        txn_ids = []
+        entry_ids = set()
+        referenced = set()
+        for chunk in range(self.chunk_count):
+            for txn in self._chunk_transactions(chunk):
+                if ArchivedTransaction.generate_id({**txn}) != txn['id']:
+                    return False
+                txn_ids.append(txn['id'])
+                referenced.update(e for e in (txn['entry_ids'] or '').split(',') if e)
+            columns = {
+                c: self._chunk(f'entry.{c}', chunk) for c in ArchivedEntry.columns
+            }
+            for i in range(len(columns['id'])):
+                entry = {c: columns[c][i] for c in ArchivedEntry.columns}
+                if ArchivedEntry.generate_id({**entry}) != entry['id']:
+                    return False
+                entry_ids.add(entry['id'])
+            # release the decompressed chunk
+            self._cache = {k: v for k, v in self._cache.items() if k[1] != chunk}
+        if entry_ids != referenced:
+            return False
+        if len(txn_ids) != self.txn_count or len(entry_ids) != self.entry_count:
+            return False
+        leaves = [bytes.fromhex(txn_id) for txn_id in sorted(txn_ids)]
+        while len(leaves) < 2:
+            leaves = [b'\x00'*32, *leaves]
+        return Tree.from_leaves(leaves).root.hex() == self.tx_root
+
+
+class SegmentWriter:
+    """Writes the records of a TxRollup to a new ArchiveSegment file one
+        chunk at a time, so the records never have to be held in memory
+        all at once. The file is written to a temporary path and renamed
+        by `finish`, so a segment file is never partially written.
+    """
+    path: str
+    rollup_id: str
+    tx_root: str
+
+    def __init__(self, directory: str, rollup_id: str, tx_root: str) -> None:
+        """Start writing the segment of the TxRollup in the directory.
+            Raises TypeError for invalid arguments or ValueError if the
+            segment already exists: segments are never rewritten.
+        """
+        tert(type(directory) is str, 'directory must be str')
+        tert(type(rollup_id) is str and type(tx_root) is str,
+            'rollup_id and tx_root must be str')
+        self.path = os.path.join(directory, ArchiveSegment.filename(rollup_id))
+        vert(not os.path.exists(self.path), 'segment already exists')
+        self.rollup_id = rollup_id
+        self.tx_root = tx_root
+        self._columns: dict[str, list[tuple[int, int]]] = {
+            **{f'entry.{c}': [] for c in ArchivedEntry.columns},
+            **{f'txn.{c}': [] for c in ArchivedTransaction.columns},
+        }
+        self._index: dict[str, list[tuple[int, int, int]]] = {}
+        self._txn_count = 0
+        self._entry_count = 0
+        self._file = open(f'{self.path}.tmp', 'wb')
+        self._file.write(_magic)
+        self._offset = len(_magic)
+
+    def _write_blob(self, values: list|dict) -> tuple[int, int]:
+        """Writes a compressed column blob and returns its offset and
+            size.
+        """
+        blob = zlib.compress(packify.pack(values))
+        self._file.write(blob)
+        position = (self._offset, len(blob))
+        self._offset += len(blob)
+        return position
+
+    def add(self, transactions: list[dict], entries: list[dict]) -> None:
+        """Writes a chunk of transaction and entry records (dicts of the
+            ArchivedTransaction and ArchivedEntry columns).
+        """
+        chunk = len(self._columns['txn.id'])
+        transactions = sorted(transactions, key=lambda t: t['id'])
+        entries = sorted(entries, key=lambda e: (e['account_id'], e['id']))
+        for i, entry in enumerate(entries):
+            ranges = self._index.setdefault(entry['account_id'], [])
+            if ranges and ranges[-1][0] == chunk:
+                ranges[-1] = (chunk, ranges[-1][1], i + 1)
+            else:
+                ranges.append((chunk, i, i + 1))
+
+        for c in ArchivedEntry.columns:
+            self._columns[f'entry.{c}'].append(
+                self._write_blob([e.get(c, None) for e in entries])
+            )
+        for c in ArchivedTransaction.columns:
+            self._columns[f'txn.{c}'].append(
+                self._write_blob([t.get(c, None) for t in transactions])
+            )
+        self._txn_count += len(transactions)
+        self._entry_count += len(entries)
+
+    def finish(self) -> ArchiveSegment:
+        """Writes the account ID index and the header, renames the file
+            into place, and returns the opened ArchiveSegment.
+        """
+        self._columns['index.account_id'] = [self._write_blob(self._index)]
+        header = packify.pack({
+            'rollup_id': self.rollup_id,
+            'tx_root': self.tx_root,
+            'txn_count': self._txn_count,
+            'entry_count': self._entry_count,
+            'columns': self._columns,
+        })
+        self._file.write(header + struct.pack('>I', len(header)))
+        self._file.close()
+        os.replace(f'{self.path}.tmp', self.path)
+        return ArchiveSegment(self.path)
+
+    def abort(self) -> None:
+        """Closes and removes the partially written file."""
+        self._file.close()
+        if os.path.exists(f'{self.path}.tmp'):
+            os.remove(f'{self.path}.tmp')
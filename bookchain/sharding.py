@@ -0,0 +1,216 @@
+from __future__ import annotations
+from bookchain.helpers import DEFAULT_PRAGMAS, _pragma_statements
+from hashlib import sha256
+from sqloquent.errors import tert, vert
+import re
+
+
+SHARDED_TABLES: dict[str, str] = {
+    'ledgers': 'id',
+    'accounts': 'ledger_id',
+    'entries': 'account_id',
+    'transactions': 'ledger_ids',
+    'txn_rollups': 'ledger_id',
+    'archived_entries': 'account_id',
+    'archived_transactions': 'ledger_ids',
+}
+"""The tables stored in the shard of a Ledger, mapped to the column
+    that identifies the Ledger: the Ledger ID, the ID of an Account of
+    the Ledger, or the comma-separated Ledger IDs of a Transaction.
+"""
+
+SHARD_PRAGMAS: dict[str, int|str] = {
+    **DEFAULT_PRAGMAS,
+    'journal_mode': 'truncate',
+    'synchronous': 'full',
+}
+
+_write_sql = re.compile(
+    r'^\s*(insert(?:\s+or\s+\w+)?\s+into|update(?:\s+or\s+\w+)?|delete\s+from)'
+    r'\s+(["`\[]?(\w+)["`\]]?)(?:\s*\(([^)]*)\))?',
+    re.IGNORECASE
+)
+
+_where_sql = re.compile(r'\swhere\s', re.IGNORECASE)
+
+
+class ShardMap:
+    """Maps each Ledger to one of several shard database files by its
+        ID, with the other models stored in a home database file. A
+        connection to the home database attaches each shard as schema
+        `s{index}` and shadows each of the `SHARDED_TABLES` with a
+        temporary view of the `union all` of the table in the home
+        database and every shard, so reads span all shards. Writes to
+        those tables are rewritten to the schema of the Ledger of each
+        row (rows without a Ledger stay in the home database), and
+        updates and deletes are run only in the schemas of the rows
+        matched by their where clause. A Transaction (or
+        ArchivedTransaction) is stored once, in the shard of its first
+        Ledger, and its Entries in the shards of their Accounts.
+
+        Writes to several shards in one database transaction are
+        committed atomically by SQLite's two-phase commit across
+        attached databases: in the first phase, the rollback journal of
+        every modified database is written and synced along with a
+        super-journal naming them; the commit point is the deletion of
+        the super-journal; and on recovery, a hot journal whose
+        super-journal still exists is rolled back while one whose
+        super-journal is gone is discarded. This requires a rollback
+        journal_mode (delete, truncate, or persist) on every database.
+        WAL is therefore not supported: in WAL mode each database
+        commits on its own, so a crash could persist a Transaction in
+        one shard but not its Entries in another. Writers to different
+        shards still commit in parallel, since a write only locks the
+        files it modifies, but a commit waits (up to busy_timeout) for
+        readers of its shard, and `Snapshot`s refuse sharded databases.
+    """
+    home: str
+    shards: tuple[str, ...]
+    assignments: dict[str, int]
+    pragmas: dict[str, int|str]
+
+    def __init__(
+            self, home: str, shards: list[str],
+            assignments: dict[str, int]|None = None,
+            pragmas: dict[str, int|str]|None = None
+        ) -> None:
+        """Ledgers are assigned to a shard by the index in assignments
+            or else by the hash of their ID. The pragmas (default
+            `SHARD_PRAGMAS`) are applied to every database. Raises
+            TypeError or ValueError for invalid arguments.
+        """
+        tert(type(home) is str, 'home must be str')
+        tert(type(shards) in (list, tuple) and all([type(s) is str for s in shards]),
+            'shards must be list[str]')
+        vert(len(shards) > 0, 'shards must not be empty')
+        paths = [home, *shards]
+        vert(all([p not in ('', ':memory:') for p in paths]),
+            'home and shards must be database file paths')
+        vert(len(set(paths)) == len(paths), 'home and shards must be distinct')
+        assignments = assignments or {}
+        tert(type(assignments) is dict and all([
+                type(k) is str and type(v) is int for k, v in assignments.items()
+            ]), 'assignments must be dict[str, int]')
+        vert(all([0 <= v < len(shards) for v in assignments.values()]),
+            'assignments must be valid shard indices')
+        pragmas = {**SHARD_PRAGMAS} if pragmas is None else {**pragmas}
+        _pragma_statements(pragmas)
+        vert(str(pragmas.get('journal_mode', 'delete')).lower() in
+            ('delete', 'truncate', 'persist'),
+            'sharding requires a rollback journal_mode (delete, truncate, or persist)')
+        self.home = home
+        self.shards = tuple(shards)
+        self.assignments = {**assignments}
+        self.pragmas = pragmas
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, ShardMap) and (
+            self.home, self.shards, self.assignments, self.pragmas
+        ) == (
+            other.home, other.shards, other.assignments, other.pragmas
+        )
+
+    @property
+    def files(self) -> list[str]:
+        """The home and shard database file paths, e.g. for migrating."""
+        return [self.home, *self.shards]
+
+    @property
+    def schemas(self) -> list[str]:
+        """The schema names of the home database and the shards."""
+        return ['main', *[f's{i}' for i in range(len(self.shards))]]
+
+    def shard_index(self, ledger_id: str) -> int:
+        """Returns the index of the shard of the Ledger."""
+        tert(type(ledger_id) is str, 'ledger_id must be str')
+        if ledger_id in self.assignments:
+            return self.assignments[ledger_id]
+        digest = sha256(ledger_id.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % len(self.shards)
+
+    def shard_for(self, ledger_id: str) -> str:
+        """Returns the database file path of the shard of the Ledger."""
+        return self.shards[self.shard_index(ledger_id)]
+
+    def schema_for(self, ledger_id: str|None) -> str:
+        """Returns the schema name of the shard of the Ledger, or 'main'
+            for rows without a Ledger.
+        """
+        return f's{self.shard_index(ledger_id)}' if ledger_id else 'main'
+
+    def setup_statements(self, tables: list[str]) -> list[str]:
+        """Returns the statements that attach the shards, apply the
+            pragmas to every schema, and create the views of the
+            sharded tables that exist in the home database.
+        """
+        statements = [
+            f"attach database '{path.replace(chr(39), chr(39)*2)}' as s{i}"
+            for i, path in enumerate(self.shards)
+        ]
+        for schema in self.schemas:
+            statements.extend([
+                s.replace('pragma ', f'pragma {schema}.', 1)
+                for s in _pragma_statements(self.pragmas)
+            ])
+        for table in SHARDED_TABLES:
+            if table not in tables:
+                continue
+            union = ' union all '.join([
+                f'select * from {schema}.{table}' for schema in self.schemas
+            ])
+            statements.append(f'create temp view if not exists {table} as {union}')
+        return statements
+
+    @staticmethod
+    def parse(sql: str) -> tuple[str, str, list[str]|None]|None:
+        """Parses a write statement to a sharded table, returning the
+            kind ('insert', 'update', or 'delete'), the table, and the
+            inserted columns if listed; returns None for other
+            statements.
+        """
+        match = _write_sql.match(sql)
+        if match is None or match.group(3) not in SHARDED_TABLES:
+            return None
+        kind = match.group(1).split()[0].lower()
+        columns = None
+        if kind == 'insert' and match.group(4) is not None:
+            columns = [c.strip().strip('"`[]') for c in match.group(4).split(',')]
+        return (kind, match.group(3), columns)
+
+    @staticmethod
+    def routing_sql(sql: str) -> tuple[str, int]|None:
+        """Takes an update or delete statement of a sharded table and
+            returns a query of the column that identifies the Ledger of
+            the rows it matches and the number of parameters that come
+            before its where clause, or None if it has no where clause.
+        """
+        match = _write_sql.match(sql)
+        where = _where_sql.search(sql, match.end())
+        if where is None:
+            return None
+        table = match.group(3)
+        return (
+            f'select {SHARDED_TABLES[table]} from {table} where {sql[where.end():]}',
+            sql[:where.start()].count('?'),
+        )
+
+    @staticmethod
+    def qualify(sql: str, schema: str) -> str:
+        """Rewrites the table of a write statement to be in the schema."""
+        match = _write_sql.match(sql)
+        return f'{sql[:match.start(2)]}{schema}.{match.group(3)}{sql[match.end(2):]}'
+
+    def schema_for_row(
+            self, table: str, row: dict, account_ledgers: dict[str, str]
+        ) -> str:
+        """Returns the schema of an inserted row of a sharded table.
+            The account_ledgers must map the IDs of the Accounts of rows
+            that refer to an Account to their Ledger IDs.
+        """
+        column = SHARDED_TABLES[table]
+        value = row.get(column)
+        if column == 'account_id':
+            value = account_ledgers.get(value)
+        elif column == 'ledger_ids':
+            value = value.split(',')[0] if value else None
+        return self.schema_for(value)
@@ -1,13 +1,17 @@
 from asyncio import run
-from context import asyncql
+import asyncio
+from context import asyncql, clearing, netting
+from bookchain.asyncql import concurrency
 from genericpath import isfile
 from nacl.signing import SigningKey
 from packify import pack
 from time import time
 import os
+import sqlite3
 import sqloquent.asyncql
 import sqloquent.tools
 import tapescript
+import threading
 import unittest
 
 
@@ -24,6 +28,7 @@ class TestCorrespondencesE2E(unittest.TestCase):
             asyncql.Identity, asyncql.Currency, asyncql.Ledger,
             asyncql.Account, asyncql.Entry, asyncql.Transaction,
             asyncql.Correspondence,
+            asyncql.TxRollupHead,
         ]
         for model in tomigrate:
             name = model.__name__
@@ -39,6 +44,7 @@ class TestCorrespondencesE2E(unittest.TestCase):
         asyncql.Correspondence.connection_info = DB_FILEPATH
         asyncql.Ledger.connection_info = DB_FILEPATH
         asyncql.Account.connection_info = DB_FILEPATH
+        asyncql.TxRollupHead.connection_info = DB_FILEPATH
         asyncql.Entry.connection_info = DB_FILEPATH
         asyncql.Transaction.connection_info = DB_FILEPATH
         sqloquent.asyncql.AsyncDeletedModel.connection_info = DB_FILEPATH
@@ -53,6 +59,7 @@ class TestCorrespondencesE2E(unittest.TestCase):
         run(asyncql.Account.query().delete())
         run(asyncql.Entry.query().delete())
         run(asyncql.Transaction.query().delete())
+        run(asyncql.TxRollupHead.query().delete())
         run(sqloquent.asyncql.AsyncDeletedModel.query().delete())
         self.setup_cryptographic_values()
         super().setUp()
@@ -100,6 +107,69 @@ class TestCorrespondencesE2E(unittest.TestCase):
             [self.pkey_alice, self.pkey_bob], 2
         ).bytes
 
+    def setup_currency(self) -> asyncql.Currency:
+        return run(asyncql.Currency.insert({
+            'name': 'Median Human Hour',
+            'prefix_symbol': 'Ħ',
+            'fx_symbol': 'MHH',
+            'base': 60,
+            'unit_divisions': 2,
+        }))
+
+    def setup_party(
+            self, currency: asyncql.Currency, name: str, seed: bytes, pkey: bytes
+        ) -> tuple[asyncql.Identity, asyncql.Ledger]:
+        identity = run(asyncql.Identity.insert({'name': name, 'pubkey': pkey, 'seed': seed}))
+        ledger = run(asyncql.Ledger.insert({
+            'name': 'Current Ledger',
+            'identity_id': identity.id,
+            'currency_id': currency.id,
+        }))
+        for acct in ledger.setup_basic_accounts():
+            run(acct.save())
+        return identity, ledger
+
+    def link_parties(
+            self, parties: list[tuple[asyncql.Identity, asyncql.Ledger, bytes]],
+            details: dict|None = None
+        ) -> asyncql.Correspondence:
+        locking_scripts = {identity.id: lock for identity, _, lock in parties}
+        correspondence: asyncql.Correspondence = run(asyncql.Correspondence.insert({
+            'identity_ids': ','.join(sorted([i.id for i, _, _ in parties])),
+            'ledger_ids': ','.join(sorted([l.id for _, l, _ in parties])),
+            'details': pack({'locking_scripts': locking_scripts, **(details or {})}),
+        }))
+        cor_accts = run(correspondence.setup_accounts(locking_scripts))
+        for accts in cor_accts.values():
+            for acct in accts.values():
+                run(acct.save())
+        return correspondence
+
+    def setup_correspondence(self) -> tuple[asyncql.Identity, asyncql.Identity, asyncql.Correspondence]:
+        currency = self.setup_currency()
+        alice, ledger_alice = self.setup_party(
+            currency, 'Alice', self.seed_alice, self.pkey_alice
+        )
+        bob, ledger_bob = self.setup_party(
+            currency, 'Bob', self.seed_bob, self.pkey_bob
+        )
+        correspondence = self.link_parties([
+            (alice, ledger_alice, self.locking_script_alice),
+            (bob, ledger_bob, self.locking_script_bob),
+        ])
+        return alice, bob, correspondence
+
+    def sign_entries(
+            self, entries: list[asyncql.Entry], seed: bytes, committed_script
+        ) -> dict[str, bytes]:
+        return {
+            e.account_id: tapescript.tools.make_taproot_witness_keyspend(
+                seed, e.get_sigfields(entries=entries), committed_script
+            ).bytes
+            for e in entries
+            if e.account.locking_scripts and e.type in e.account.locking_scripts
+        }
+
     def test_e2e(self):
         assert run(asyncql.Account.query().count()) == 0
 
@@ -683,5 +753,665 @@ class TestCorrespondencesE2E(unittest.TestCase):
         assert balances[bob.id] == 200, balances
 
 
+    def test_settle_payments_e2e(self):
+        alice, bob, correspondence = self.setup_correspondence()
+        payments = [
+            (alice.id, bob.id, 100),
+            (bob.id, alice.id, 30),
+            (alice.id, bob.id, 50),
+            (bob.id, alice.id, 20),
+        ]
+        assert netting.net_payments(payments) == [(alice.id, bob.id, 100)]
+
+        settlements = run(correspondence.settle_payments(payments, os.urandom(16)))
+        assert len(settlements) == 1
+        entries, _, details = settlements[0]
+        assert all([e.amount == 100 for e in entries])
+        assert details['payments_count'] == (4).to_bytes(8, 'big')
+        txn = run(asyncql.Transaction.prepare(
+            entries, str(time()), details=details,
+            auth_scripts=self.sign_entries(entries, self.seed_alice, self.committed_script_alice)
+        ))
+        run(txn.save())
+        balances = run(correspondence.balances())
+        assert balances[alice.id] == -100, balances
+        assert balances[bob.id] == 100, balances
+
+        # every netted payment can be proven against the committed root
+        root = txn.details['payments_root']
+        for i, payment in enumerate(payments):
+            proof = netting.prove_payment(payments, i)
+            assert netting.verify_payment(root, i, payment, proof)
+            assert not netting.verify_payment(root, i, (alice.id, bob.id, 1), proof)
+
+        # offsetting payments net to nothing
+        assert run(correspondence.settle_payments(
+            [(alice.id, bob.id, 5), (bob.id, alice.id, 5)], os.urandom(16)
+        )) == []
+        with self.assertRaises(ValueError) as e:
+            run(correspondence.settle_payments([(alice.id, alice.id, 5)], os.urandom(16)))
+        assert str(e.exception) == 'payer and payee must differ'
+        with self.assertRaises(ValueError) as e:
+            run(correspondence.settle_payments([(alice.id, correspondence.id, 5)], os.urandom(16)))
+        assert str(e.exception) == 'all payers and payees must be correspondence identities'
+        with self.assertRaises(TypeError) as e:
+            run(correspondence.settle_payments([(alice.id, bob.id, '5')], os.urandom(16)))
+
+
+    def test_balances_aggregate_e2e(self):
+        alice, bob, correspondence = self.setup_correspondence()
+        assert run(correspondence.balances()) == {alice.id: 0, bob.id: 0}
+        for payer, payee, amount in ((alice, bob, 70), (bob, alice, 20)):
+            entries, _ = run(correspondence.pay_correspondent(
+                payer, payee, amount, os.urandom(16)
+            ))
+            seed, committed_script = {
+                alice.id: (self.seed_alice, self.committed_script_alice),
+                bob.id: (self.seed_bob, self.committed_script_bob),
+            }[payer.id]
+            txn = run(asyncql.Transaction.prepare(
+                entries, str(time()),
+                auth_scripts=self.sign_entries(entries, seed, committed_script)
+            ))
+            run(txn.save())
+
+        balances = run(correspondence.balances())
+        assert balances == {alice.id: -50, bob.id: 50}, balances
+
+        # matches the per-Account tally
+        accts = run(correspondence.get_accounts())
+        for identity_id, by_type in accts.items():
+            nostro = run(by_type[asyncql.AccountType.NOSTRO_ASSET].balance())
+            vostro = run(by_type[asyncql.AccountType.VOSTRO_LIABILITY].balance())
+            assert balances[identity_id] == nostro - vostro
+
+        # rolled up balances are used as starting balances
+        nostro_alice = accts[alice.id][asyncql.AccountType.NOSTRO_ASSET]
+        vostro_bob = accts[bob.id][asyncql.AccountType.VOSTRO_LIABILITY]
+        balances = run(correspondence.balances({
+            nostro_alice.id: (asyncql.EntryType.DEBIT, 5),
+            vostro_bob.id: (asyncql.EntryType.CREDIT, 5),
+        }))
+        assert balances == {alice.id: -45, bob.id: 45}, balances
+
+    def test_get_accounts_cache_e2e(self):
+        alice, bob, correspondence = self.setup_correspondence()
+        accts = run(correspondence.get_accounts())
+        assert all([len(a) == 3 for a in accts.values()])
+        equity_alice = accts[alice.id][asyncql.AccountType.EQUITY]
+        assert equity_alice.name.startswith('General Equity')
+
+        # setup_accounts stored the IDs of the equity Accounts
+        equity_bob = accts[bob.id][asyncql.AccountType.EQUITY]
+        assert correspondence.equity_account_ids == ','.join(
+            sorted([equity_alice.id, equity_bob.id])
+        )
+
+        # the loaded map is kept on the instance until reload=True
+        nostro_alice = accts[alice.id][asyncql.AccountType.NOSTRO_ASSET]
+        run(nostro_alice.delete())
+        assert run(correspondence.get_accounts())[alice.id][asyncql.AccountType.NOSTRO_ASSET].id == nostro_alice.id
+        assert asyncql.AccountType.NOSTRO_ASSET not in run(correspondence.get_accounts(reload=True))[alice.id]
+        run(nostro_alice.save())
+        assert asyncql.AccountType.NOSTRO_ASSET in run(correspondence.get_accounts(reload=True))[alice.id]
+
+        # other instances do not share the map
+        other = run(asyncql.Correspondence.find(correspondence.id))
+        assert '_accounts' not in other.__dict__
+        assert run(other.get_accounts())[alice.id][asyncql.AccountType.NOSTRO_ASSET].id == nostro_alice.id
+
+        # equity Accounts are looked up by the stored IDs, not by name
+        custom_equity = run(asyncql.Account.insert({
+            'name': 'Owner Capital',
+            'type': asyncql.AccountType.EQUITY.value,
+            'ledger_id': equity_alice.ledger_id,
+        }))
+        run(correspondence.update({
+            'equity_account_ids': ','.join(sorted([custom_equity.id, equity_bob.id])),
+        }))
+        correspondence = run(asyncql.Correspondence.find(other.id))
+        assert correspondence is not None
+        accts = run(correspondence.get_accounts())
+        assert accts[alice.id][asyncql.AccountType.EQUITY].id == custom_equity.id
+        assert accts[bob.id][asyncql.AccountType.EQUITY].id == equity_bob.id
+
+    def test_setup_many_e2e(self):
+        currency = self.setup_currency()
+        parties = [
+            self.setup_party(currency, name, seed, pkey)
+            for name, seed, pkey in (
+                ('Alice', self.seed_alice, self.pkey_alice),
+                ('Bob', self.seed_bob, self.pkey_bob),
+                ('Charlie', self.seed_charlie, self.pkey_charlie),
+            )
+        ]
+        (alice, ledger_alice), (bob, ledger_bob), (charlie, ledger_charlie) = parties
+        locking_scripts = {
+            alice.id: self.locking_script_alice,
+            bob.id: self.locking_script_bob,
+            charlie.id: self.locking_script_alice,
+        }
+        groups = [
+            [ledger_alice, ledger_bob],
+            [ledger_bob, ledger_charlie],
+            [ledger_alice, ledger_bob, ledger_charlie],
+        ]
+        accounts_before = run(asyncql.Account.query().count())
+        correspondences = run(asyncql.Correspondence.setup_many(
+            groups, locking_scripts, {'txru_lock': self.multisig_lock}
+        ))
+        assert len(correspondences) == 3
+        assert run(asyncql.Correspondence.query().count()) == 3
+        # 2 accounts for each ordered pair of Identities
+        assert run(asyncql.Account.query().count()) == accounts_before + 4 + 4 + 12
+
+        cor_ab = run(asyncql.Correspondence.find(correspondences[0].id))
+        assert cor_ab.details['txru_lock'] == self.multisig_lock
+        equity_ids = [
+            run(asyncql.Account.query().equal('ledger_id', l.id).starts_with(
+                name='General Equity'
+            ).first()).id
+            for l in (ledger_alice, ledger_bob)
+        ]
+        assert cor_ab.equity_account_ids == ','.join(sorted(equity_ids))
+        assert cor_ab.details['locking_scripts'] == {
+            alice.id: self.locking_script_alice, bob.id: self.locking_script_bob
+        }
+        accts = run(cor_ab.get_accounts())
+        nostro = accts[alice.id][asyncql.AccountType.NOSTRO_ASSET]
+        assert nostro.details == bob.id
+        assert nostro.locking_scripts == {
+            asyncql.EntryType.CREDIT: self.locking_script_alice,
+            asyncql.EntryType.DEBIT: self.locking_script_bob,
+        }
+        assert all([len(a) == 3 for a in accts.values()])
+
+        # rerunning the onboarding does not duplicate anything
+        run(asyncql.Correspondence.setup_many(
+            groups, locking_scripts, {'txru_lock': self.multisig_lock}
+        ))
+        assert run(asyncql.Correspondence.query().count()) == 3
+        assert run(asyncql.Account.query().count()) == accounts_before + 20
+
+        with self.assertRaises(ValueError) as e:
+            run(asyncql.Correspondence.setup_many([[ledger_alice]], locking_scripts))
+        assert 'at least 2' in str(e.exception)
+        with self.assertRaises(ValueError) as e:
+            run(asyncql.Correspondence.setup_many(
+                [[ledger_alice, ledger_bob]], {alice.id: self.locking_script_alice}
+            ))
+        assert 'missing locking script' in str(e.exception)
+        with self.assertRaises(TypeError) as e:
+            run(asyncql.Correspondence.setup_many([[alice]], locking_scripts))
+
+    def test_load_correspondents_e2e(self):
+        currency = self.setup_currency()
+        (alice, ledger_alice), (bob, ledger_bob), (charlie, ledger_charlie) = [
+            self.setup_party(currency, name, seed, pkey)
+            for name, seed, pkey in (
+                ('Alice', self.seed_alice, self.pkey_alice),
+                ('Bob', self.seed_bob, self.pkey_bob),
+                ('Charlie', self.seed_charlie, self.pkey_charlie),
+            )
+        ]
+        run(asyncql.Correspondence.setup_many(
+            [[ledger_alice, ledger_bob], [ledger_alice, ledger_charlie]],
+            {
+                alice.id: self.locking_script_alice,
+                bob.id: self.locking_script_bob,
+                charlie.id: self.locking_script_bob,
+            }
+        ))
+
+        correspondents = run(alice.correspondents(reload=True))
+        assert sorted([i.id for i in correspondents]) == sorted([bob.id, charlie.id])
+        assert [i.id for i in run(bob.correspondents(reload=True))] == [alice.id]
+
+        loaded = run(alice.load_correspondents())
+        assert set(loaded) == set([bob.id, charlie.id])
+        for counterparty_id, (identity, accounts) in loaded.items():
+            assert identity.id == counterparty_id
+            assert len(accounts) == 4
+            assert sorted([a.type.value for a in accounts]) == sorted([
+                asyncql.AccountType.NOSTRO_ASSET.value, asyncql.AccountType.NOSTRO_ASSET.value,
+                asyncql.AccountType.VOSTRO_LIABILITY.value, asyncql.AccountType.VOSTRO_LIABILITY.value,
+            ])
+            assert set([a.details for a in accounts]) == set([alice.id, counterparty_id])
+
+        # matches the lazy per-correspondent lookup
+        lazy = run(alice.get_correspondent_accounts(bob))
+        assert sorted([a.id for a in lazy]) == sorted([a.id for a in loaded[bob.id][1]])
+
+    def test_concurrent_loading_e2e(self):
+        # gather_limited keeps the order and bounds the concurrency
+        running, peak = [0], [0]
+        async def task(i: int) -> int:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            await asyncio.sleep(0.001)
+            running[0] -= 1
+            return i
+        assert run(concurrency.gather_limited(*[task(i) for i in range(10)], limit=3)) == list(range(10))
+        assert peak[0] == 3
+        peak[0] = 0
+        assert run(concurrency.gather_limited(*[task(i) for i in range(5)])) == list(range(5))
+        assert peak[0] == concurrency.get_concurrency_limit() == 1
+
+        alice, bob, correspondence = self.setup_correspondence()
+        txn_ids = []
+        for amount in (10, 20, 30):
+            entries, _ = run(correspondence.pay_correspondent(alice, bob, amount, os.urandom(16)))
+            txn = run(asyncql.Transaction.prepare(
+                entries, str(time()),
+                auth_scripts=self.sign_entries(
+                    entries, self.seed_alice, self.committed_script_alice
+                )
+            ))
+            run(txn.save())
+            txn_ids.append(txn.id)
+
+        # batched loading matches the per-Transaction relation reloads
+        txns = [run(asyncql.Transaction.find(i)) for i in txn_ids]
+        run(asyncql.Transaction.load_entries(txns, load_accounts=True))
+        for txn in txns:
+            loaded = sorted([(e.id, e.account.id) for e in txn.entries])
+            run(txn.entries().reload())
+            assert loaded == sorted([(e.id, e.account_id) for e in txn.entries])
+            assert run(txn.validate(reload=True))
+
+    def test_connection_pool_e2e(self):
+        asyncql.set_connection_info(DB_FILEPATH, pool_size=3)
+        pool = asyncql.pool.get_pool(DB_FILEPATH)
+        try:
+            assert concurrency.get_concurrency_limit() == 3
+            assert asyncql.Account.query_builder_class is asyncql.AsyncPooledQueryBuilder
+
+            async def journal_mode():
+                async with asyncql.AsyncPooledContext(DB_FILEPATH) as cursor:
+                    await cursor.execute('pragma journal_mode')
+                    return (await cursor.fetchone())[0]
+            assert run(journal_mode()) == 'wal'
+
+            # concurrent readers are bounded by the pool size
+            counts = run(concurrency.gather_limited(*[
+                asyncql.Currency.query().count() for _ in range(10)
+            ]))
+            assert counts == [0] * 10
+            assert 0 < len(pool._idle) <= 3
+
+            # the queries overlap up to the pool size
+            running, peak = [0], [0]
+            async def count() -> int:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+                result = await asyncql.Currency.query().count()
+                running[0] -= 1
+                return result
+            assert run(concurrency.gather_limited(*[count() for _ in range(10)])) == [0] * 10
+            assert peak[0] == 3
+
+            # writes are visible within the context and rolled back on error
+            async def insert_then_fail():
+                async with asyncql.AsyncPooledContext(DB_FILEPATH):
+                    await asyncql.Currency.insert({
+                        'name': 'Test', 'prefix_symbol': 'T', 'fx_symbol': 'TST',
+                        'base': 100, 'unit_divisions': 1,
+                    })
+                    assert await asyncql.Currency.query({'fx_symbol': 'TST'}).count() == 1
+                    raise ValueError('rollback')
+            with self.assertRaises(ValueError):
+                run(insert_then_fail())
+            assert run(asyncql.Currency.query({'fx_symbol': 'TST'}).count()) == 0
+
+            alice, bob, correspondence = self.setup_correspondence()
+            entries, _ = run(correspondence.pay_correspondent(alice, bob, 100, os.urandom(16)))
+            txn = run(asyncql.Transaction.prepare(
+                entries, str(time()),
+                auth_scripts=self.sign_entries(
+                    entries, self.seed_alice, self.committed_script_alice
+                )
+            ))
+            run(txn.save())
+            balances = run(correspondence.balances())
+            assert balances[alice.id] == -100 and balances[bob.id] == 100, balances
+        finally:
+            asyncql.set_connection_info(DB_FILEPATH)
+            run(asyncql.close_pools())
+        assert pool._idle == [] and pool._writer is None
+        assert concurrency.get_concurrency_limit() == 1
+
+    def test_sharding_e2e(self):
+        shards = ['tests/shard0.db', 'tests/shard1.db']
+        self.automigrate()
+        for shard in shards:
+            sqloquent.tools.automigrate(MIGRATIONS_PATH, shard)
+
+        def count(path: str, table: str, column: str, value: str) -> int:
+            connection = sqlite3.connect(path)
+            try:
+                return connection.execute(
+                    f'select count(*) from {table} where {column} = ?', [value]
+                ).fetchone()[0]
+            finally:
+                connection.close()
+
+        asyncql.set_connection_info(DB_FILEPATH, shards=shards)
+        try:
+            assert concurrency.get_concurrency_limit() == 1
+            currency = self.setup_currency()
+            parties = [
+                (run(asyncql.Identity.insert({'name': name, 'pubkey': pkey, 'seed': seed})), lock)
+                for name, seed, pkey, lock in (
+                    ('Alice', self.seed_alice, self.pkey_alice, self.locking_script_alice),
+                    ('Bob', self.seed_bob, self.pkey_bob, self.locking_script_bob),
+                )
+            ]
+            alice, bob = parties[0][0], parties[1][0]
+
+            # assign the Ledgers to different shards
+            ledger_data = [
+                {'name': 'Current Ledger', 'identity_id': i.id, 'currency_id': currency.id}
+                for i, _ in parties
+            ]
+            ledger_ids = [asyncql.Ledger.generate_id({**d}) for d in ledger_data]
+            shard_map = asyncql.ShardMap(
+                DB_FILEPATH, shards, {ledger_ids[0]: 0, ledger_ids[1]: 1}
+            )
+            asyncql.set_connection_info(DB_FILEPATH, pool_size=2, shards=shard_map)
+            assert concurrency.get_concurrency_limit() == 2
+            ledgers = []
+            for data in ledger_data:
+                ledger = run(asyncql.Ledger.insert(data))
+                for acct in ledger.setup_basic_accounts():
+                    run(acct.save())
+                ledgers.append(ledger)
+            assert [l.id for l in ledgers] == ledger_ids
+            correspondence = self.link_parties([
+                (identity, ledger, lock)
+                for (identity, lock), ledger in zip(parties, ledgers)
+            ])
+
+            # each Ledger and its Accounts are stored only in its shard
+            for i, ledger in enumerate(ledgers):
+                assert count(shards[i], 'ledgers', 'id', ledger.id) == 1
+                assert count(shards[1-i], 'ledgers', 'id', ledger.id) == 0
+                assert count(DB_FILEPATH, 'ledgers', 'id', ledger.id) == 0
+                assert count(shards[i], 'accounts', 'ledger_id', ledger.id) == \
+                    run(asyncql.Account.query({'ledger_id': ledger.id}).count()) > 0
+            assert count(DB_FILEPATH, 'correspondences', 'id', correspondence.id) == 1
+            # reads span all shards
+            assert run(asyncql.Ledger.query().count()) == 2
+            assert set(run(correspondence.get_accounts(reload=True))) == {alice.id, bob.id}
+
+            async def save(txn: asyncql.Transaction, fail: bool = False):
+                async with asyncql.AsyncPooledContext(DB_FILEPATH):
+                    await txn.save()
+                    if fail:
+                        assert await asyncql.Transaction.query().count() == 2
+                        raise ValueError('rollback')
+
+            # a cross-shard Transaction is committed atomically
+            entries, _ = run(correspondence.pay_correspondent(alice, bob, 100, os.urandom(16)))
+            txn = run(asyncql.Transaction.prepare(
+                entries, str(time()),
+                auth_scripts=self.sign_entries(
+                    entries, self.seed_alice, self.committed_script_alice
+                )
+            ))
+            run(save(txn))
+            assert count(shard_map.shard_for(sorted(ledger_ids)[0]), 'transactions', 'id', txn.id) == 1
+            assert count(shard_map.shard_for(sorted(ledger_ids)[1]), 'transactions', 'id', txn.id) == 0
+            for entry in txn.entries:
+                assert count(shard_map.shard_for(entry.account.ledger_id), 'entries', 'id', entry.id) == 1
+            found = run(asyncql.Transaction.find(txn.id))
+            run(found.entries().reload())
+            assert {e.id for e in found.entries} == {e.id for e in entries}
+            balances = run(correspondence.balances())
+            assert balances[alice.id] == -100 and balances[bob.id] == 100, balances
+
+            # a failure rolls back the writes to every shard
+            entries, _ = run(correspondence.pay_correspondent(alice, bob, 50, os.urandom(16)))
+            txn2 = run(asyncql.Transaction.prepare(
+                entries, str(time()),
+                auth_scripts=self.sign_entries(
+                    entries, self.seed_alice, self.committed_script_alice
+                )
+            ))
+            with self.assertRaises(ValueError):
+                run(save(txn2, fail=True))
+            assert run(asyncql.Transaction.query().count()) == 1
+            for shard in shards:
+                for entry in txn2.entries:
+                    assert count(shard, 'entries', 'id', entry.id) == 0
+
+            # updates and deletes by id run only in the shard of the row
+            entry = txn.entries[0]
+            schema = shard_map.schema_for(entry.account.ledger_id)
+            statements = []
+            async def update_one() -> int:
+                async with asyncql.AsyncPooledContext(DB_FILEPATH) as cursor:
+                    await cursor._prepare(True)
+                    await cursor.connection.set_trace_callback(statements.append)
+                    try:
+                        return await asyncql.Entry.query({'id': entry.id}).update(
+                            {'description': 'routed'}
+                        )
+                    finally:
+                        await cursor.connection.set_trace_callback(None)
+            assert run(update_one()) == 1
+            updates = [s for s in statements if s.lower().startswith('update')]
+            assert len(updates) == 1 and f'{schema}.entries' in updates[0], updates
+            assert run(asyncql.Entry.find(entry.id)).description == 'routed'
+
+            # updates and deletes without a where clause reach every shard
+            n = len(txn.entries)
+            assert run(asyncql.Entry.query().update({'description': 'sharded'})) == n
+            assert run(asyncql.Entry.query({'description': 'sharded'}).count()) == n
+            assert run(asyncql.Entry.query().delete()) == n
+            assert run(asyncql.Entry.query().count()) == 0
+        finally:
+            asyncql.set_connection_info(DB_FILEPATH)
+            run(asyncql.close_pools())
+            for path in [*shards, *[f'{p}-journal' for p in [DB_FILEPATH, *shards]]]:
+                if isfile(path):
+                    os.remove(path)
+
+    def test_snapshot_e2e(self):
+        asyncql.set_connection_info(DB_FILEPATH, pool_size=2)
+        alice, bob, correspondence = self.setup_correspondence()
+
+        async def pay(amount: int) -> None:
+            entries, _ = await correspondence.pay_correspondent(alice, bob, amount, os.urandom(16))
+            txn = await asyncql.Transaction.prepare(
+                entries, str(time()),
+                auth_scripts=self.sign_entries(
+                    entries, self.seed_alice, self.committed_script_alice
+                )
+            )
+            await txn.save()
+
+        async def report(amount: int) -> tuple[dict, int, int]:
+            async with asyncql.AsyncSnapshot(DB_FILEPATH) as snapshot:
+                assert snapshot.connection is not None
+                # posting in another thread is not blocked or visible
+                thread = threading.Thread(target=lambda: run(pay(amount)))
+                thread.start()
+                thread.join()
+                balances, count = await asyncio.gather(
+                    correspondence.balances(),
+                    asyncql.Transaction.query().count(),
+                )
+                # writes fail within the snapshot
+                with self.assertRaises(sqlite3.OperationalError):
+                    await asyncql.Currency.insert({
+                        'name': 'Test', 'prefix_symbol': 'T', 'fx_symbol': 'TST',
+                        'base': 100, 'unit_divisions': 1,
+                    })
+            assert snapshot.connection is None
+            return balances, count, await asyncql.Transaction.query().count()
+
+        try:
+            run(pay(100))
+            balances, count, after = run(report(50))
+            assert balances[alice.id] == -100 and balances[bob.id] == 100, balances
+            assert count == 1 and after == 2
+
+            # models that do not use a pool only read through snapshots
+            # when opted in
+            asyncql.set_connection_info(DB_FILEPATH)
+            assert asyncql.Transaction.query_builder_class is sqloquent.asyncql.AsyncSqlQueryBuilder
+            async def unbound() -> tuple[int, int]:
+                async with asyncql.AsyncSnapshot(DB_FILEPATH):
+                    before = await asyncql.Transaction.query().count()
+                    await pay(10)
+                    return before, await asyncql.Transaction.query().count()
+            assert run(unbound()) == (2, 3)
+
+            asyncql.set_connection_info(DB_FILEPATH, snapshots=True)
+            assert asyncql.Transaction.query_builder_class is asyncql.AsyncSnapshotQueryBuilder
+            # sqloquent's shared models are left alone
+            assert asyncql.AsyncDeletedModel.query_builder_class is sqloquent.asyncql.AsyncSqlQueryBuilder
+            assert sqloquent.asyncql.AsyncAttachment.query_builder_class is sqloquent.asyncql.AsyncSqlQueryBuilder
+            balances, count, after = run(report(25))
+            assert balances[alice.id] == -160, balances
+            assert count == 3 and after == 4
+
+            # snapshots require WAL journal mode
+            connection = sqlite3.connect('tests/rollback.db')
+            connection.execute('create table t (id integer)')
+            connection.close()
+            async def open_snapshot():
+                async with asyncql.AsyncSnapshot('tests/rollback.db'):
+                    pass
+            with self.assertRaises(ValueError):
+                run(open_snapshot())
+        finally:
+            asyncql.set_connection_info(DB_FILEPATH)
+            run(asyncql.close_pools())
+            if isfile('tests/rollback.db'):
+                os.remove('tests/rollback.db')
+
+    def test_memory_engine_e2e(self):
+        alice, bob, correspondence = self.setup_correspondence()
+
+        async def pay(amount: int) -> asyncql.Transaction:
+            entries, _ = await correspondence.pay_correspondent(alice, bob, amount, os.urandom(16))
+            txn = await asyncql.Transaction.prepare(
+                entries, str(time()),
+                auth_scripts=self.sign_entries(
+                    entries, self.seed_alice, self.committed_script_alice
+                )
+            )
+            await txn.save()
+            return txn
+
+        run(pay(100))
+        engine = asyncql.MemoryEngine(DB_FILEPATH)
+        try:
+            asyncql.set_connection_info(engine.connection_info, pool_size=2)
+            assert asyncql.Account.query_builder_class is asyncql.AsyncPooledQueryBuilder
+            assert type(asyncql.pool.get_pool(engine.connection_info)) is asyncql.AsyncMemoryPool
+
+            # concurrent simulated postings run in memory only
+            txns = run(concurrency.gather_limited(pay(10), pay(20), pay(30)))
+            balances = run(correspondence.balances())
+            assert balances[alice.id] == -160 and balances[bob.id] == 160, balances
+            assert set(engine.diff()['transactions']) == {t.id for t in txns}
+            connection = sqlite3.connect(DB_FILEPATH)
+            assert connection.execute('select count(*) from transactions').fetchone()[0] == 1
+            connection.close()
+
+            # the changes are written back
+            assert engine.apply() > 0
+            asyncql.set_connection_info(DB_FILEPATH)
+            assert run(asyncql.Transaction.query().count()) == 4
+            balances = run(correspondence.balances())
+            assert balances[alice.id] == -160 and balances[bob.id] == 160, balances
+        finally:
+            asyncql.set_connection_info(DB_FILEPATH)
+            run(asyncql.close_pools())
+            engine.close()
+
+    def test_clearing_house_e2e(self):
+        currency = self.setup_currency()
+        alice, ledger_alice = self.setup_party(
+            currency, 'Alice', self.seed_alice, self.pkey_alice
+        )
+        bob, ledger_bob = self.setup_party(
+            currency, 'Bob', self.seed_bob, self.pkey_bob
+        )
+        charlie, ledger_charlie = self.setup_party(
+            currency, 'Charlie', self.seed_charlie, self.pkey_charlie
+        )
+        committed_script_charlie = tapescript.tools.make_delegate_key_lock(self.pkey_charlie)
+        locking_script_charlie = tapescript.tools.make_taproot_lock(
+            self.pkey_charlie, committed_script_charlie
+        ).bytes
+        cor_ab = self.link_parties([
+            (alice, ledger_alice, self.locking_script_alice),
+            (bob, ledger_bob, self.locking_script_bob),
+        ], {'credit_limits': {alice.id: 1000, bob.id: 1000}})
+        cor_bc = self.link_parties([
+            (bob, ledger_bob, self.locking_script_bob),
+            (charlie, ledger_charlie, locking_script_charlie),
+        ], {'credit_limits': {bob.id: 1000, charlie.id: 1000}})
+
+        house = asyncql.ClearingHouse()
+        run(house.add(cor_ab))
+        run(house.add(cor_bc))
+
+        # alice and charlie have no Correspondence, so payments route through bob
+        route = house.find_route(alice.id, charlie.id, 100)
+        assert [(a, b, c.id) for a, b, c in route] == [
+            (alice.id, bob.id, cor_ab.id), (bob.id, charlie.id, cor_bc.id)
+        ]
+        assert house.find_route(alice.id, charlie.id, 5000) is None
+
+        # the cycle is netted before routing: alice owes 250 in total
+        payments = [
+            (alice.id, charlie.id, 300),
+            (charlie.id, bob.id, 100),
+            (bob.id, alice.id, 50),
+        ]
+        assert clearing.ClearingGraph.net_positions(payments) == {
+            alice.id: -250, bob.id: 50, charlie.id: 200
+        }
+        before = {cid: {**b} for cid, b in house.graph.balances.items()}
+        settlements = run(house.clear(payments, os.urandom(16)))
+        assert len(settlements) == 2
+
+        # nothing is saved yet, so the cached balances are unchanged
+        assert house.graph.balances == before
+        signers = {
+            alice.id: (self.seed_alice, self.committed_script_alice),
+            bob.id: (self.seed_bob, self.committed_script_bob),
+        }
+        for correspondence, entries, _, details in settlements:
+            assert details['clearing_root'] == netting.payments_root(payments)
+            payer_id = {
+                cor_ab.id: alice.id, cor_bc.id: bob.id
+            }[correspondence.id]
+            txn = run(asyncql.Transaction.prepare(
+                entries, str(time()), details=details,
+                auth_scripts=self.sign_entries(entries, *signers[payer_id])
+            ))
+            run(txn.save())
+
+        # the cached balances are updated once refreshed after saving
+        assert house.graph.balances == before
+        run(house.refresh())
+        cached = {cid: {**b} for cid, b in house.graph.balances.items()}
+        assert cached[cor_ab.id] == {alice.id: -250, bob.id: 250}
+        assert cached[cor_bc.id] == {bob.id: -200, charlie.id: 200}
+
+        # a payment without enough credit fails and leaves the balances intact
+        with self.assertRaises(ValueError) as e:
+            run(house.clear([(charlie.id, alice.id, 5000)], os.urandom(16)))
+        assert 'no route' in str(e.exception)
+        assert house.graph.balances == cached
+        assert house.find_route(bob.id, alice.id, 1250) is not None
+        assert house.find_route(bob.id, alice.id, 1251) is None
+
+
 if __name__ == '__main__':
     unittest.main()
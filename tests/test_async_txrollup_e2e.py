@@ -1,10 +1,13 @@
 from asyncio import run
-from context import asyncql
+from context import asyncql, bookchain, mirror
 from genericpath import isfile
 from nacl.signing import SigningKey
 from packify import pack, unpack
+from tempfile import TemporaryDirectory
+from threading import Thread
 from time import time
 import os
+import socket
 import sqloquent.asyncql
 import sqloquent.tools
 import tapescript
@@ -24,7 +27,8 @@ class TestTxRollupE2E(unittest.TestCase):
             asyncql.Identity, asyncql.Currency, asyncql.Ledger,
             asyncql.Account, asyncql.Entry, asyncql.Transaction,
             asyncql.Correspondence, asyncql.TxRollup,
-            asyncql.ArchivedTransaction, asyncql.ArchivedEntry
+            asyncql.ArchivedTransaction, asyncql.ArchivedEntry,
+            asyncql.TxRollupHead, asyncql.TrimmedRecord,
         ]
         for model in tomigrate:
             name = model.__name__
@@ -40,6 +44,8 @@ class TestTxRollupE2E(unittest.TestCase):
         asyncql.Correspondence.connection_info = DB_FILEPATH
         asyncql.Ledger.connection_info = DB_FILEPATH
         asyncql.Account.connection_info = DB_FILEPATH
+        asyncql.TxRollupHead.connection_info = DB_FILEPATH
+        asyncql.TrimmedRecord.connection_info = DB_FILEPATH
         asyncql.Entry.connection_info = DB_FILEPATH
         asyncql.Transaction.connection_info = DB_FILEPATH
         asyncql.TxRollup.connection_info = DB_FILEPATH
@@ -57,6 +63,8 @@ class TestTxRollupE2E(unittest.TestCase):
         run(asyncql.Account.query().delete())
         run(asyncql.Entry.query().delete())
         run(asyncql.Transaction.query().delete())
+        run(asyncql.TxRollupHead.query().delete())
+        run(asyncql.TrimmedRecord.query().delete())
         run(asyncql.TxRollup.query().delete())
         run(asyncql.ArchivedTransaction.query().delete())
         run(asyncql.ArchivedEntry.query().delete())
@@ -307,9 +315,11 @@ class TestTxRollupE2E(unittest.TestCase):
         txrollup.tx_ids
 
         # create a txrollup
+        assert run(asyncql.TxRollup.head_for(ledger)) is None
         txrollup = run(asyncql.TxRollup.prepare([txn1, txn2]))
         assert run(txrollup.validate())
         run(txrollup.save())
+        assert run(asyncql.TxRollup.head_for(ledger)).id == txrollup.id
 
         # prove inclusion of txn
         proof = txrollup.prove_txn_inclusion(txn1.id)
@@ -329,17 +339,45 @@ class TestTxRollupE2E(unittest.TestCase):
         assert run(run(txrollup.archived_entries()).count()) == 4, run(run(txrollup.archived_entries()).count())
 
         # ensure the txn has been trimmed
-        assert run(txrollup.trimmed_transactions().count()) == 2
+        assert run(run(txrollup.trimmed_transactions()).count()) == 2
+        assert run(run(txrollup.trimmed_entries()).count()) == 4
+
+        # the deleted records keep their own ids
+        deleted_ids = [d.id for d in run(run(txrollup.trimmed_entries()).get())]
+        assert run(asyncql.TrimmedRecord.query({'rollup_id': txrollup.id}).count()) == 6
+        assert not any(i.startswith(txrollup.id) for i in deleted_ids)
+
+        # the trimmed records can be loaded in chunks
+        async def check_chunks():
+            chunks = [c async for c in txrollup.trimmed_transaction_chunks(1)]
+            assert [len(c) for c in chunks] == [1, 1]
+            assert sorted([c[0].record_id for c in chunks]) == sorted(txrollup.tx_ids)
+            chunks = [c async for c in txrollup.trimmed_entry_chunks(3)]
+            assert all([0 < len(c) <= 3 for c in chunks])
+            assert sorted([d.id for c in chunks for d in c]) == sorted(deleted_ids)
+        run(check_chunks())
+
+        # records trimmed without TrimmedRecords are found by record_id
+        run(asyncql.TrimmedRecord.query().delete())
+        assert run(run(txrollup.trimmed_transactions()).count()) == 2
+        assert run(run(txrollup.trimmed_entries()).count()) == 4
+        run(check_chunks())
+        assert run(txrollup.reindex_trimmed()) == 6
+        assert run(txrollup.reindex_trimmed()) == 0
+        assert sorted([d.id for d in run(run(txrollup.trimmed_entries()).get())]) == sorted(deleted_ids)
+        assert run(run(txrollup.trimmed_transactions()).count()) == 2
         assert run(run(txrollup.trimmed_entries()).count()) == 4
         assert run(asyncql.Transaction.query().is_in('id', txrollup.tx_ids).count()) == 0
         entry_ids = [e.id for e in txn1.entries] + [e.id for e in txn2.entries]
         assert run(asyncql.Entry.query().is_in('id', entry_ids).count()) == 0
 
         # ensure the balances are correct
-        assert run(asset_acct.balance()) == asset_starting_balance # without rolled up balances
+        assert run(asset_acct.balance(rolled_up_balances={})) == asset_starting_balance # without rolled up balances
+        assert run(asset_acct.balance()) == asset_starting_balance + 300 # with TxRollupHead balances
         assert run(asset_acct.balance(rolled_up_balances=txrollup.balances)) == asset_starting_balance + 300, \
             f'{run(asset_acct.balance(rolled_up_balances=txrollup.balances))} != {asset_starting_balance} + 300'
-        assert run(equity_acct.balance()) == equity_starting_balance # without rolled up balances
+        assert run(equity_acct.balance(rolled_up_balances={})) == equity_starting_balance # without rolled up balances
+        assert run(equity_acct.balance()) == equity_starting_balance + 300 # with TxRollupHead balances
         assert run(equity_acct.balance(rolled_up_balances=txrollup.balances)) == equity_starting_balance + 300, \
             f'{run(equity_acct.balance(rolled_up_balances=txrollup.balances))} != {equity_starting_balance} + 300'
 
@@ -357,6 +395,8 @@ class TestTxRollupE2E(unittest.TestCase):
         txrollup2 = run(asyncql.TxRollup.prepare([txn3, txn4], txrollup.id))
         assert run(txrollup2.validate())
         run(txrollup2.save())
+        assert run(asyncql.TxRollup.head_for(ledger)).id == txrollup2.id
+        assert run(txrollup.validate())
 
         # attempt to create a competing txrollup chain
         with self.assertRaises(ValueError) as e:
@@ -369,16 +409,39 @@ class TestTxRollupE2E(unittest.TestCase):
         proof = txrollup2.prove_txn_inclusion(txn4.id)
         assert txrollup2.verify_txn_inclusion_proof(txn4.id, proof)
 
-        # archive and trim txn and entries
-        assert run(txrollup2.trim()) == 2
+        # archive and trim txn and entries in chunks of 1 txn
+        with self.assertRaises(TypeError) as e:
+            run(txrollup2.trim(chunk_size=0))
+        assert str(e.exception) == 'chunk_size must be a positive int'
+        run(txn3.entries[0].archive()) # already archived records are left in place
+        assert run(txrollup2.trim(chunk_size=1)) == 2
+        assert run(txrollup2.trim()) == 0
         assert run(txrollup2.archived_transactions().count()) == 2, run(txrollup2.archived_transactions().count())
         assert run(run(txrollup2.archived_entries()).count()) == 4, run(run(txrollup2.archived_entries()).count())
 
+        # stream the archived entries one archived txn at a time
+        async def collect_chunks(chunk_size: int):
+            return [chunk async for chunk in txrollup2.archived_entry_chunks(chunk_size)]
+        chunks = run(collect_chunks(1))
+        assert [len(c) for c in chunks] == [2, 2]
+
+        # eager load the archived txns with their entries
+        archived_txns = run(txrollup2.archived_transactions_with_entries())
+        assert len(archived_txns) == 2
+        for archived_txn in archived_txns:
+            assert len(archived_txn.entries) == 2
+            assert sorted([e.id for e in archived_txn.entries]) == sorted(
+                archived_txn.entry_ids.split(',')
+            )
+
         # ensure the balances are correct
         assert run(asset_acct.balance(rolled_up_balances=txrollup2.balances)) == asset_starting_balance + 330, \
             f'{run(asset_acct.balance(rolled_up_balances=txrollup2.balances))} != {asset_starting_balance} + 330'
         assert run(equity_acct.balance(rolled_up_balances=txrollup2.balances)) == equity_starting_balance + 330, \
             f'{run(equity_acct.balance(rolled_up_balances=txrollup2.balances))} != {equity_starting_balance} + 330'
+        balances = run(ledger.balances())
+        assert balances[asset_acct.id][0] == asset_starting_balance + 330
+        assert balances[equity_acct.id][0] == equity_starting_balance + 330
 
         # check relations
         assert len(ledger.rollups) == 2
@@ -437,6 +500,567 @@ class TestTxRollupE2E(unittest.TestCase):
         ]))
         assert archived_entries == 2, archived_entries
 
+    def test_verify_chain_e2e(self):
+        run(self.setup_currency())
+        alice, _ = run(self.setup_identities())
+        ledger: asyncql.Ledger = alice.ledgers[0]
+        asset_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.ASSET][0]
+        equity_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.EQUITY][0]
+
+        # an empty chain is valid
+        assert run(asyncql.TxRollup.verify_chain(ledger)) == (True, None)
+
+        # build a chain of 3 txrollups
+        parent_id = None
+        rollups = []
+        for i in range(3):
+            txn = run(self.create_txn(asset_acct, equity_acct, 10 * (i+1)))
+            txrollup = run(asyncql.TxRollup.prepare([txn], parent_id, ledger=ledger))
+            assert run(txrollup.validate())
+            run(txrollup.save())
+            rollups.append(txrollup)
+            parent_id = txrollup.id
+
+        # verify inline and in a process pool
+        assert run(asyncql.TxRollup.verify_chain(ledger)) == (True, None)
+        assert run(asyncql.TxRollup.verify_chain(ledger, batch_size=1)) == (True, None)
+
+        # tamper with the tx_ids of the last txrollup
+        run(asyncql.TxRollup.query().equal('id', rollups[2].id).update({
+            'tx_ids': rollups[0].data['tx_ids'],
+        }))
+        assert run(asyncql.TxRollup.verify_chain(ledger, batch_size=1)) == (False, 2)
+
+        # tamper with the height of the middle txrollup
+        run(asyncql.TxRollup.query().equal('id', rollups[1].id).update({'height': 5}))
+        assert run(asyncql.TxRollup.verify_chain(ledger)) == (False, 1)
+
+    def test_delta_balances_e2e(self):
+        run(self.setup_currency())
+        alice, _ = run(self.setup_identities())
+        ledger: asyncql.Ledger = alice.ledgers[0]
+        asset_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.ASSET][0]
+        equity_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.EQUITY][0]
+
+        starting_balance = run(asset_acct.balance())
+
+        # build a chain of 5 txrollups with a snapshot every 3 heights
+        parent_id = None
+        rollups = []
+        for i in range(5):
+            txn = run(self.create_txn(asset_acct, equity_acct, 10 * (i+1)))
+            txrollup = run(asyncql.TxRollup.prepare(
+                [txn], parent_id, ledger=ledger, snapshot_interval=3
+            ))
+            assert run(txrollup.validate())
+            run(txrollup.save())
+            rollups.append(txrollup)
+            parent_id = txrollup.id
+        assert [r.is_delta for r in rollups] == [False, True, True, False, True]
+
+        # deltas contain only the effects of the rollup's own txns
+        assert rollups[2].balance_deltas == {
+            asset_acct.id: (asyncql.EntryType.DEBIT, 30),
+            equity_acct.id: (asyncql.EntryType.CREDIT, 30),
+        }
+        with self.assertRaises(ValueError) as e:
+            rollups[3].balance_deltas
+        assert str(e.exception) == 'TxRollup balances are not delta-encoded'
+
+        # cumulative balances are resolved from the nearest snapshot
+        assert run(rollups[2].resolve_balances())[asset_acct.id] == (asyncql.EntryType.DEBIT, 60)
+        assert run(rollups[3].resolve_balances())[asset_acct.id] == (asyncql.EntryType.DEBIT, 100)
+        assert run(rollups[4].resolve_balances())[asset_acct.id] == (asyncql.EntryType.DEBIT, 150)
+        assert rollups[3].balances[equity_acct.id] == (asyncql.EntryType.CREDIT, 100)
+
+        # a delta-encoded genesis txrollup is invalid
+        genesis = asyncql.TxRollup({**rollups[0].data})
+        genesis.balance_deltas = rollups[0].balances
+        assert not run(genesis.validate())
+
+        # the chain must be trimmed in order
+        with self.assertRaises(ValueError) as e:
+            run(rollups[1].trim())
+        assert str(e.exception) == 'the parent tx rollup must be trimmed first'
+        assert run(asset_acct.balance()) == starting_balance + 150
+
+        # trimmed delta-encoded txrollups provide the starting balances
+        for txrollup in rollups:
+            assert run(txrollup.trim()) == 1
+        assert run(asset_acct.balance(rolled_up_balances={})) == starting_balance
+        assert run(asset_acct.balance()) == starting_balance + 150
+        assert run(asyncql.TxRollup.verify_chain(ledger)) == (True, None)
+
+    def test_balance_root_e2e(self):
+        run(self.setup_currency())
+        alice, _ = run(self.setup_identities())
+        ledger: asyncql.Ledger = alice.ledgers[0]
+        asset_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.ASSET][0]
+        equity_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.EQUITY][0]
+
+        # a txrollup without a balance_root cannot prove balances
+        txn = run(self.create_txn(asset_acct, equity_acct, 10))
+        txrollup = run(asyncql.TxRollup.prepare([txn], ledger=ledger))
+        assert txrollup.balance_root is None
+        with self.assertRaises(ValueError) as e:
+            run(txrollup.prove_balance(asset_acct.id))
+        assert str(e.exception) == 'tx rollup has no balance_root'
+
+        # build a chain of delta-encoded txrollups with balance_roots
+        parent_id = None
+        for i in range(3):
+            txn = run(self.create_txn(asset_acct, equity_acct, 10 * (i+1)))
+            txrollup = run(asyncql.TxRollup.prepare(
+                [txn], parent_id, ledger=ledger, snapshot_interval=3,
+                include_balance_root=True
+            ))
+            assert txrollup.balance_root is not None
+            assert run(txrollup.validate())
+            run(txrollup.save())
+            parent_id = txrollup.id
+        assert txrollup.is_delta
+        assert run(asyncql.TxRollup.verify_chain(ledger)) == (True, None)
+
+        # prove the cumulative balances of the last txrollup
+        root = txrollup.public()['balance_root']
+        balance = (asyncql.EntryType.DEBIT, 60)
+        proof = run(txrollup.prove_balance(asset_acct.id))
+        assert asyncql.TxRollup.verify_balance_proof(root, asset_acct.id, balance, proof)
+        proof = run(txrollup.prove_balance(equity_acct.id))
+        assert asyncql.TxRollup.verify_balance_proof(
+            root, equity_acct.id, (asyncql.EntryType.CREDIT, 60), proof
+        )
+
+        # wrong balances, accounts, and proofs are rejected
+        assert not asyncql.TxRollup.verify_balance_proof(
+            root, equity_acct.id, (asyncql.EntryType.CREDIT, 61), proof
+        )
+        assert not asyncql.TxRollup.verify_balance_proof(
+            root, asset_acct.id, (asyncql.EntryType.CREDIT, 60), proof
+        )
+        assert not asyncql.TxRollup.verify_balance_proof(root, equity_acct.id, balance, b'junk')
+        with self.assertRaises(ValueError) as e:
+            run(txrollup.prove_balance('nonexistent'))
+        assert str(e.exception) == 'account_id must have a balance'
+
+        # a tampered balance_root fails validation
+        txrollup.balance_root = txrollup.balance_root[::-1]
+        assert not run(txrollup.validate())
+
+    def test_archive_segment_e2e(self):
+        run(self.setup_currency())
+        alice, _ = run(self.setup_identities())
+        ledger: asyncql.Ledger = alice.ledgers[0]
+        asset_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.ASSET][0]
+        equity_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.EQUITY][0]
+
+        txns = [run(self.create_txn(asset_acct, equity_acct, 10 * (i+1))) for i in range(3)]
+        txrollup = run(asyncql.TxRollup.prepare(txns, ledger=ledger))
+        run(txrollup.save())
+
+        with TemporaryDirectory() as segment_dir:
+            assert run(txrollup.load_segment(segment_dir)) is None
+
+            # trim into a segment file instead of the archive tables
+            assert run(txrollup.trim(segment_dir=segment_dir, chunk_size=2)) == 3
+            assert run(txrollup.archived_transactions().count()) == 0
+            # only the IDs are mapped to the tx rollup; no packed records
+            assert run(sqloquent.asyncql.AsyncDeletedModel.query().count()) == 0
+            assert run(run(txrollup.trimmed_transactions()).count()) == 0
+            trimmed_ids = [
+                r.id for r in run(asyncql.TrimmedRecord.query({'rollup_id': txrollup.id}).get())
+            ]
+            entry_ids = [e.id for txn in txns for e in txn.entries]
+            assert sorted(trimmed_ids) == sorted([*txrollup.tx_ids, *entry_ids])
+
+            with run(txrollup.load_segment(segment_dir)) as segment:
+                assert segment.rollup_id == txrollup.id
+                assert segment.txn_count == 3
+                assert segment.entry_count == 6
+                assert segment.chunk_count == 2
+                assert sorted([t['id'] for t in segment.transactions()]) == sorted(txrollup.tx_ids)
+                entries = segment.entries(asset_acct.id)
+                assert sorted([e['amount'] for e in entries]) == [10, 20, 30]
+                assert all([e['account_id'] == asset_acct.id for e in entries])
+                assert segment.entries('nonexistent') == []
+                assert sum(segment.column('entry.amount')) == 120
+                archived_entry = asyncql.ArchivedEntry(entries[0])
+                assert archived_entry.type is asyncql.EntryType.DEBIT
+
+            # segments are immutable and verified against the tx_root
+            segment = run(txrollup.archive_segment(segment_dir))
+            assert segment.entry_count == 6
+            segment.close()
+
+            # tampered content fails verification despite matching ids
+            with TemporaryDirectory() as tampered_dir:
+                with run(txrollup.load_segment(segment_dir)) as segment:
+                    transactions = segment.transactions()
+                    entries = segment.entries()
+                entries[0]['amount'] += 1
+                tampered = bookchain.ArchiveSegment.write(
+                    tampered_dir, txrollup.id, txrollup.tx_root, transactions, entries
+                )
+                assert not tampered.verify(txrollup.tx_root)
+                tampered.close()
+                with self.assertRaises(ValueError) as e:
+                    run(txrollup.load_segment(tampered_dir))
+                assert str(e.exception) == 'segment does not match the tx_root'
+
+            txrollup.tx_ids = txrollup.tx_ids[:1]
+            with self.assertRaises(ValueError) as e:
+                run(txrollup.load_segment(segment_dir))
+            assert str(e.exception) == 'segment does not match the tx_root'
+
+    def test_transaction_rollup_id_e2e(self):
+        run(self.setup_currency())
+        alice, _ = run(self.setup_identities())
+        ledger: asyncql.Ledger = alice.ledgers[0]
+        asset_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.ASSET][0]
+        equity_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.EQUITY][0]
+
+        txns = [run(self.create_txn(asset_acct, equity_acct, 10 * (i+1))) for i in range(2)]
+        pending = asyncql.Transaction.query().equal('ledger_ids', ledger.id).is_null('rollup_id')
+        assert run(pending.count()) == 3 # includes the opening txn
+
+        # the rollup_id is set on save and does not change the txn ids
+        txrollup = run(asyncql.TxRollup.prepare(txns, ledger=ledger))
+        run(txrollup.save())
+        assert run(pending.count()) == 1
+        for txn in txns:
+            txn = run(asyncql.Transaction.find(txn.id))
+            assert txn.rollup_id == txrollup.id
+            assert txn.id == txn.generate_id(txn.data)
+            assert run(txn.rollup().reload())
+        txn.rollup.id == txrollup.id
+
+        # rollups saved before the column existed can be marked later
+        run(asyncql.Transaction.query().is_in('id', txrollup.tx_ids).update({'rollup_id': None}))
+        assert run(pending.count()) == 3
+        assert run(txrollup.mark_transactions()) == 2
+        assert run(pending.count()) == 1
+
+        # rolled-up txns can still be archived
+        assert txn.rollup_id is not None
+        assert (run(txn.archive())).id == txn.id
+
+    def test_rollup_mmr_e2e(self):
+        run(self.setup_currency())
+        alice, _ = run(self.setup_identities())
+        ledger: asyncql.Ledger = alice.ledgers[0]
+        asset_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.ASSET][0]
+        equity_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.EQUITY][0]
+        assert run(asyncql.TxRollup.chain_root(ledger)) is None
+
+        rollups: list[asyncql.TxRollup] = []
+        txns: list[asyncql.Transaction] = []
+        for i in range(7):
+            txns.append(run(self.create_txn(asset_acct, equity_acct, 10 * (i+1))))
+            txrollup = run(asyncql.TxRollup.prepare(
+                [txns[-1]], rollups[-1].id if rollups else None, ledger=ledger
+            ))
+            run(txrollup.save())
+            rollups.append(txrollup)
+
+        # every rollup can be proven against the current root
+        root = run(asyncql.TxRollup.chain_root(ledger))
+        proofs = {}
+        for txrollup in rollups:
+            proofs[txrollup.id] = run(asyncql.TxRollup.prove_rollup_in_chain(txrollup.id))
+            assert asyncql.TxRollup.verify_rollup_in_chain(
+                root, txrollup.id, proofs[txrollup.id], txrollup.height
+            )
+            assert not asyncql.TxRollup.verify_rollup_in_chain(
+                root, txrollup.id, proofs[txrollup.id], txrollup.height + 1
+            )
+        assert not asyncql.TxRollup.verify_rollup_in_chain(root, rollups[0].id, proofs[rollups[1].id])
+        assert not asyncql.TxRollup.verify_rollup_in_chain(root, rollups[0].id, b'junk')
+
+        # a txn is proven in the chain with two proofs
+        txn_proof = rollups[2].prove_txn_inclusion(txns[2].id)
+        assert rollups[2].verify_txn_inclusion_proof(txns[2].id, txn_proof)
+        assert asyncql.TxRollup.verify_rollup_in_chain(root, rollups[2].id, proofs[rollups[2].id])
+
+        # the incrementally maintained peaks match a full recalculation
+        run(asyncql.TxRollupHead.query().equal('id', ledger.id).update({'mmr_peaks': None}))
+        assert run(asyncql.TxRollup.chain_root(ledger)) == root
+
+        # appending a rollup changes the root
+        txn = run(self.create_txn(asset_acct, equity_acct, 100))
+        txrollup = run(asyncql.TxRollup.prepare([txn], rollups[-1].id, ledger=ledger))
+        run(txrollup.save())
+        new_root = run(asyncql.TxRollup.chain_root(ledger))
+        assert new_root != root
+        assert not asyncql.TxRollup.verify_rollup_in_chain(new_root, rollups[0].id, proofs[rollups[0].id])
+        proof = run(asyncql.TxRollup.prove_rollup_in_chain(rollups[0].id))
+        assert asyncql.TxRollup.verify_rollup_in_chain(new_root, rollups[0].id, proof, 0)
+
+        with self.assertRaises(ValueError) as e:
+            run(asyncql.TxRollup.prove_rollup_in_chain(txn.id))
+        assert str(e.exception) == 'TxRollup not found'
+
+    def test_mirror_sync_e2e(self):
+        run(self.setup_currency())
+        alice, _ = run(self.setup_identities())
+        ledger: asyncql.Ledger = alice.ledgers[0]
+        asset_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.ASSET][0]
+        equity_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.EQUITY][0]
+
+        parent_id = None
+        for i in range(5):
+            txn = run(self.create_txn(asset_acct, equity_acct, 10 * (i+1)))
+            txrollup = run(asyncql.TxRollup.prepare(
+                [txn], parent_id, ledger=ledger, include_balance_root=i == 3
+            ))
+            run(txrollup.save())
+            parent_id = txrollup.id
+        assert not txrollup.is_mirror
+
+        # headers contain only the public data
+        scope_id, headers = mirror.decode_headers(run(asyncql.TxRollup.export_headers(ledger)))
+        assert scope_id == ledger.id
+        assert [h['height'] for h in headers] == [0, 1, 2, 3, 4]
+        assert all(['tx_ids' not in h for h in headers])
+
+        # stand-in for the source node, which will no longer share the db
+        def handler(request: bytes) -> bytes:
+            scope_id, from_height, limit = mirror.decode_request(request)
+            return mirror.encode_headers(
+                scope_id, [h for h in headers if h['height'] >= from_height][:limit]
+            )
+
+        async def async_handler(request: bytes) -> bytes:
+            return handler(request)
+
+        request = mirror.encode_request(ledger.id, 2, 2)
+        assert run(asyncql.TxRollup.serve_headers(request)) == handler(request)
+        with self.assertRaises(ValueError) as e:
+            run(asyncql.TxRollup.serve_headers(b'junk'))
+        assert str(e.exception) == 'invalid request'
+
+        def reset_mirror():
+            run(asyncql.TxRollupHead.query().delete())
+            run(asyncql.TxRollup.query().delete())
+
+        root = run(asyncql.TxRollup.chain_root(ledger))
+
+        # import a first batch, then resume from the local head
+        reset_mirror()
+        assert run(asyncql.TxRollup.import_headers(
+            handler(mirror.encode_request(ledger.id, 0, 2)), ledger
+        )) == 2
+        assert (run(asyncql.TxRollup.head_for(ledger))).height == 1
+        transport = mirror.InProcessTransport(async_handler)
+        assert run(asyncql.TxRollup.sync_headers(transport, ledger, batch_size=2)) == 3
+        head = run(asyncql.TxRollup.head_for(ledger))
+        assert head.height == 4 and head.id == headers[-1]['id']
+        assert run(asyncql.TxRollup.verify_chain(ledger)) == (True, None)
+        assert run(asyncql.TxRollup.sync_headers(transport, ledger)) == 0
+        assert run(asyncql.TxRollup.chain_root(ledger)) == root
+
+        # mirrored rollups can be reloaded and validated without their txns
+        mirrored = run(asyncql.TxRollup.find(headers[3]['id']))
+        assert mirrored.is_mirror
+        assert mirrored.tx_ids == []
+        assert run(mirrored.validate())
+
+        # invalid headers are rejected before anything is saved
+        reset_mirror()
+        tampered = [{**h} for h in headers]
+        tampered[2]['balances'] = tampered[1]['balances']
+        with self.assertRaises(ValueError) as e:
+            run(asyncql.TxRollup.import_headers(mirror.encode_headers(ledger.id, tampered), ledger))
+        assert str(e.exception) == 'invalid TxRollup header at height 2'
+        assert run(asyncql.TxRollup.query().count()) == 0
+        with self.assertRaises(ValueError) as e:
+            run(asyncql.TxRollup.import_headers(mirror.encode_headers(ledger.id, headers[1:]), ledger))
+        assert str(e.exception) == 'invalid TxRollup header at height 0'
+        with self.assertRaises(ValueError) as e:
+            run(asyncql.TxRollup.import_headers(mirror.encode_headers(alice.id, headers), ledger))
+        assert str(e.exception) == 'headers are for a different chain'
+
+        # with a txru_lock, every header must have an auth_script
+        with self.assertRaises(ValueError) as e:
+            run(asyncql.TxRollup.import_headers(
+                mirror.encode_headers(ledger.id, headers), ledger, txru_lock=b'\x00'
+            ))
+        assert str(e.exception) == 'invalid TxRollup header at height 0'
+
+        # sync over a local socket
+        client, server = socket.socketpair()
+        thread = Thread(target=mirror.SocketTransport.serve, args=(server, handler))
+        thread.start()
+        try:
+            transport = mirror.SocketTransport(client)
+            assert run(asyncql.TxRollup.sync_headers(transport, ledger, batch_size=3)) == 5
+        finally:
+            client.close()
+            thread.join()
+            server.close()
+        assert (run(asyncql.TxRollup.head_for(ledger))).id == headers[-1]['id']
+
+    def test_rollup_scheduler_e2e(self):
+        run(self.setup_currency())
+        alice, bob = run(self.setup_identities())
+        ledger: asyncql.Ledger = alice.ledgers[0]
+        asset_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.ASSET][0]
+        equity_acct: asyncql.Account = [acct for acct in ledger.accounts if acct.type == asyncql.AccountType.EQUITY][0]
+
+        with self.assertRaises(TypeError) as e:
+            asyncql.RollupScheduler(max_txns=0)
+        assert str(e.exception) == 'max_txns must be a positive int'
+
+        # the opening txn is pending; a rollup is due after 3 txns
+        scheduler = asyncql.RollupScheduler(max_txns=3, max_age=None)
+        scheduler.watch(ledger)
+        assert len(run(scheduler.pending_transactions(ledger))) == 1
+        txn1 = run(self.create_txn(asset_acct, equity_acct, 10))
+        assert not run(scheduler.due(ledger))
+        assert run(scheduler.pending_count(ledger)) == 2
+        assert run(scheduler.run_once()) == []
+        assert scheduler.metrics[ledger.id]['pending'] == 2
+        assert scheduler.metrics[ledger.id]['height'] is None
+        assert scheduler.metrics[ledger.id]['lag'] >= 0
+
+        txn2 = run(self.create_txn(asset_acct, equity_acct, 20))
+        assert run(scheduler.due(ledger))
+        rollups = run(scheduler.run_once())
+        assert len(rollups) == 1
+        assert rollups[0].height == 0
+        assert txn1.id in rollups[0].tx_ids and txn2.id in rollups[0].tx_ids
+        assert len(rollups[0].tx_ids) == 3
+        assert run(scheduler.pending_transactions(ledger)) == []
+        assert scheduler.metrics[ledger.id]['pending'] == 0
+        assert scheduler.metrics[ledger.id]['height'] == 0
+        assert scheduler.metrics[ledger.id]['rollups'] == 1
+        assert scheduler.metrics[ledger.id]['rolled_up'] == 3
+        assert run(scheduler.run_once()) == []
+
+        # a rollup is due after max_age seconds since the chain head; the
+        # txns are trimmed after the rollup is saved
+        scheduler = asyncql.RollupScheduler(max_txns=100, max_age=0, trim=True)
+        scheduler.watch(ledger)
+        txn3 = run(self.create_txn(asset_acct, equity_acct, 30))
+        rollups = run(scheduler.run_once())
+        assert len(rollups) == 1
+        assert rollups[0].height == 1
+        assert rollups[0].parent_id is not None
+        assert (run(asyncql.TxRollup.head_for(ledger))).id == rollups[0].id
+        assert rollups[0].tx_ids == [txn3.id]
+        # the untrimmed rollup below it is trimmed first
+        assert scheduler.metrics[ledger.id]['trimmed'] == 4
+        assert run(asyncql.Transaction.find(txn1.id)) is None
+        assert run(asyncql.Transaction.find(txn3.id)) is None
+        assert run(asyncql.TxRollup.verify_chain(ledger)) == (True, None)
+
+        # only the oldest max_txns pending txns are loaded and rolled up
+        scheduler = asyncql.RollupScheduler(max_txns=2, max_age=None)
+        scheduler.watch(ledger)
+        for i in range(3):
+            run(self.create_txn(asset_acct, equity_acct, 40 + i))
+        assert run(scheduler.pending_count(ledger)) == 3
+        assert len(run(scheduler.pending_transactions(ledger))) == 2
+        rollups = run(scheduler.run_once())
+        assert len(rollups) == 1 and len(rollups[0].tx_ids) == 2
+        assert scheduler.metrics[ledger.id]['pending'] == 1
+        assert run(scheduler.pending_count(ledger)) == 1
+        assert run(scheduler.rollup(ledger)).tx_ids != rollups[0].tx_ids
+        assert run(scheduler.pending_count(ledger)) == 0
+
+        # correspondence txns are rolled up separately and signed
+        correspondence = run(self.setup_correspondence())
+        cor_accts = run(correspondence.get_accounts())
+        _, entries = run(correspondence.pay_correspondent(alice, bob, 200, os.urandom(16)))
+        txn = run(asyncql.Transaction.prepare(entries, str(time()), auth_scripts={
+            cor_accts[alice.id][asyncql.AccountType.EQUITY].id: tapescript.tools.make_taproot_witness_keyspend(
+                self.seed_alice, entries[0].get_sigfields(entries=entries), self.committed_script_alice
+            ).bytes,
+            cor_accts[alice.id][asyncql.AccountType.VOSTRO_LIABILITY].id: tapescript.tools.make_taproot_witness_keyspend(
+                self.seed_alice, entries[2].get_sigfields(entries=entries), self.committed_script_alice
+            ).bytes,
+            cor_accts[bob.id][asyncql.AccountType.NOSTRO_ASSET].id: tapescript.tools.make_taproot_witness_keyspend(
+                self.seed_alice, entries[3].get_sigfields(entries=entries), self.committed_script_alice
+            ).bytes,
+        }))
+        run(txn.save())
+
+        # correspondence rollups are never saved unsigned
+        with self.assertRaises(ValueError) as e:
+            asyncql.RollupScheduler().watch(correspondence)
+        assert str(e.exception) == 'a signer is required to roll up a Correspondence'
+        with self.assertRaises(ValueError) as e:
+            run(asyncql.RollupScheduler().rollup(correspondence))
+        assert str(e.exception) == 'a signer is required to roll up a Correspondence'
+
+        signed = []
+        def signer(txru, cor):
+            signed.append((txru.id, cor.id))
+            return None
+        scheduler = asyncql.RollupScheduler(max_txns=1, signer=signer)
+        scheduler.watch(correspondence)
+        scheduler.watch(ledger)
+        assert [t.id for t in run(scheduler.pending_transactions(correspondence))] == [txn.id]
+        assert run(scheduler.pending_transactions(ledger)) == []
+        rollups = run(scheduler.run_once())
+        assert len(rollups) == 1
+        assert rollups[0].correspondence_id == correspondence.id
+        assert rollups[0].tx_ids == [txn.id]
+        assert signed == [(rollups[0].id, correspondence.id)]
+        assert scheduler.metrics[correspondence.id]['height'] == 0
+        assert run(scheduler.rollup(correspondence)) is None
+
+    def test_rollup_signing_session_e2e(self):
+        run(self.setup_currency())
+        alice, bob = run(self.setup_identities())
+        correspondence = run(self.setup_correspondence())
+        txrollup = run(asyncql.TxRollup.prepare([], correspondence=correspondence))
+
+        session = run(asyncql.RollupSigningSession.start(txrollup))
+        assert session.rollup_id == txrollup.generate_id(txrollup.data)
+        assert session.sigfields == txrollup.get_sigfields()
+        assert sorted(session.missing) == sorted([alice.id, bob.id])
+        assert session.auth_script is None
+        assert not session.verify()
+
+        # partial signatures are verified as they arrive
+        wrong = tapescript.make_single_sig_witness(self.seed_bob, session.sigfields).bytes
+        assert not session.add_signature(alice.id, wrong)
+        with self.assertRaises(ValueError) as e:
+            session.sign(alice.id, self.seed_bob)
+        assert str(e.exception) == 'seed does not match the pubkey of the identity'
+        with self.assertRaises(ValueError) as e:
+            session.add_signature(correspondence.id, wrong)
+        assert str(e.exception) == 'identity is not part of the session'
+        session.sign(alice.id, self.seed_alice)
+        assert session.missing == [bob.id]
+        with self.assertRaises(ValueError) as e:
+            session.finalize()
+        assert str(e.exception) == 'auth_script is not valid'
+
+        # a partial signature made by another party
+        assert session.add_signature(bob.id, wrong)
+        assert session.missing == []
+        assert session.verify()
+        txrollup = session.finalize()
+        assert txrollup.id == session.rollup_id
+        assert run(txrollup.validate())
+        run(txrollup.save())
+        assert run(asyncql.TxRollup.verify_chain(correspondence)) == (True, None)
+
+        # an incomplete auth_script does not validate
+        txrollup.auth_script = session.signatures[alice.id]
+        assert not run(txrollup.validate())
+
+        # the session is bound to the TxRollup data
+        txrollup2 = run(asyncql.TxRollup.prepare([], txrollup.id, correspondence=correspondence))
+        session = run(asyncql.RollupSigningSession.start(txrollup2, correspondence))
+        session.sign(alice.id, self.seed_alice)
+        session.sign(bob.id, self.seed_bob)
+        txrollup2.timestamp = '0'
+        with self.assertRaises(ValueError) as e:
+            session.finalize()
+        assert str(e.exception) == 'txrollup was changed during the signing session'
+
     def test_with_correspondence_e2e(self):
         run(self.setup_currency())
         alice, bob = run(self.setup_identities())
@@ -501,14 +1125,14 @@ class TestTxRollupE2E(unittest.TestCase):
         assert run(run(txrollup.archived_entries()).count()) == 8, run(run(txrollup.archived_entries()).count())
 
         # ensure the txns have been trimmed
-        assert run(txrollup.trimmed_transactions().count()) == 2
+        assert run(run(txrollup.trimmed_transactions()).count()) == 2
         assert run(run(txrollup.trimmed_entries()).count()) == 8
         assert run(asyncql.Transaction.query().is_in('id', txrollup.tx_ids).count()) == 0
         entry_ids = [e.id for e in txn.entries] + [e.id for e in txn2.entries]
         assert run(asyncql.Entry.query().is_in('id', entry_ids).count()) == 0
 
         # prove inclusion of each trimmed txn
-        txns = [asyncql.Transaction(unpack(item.record)) for item in run(txrollup.trimmed_transactions().get())]
+        txns = [asyncql.Transaction(unpack(item.record)) for item in run(run(txrollup.trimmed_transactions()).get())]
         for txn in txns:
             assert len(txn.id) > 0
             proof = txrollup.prove_txn_inclusion(txn.id)
@@ -522,19 +1146,27 @@ class TestTxRollupE2E(unittest.TestCase):
             assert txrollup.verify_txn_inclusion_proof(txn.id, proof)
 
         # prove that the balances are correct when using rolled up balances
-        assert run(nostro_acct_bob.balance()) == 0
+        assert run(nostro_acct_bob.balance(rolled_up_balances={})) == 0
+        assert run(nostro_acct_bob.balance()) == 100
         assert run(nostro_acct_bob.balance(rolled_up_balances=txrollup.balances)) == 100, \
             run(nostro_acct_bob.balance(rolled_up_balances=txrollup.balances))
-        assert run(vostro_acct_alice.balance()) == 0
+        assert run(vostro_acct_alice.balance(rolled_up_balances={})) == 0
+        assert run(vostro_acct_alice.balance()) == 100
         assert run(vostro_acct_alice.balance(rolled_up_balances=txrollup.balances)) == 100, \
             run(vostro_acct_alice.balance(rolled_up_balances=txrollup.balances))
-        balances = run(correspondence.balances())
+        balances = run(correspondence.balances(rolled_up_balances={}))
         assert balances[alice.id] == 0, balances[alice.id]
         assert balances[bob.id] == 0, balances[bob.id]
+        balances = run(correspondence.balances())
+        assert balances[alice.id] == -100, balances[alice.id]
+        assert balances[bob.id] == 100, balances[bob.id]
         balances = run(correspondence.balances(rolled_up_balances=txrollup.balances))
         assert balances[alice.id] == -100, balances[alice.id]
         assert balances[bob.id] == 100, balances[bob.id]
 
+        # verify the chain
+        assert run(asyncql.TxRollup.verify_chain(correspondence)) == (True, None)
+
         # check relations
         assert len(correspondence.rollups) == 1
         assert txrollup.id in [r.id for r in correspondence.rollups]
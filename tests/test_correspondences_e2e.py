@@ -1,11 +1,13 @@
-from context import models
+from context import models, clearing, netting
 from genericpath import isfile
 from nacl.signing import SigningKey
 from packify import pack
 from time import time
 import os
+import sqlite3
 import sqloquent.tools
 import tapescript
+import threading
 import unittest
 
 
@@ -22,6 +24,7 @@ class TestCorrespondencesE2E(unittest.TestCase):
             models.Identity, models.Currency, models.Ledger,
             models.Account, models.Entry, models.Transaction,
             models.Correspondence,
+            models.TxRollupHead,
         ]
         for model in tomigrate:
             name = model.__name__
@@ -37,6 +40,7 @@ class TestCorrespondencesE2E(unittest.TestCase):
         models.Correspondence.connection_info = DB_FILEPATH
         models.Ledger.connection_info = DB_FILEPATH
         models.Account.connection_info = DB_FILEPATH
+        models.TxRollupHead.connection_info = DB_FILEPATH
         models.Entry.connection_info = DB_FILEPATH
         models.Transaction.connection_info = DB_FILEPATH
         sqloquent.DeletedModel.connection_info = DB_FILEPATH
@@ -51,6 +55,7 @@ class TestCorrespondencesE2E(unittest.TestCase):
         models.Account.query().delete()
         models.Entry.query().delete()
         models.Transaction.query().delete()
+        models.TxRollupHead.query().delete()
         sqloquent.DeletedModel.query().delete()
         self.setup_cryptographic_values()
         super().setUp()
@@ -98,6 +103,69 @@ class TestCorrespondencesE2E(unittest.TestCase):
             [self.pkey_alice, self.pkey_bob], 2
         ).bytes
 
+    def setup_currency(self) -> models.Currency:
+        return models.Currency.insert({
+            'name': 'Median Human Hour',
+            'prefix_symbol': 'Ħ',
+            'fx_symbol': 'MHH',
+            'base': 60,
+            'unit_divisions': 2,
+        })
+
+    def setup_party(
+            self, currency: models.Currency, name: str, seed: bytes, pkey: bytes
+        ) -> tuple[models.Identity, models.Ledger]:
+        identity = models.Identity.insert({'name': name, 'pubkey': pkey, 'seed': seed})
+        ledger = models.Ledger.insert({
+            'name': 'Current Ledger',
+            'identity_id': identity.id,
+            'currency_id': currency.id,
+        })
+        for acct in ledger.setup_basic_accounts():
+            acct.save()
+        return identity, ledger
+
+    def link_parties(
+            self, parties: list[tuple[models.Identity, models.Ledger, bytes]],
+            details: dict|None = None
+        ) -> models.Correspondence:
+        locking_scripts = {identity.id: lock for identity, _, lock in parties}
+        correspondence: models.Correspondence = models.Correspondence.insert({
+            'identity_ids': ','.join(sorted([i.id for i, _, _ in parties])),
+            'ledger_ids': ','.join(sorted([l.id for _, l, _ in parties])),
+            'details': pack({'locking_scripts': locking_scripts, **(details or {})}),
+        })
+        cor_accts = correspondence.setup_accounts(locking_scripts)
+        for accts in cor_accts.values():
+            for acct in accts.values():
+                acct.save()
+        return correspondence
+
+    def setup_correspondence(self) -> tuple[models.Identity, models.Identity, models.Correspondence]:
+        currency = self.setup_currency()
+        alice, ledger_alice = self.setup_party(
+            currency, 'Alice', self.seed_alice, self.pkey_alice
+        )
+        bob, ledger_bob = self.setup_party(
+            currency, 'Bob', self.seed_bob, self.pkey_bob
+        )
+        correspondence = self.link_parties([
+            (alice, ledger_alice, self.locking_script_alice),
+            (bob, ledger_bob, self.locking_script_bob),
+        ])
+        return alice, bob, correspondence
+
+    def sign_entries(
+            self, entries: list[models.Entry], seed: bytes, committed_script
+        ) -> dict[str, bytes]:
+        return {
+            e.account_id: tapescript.tools.make_taproot_witness_keyspend(
+                seed, e.get_sigfields(entries=entries), committed_script
+            ).bytes
+            for e in entries
+            if e.account.locking_scripts and e.type in e.account.locking_scripts
+        }
+
     def test_e2e(self):
         assert models.Account.query().count() == 0
 
@@ -681,5 +749,694 @@ class TestCorrespondencesE2E(unittest.TestCase):
         assert balances[bob.id] == 200, balances
 
 
+    def test_settle_payments_e2e(self):
+        alice, bob, correspondence = self.setup_correspondence()
+        payments = [
+            (alice.id, bob.id, 100),
+            (bob.id, alice.id, 30),
+            (alice.id, bob.id, 50),
+            (bob.id, alice.id, 20),
+        ]
+        assert netting.net_payments(payments) == [(alice.id, bob.id, 100)]
+
+        settlements = correspondence.settle_payments(payments, os.urandom(16))
+        assert len(settlements) == 1
+        entries, _, details = settlements[0]
+        assert all([e.amount == 100 for e in entries])
+        assert details['payments_count'] == (4).to_bytes(8, 'big')
+        txn = models.Transaction.prepare(
+            entries, str(time()), details=details,
+            auth_scripts=self.sign_entries(entries, self.seed_alice, self.committed_script_alice)
+        )
+        txn.save()
+        balances = correspondence.balances()
+        assert balances[alice.id] == -100, balances
+        assert balances[bob.id] == 100, balances
+
+        # every netted payment can be proven against the committed root
+        root = txn.details['payments_root']
+        for i, payment in enumerate(payments):
+            proof = netting.prove_payment(payments, i)
+            assert netting.verify_payment(root, i, payment, proof)
+            assert not netting.verify_payment(root, i, (alice.id, bob.id, 1), proof)
+
+        # offsetting payments net to nothing
+        assert correspondence.settle_payments(
+            [(alice.id, bob.id, 5), (bob.id, alice.id, 5)], os.urandom(16)
+        ) == []
+        with self.assertRaises(ValueError) as e:
+            correspondence.settle_payments([(alice.id, alice.id, 5)], os.urandom(16))
+        assert str(e.exception) == 'payer and payee must differ'
+        with self.assertRaises(ValueError) as e:
+            correspondence.settle_payments([(alice.id, correspondence.id, 5)], os.urandom(16))
+        assert str(e.exception) == 'all payers and payees must be correspondence identities'
+        with self.assertRaises(TypeError) as e:
+            correspondence.settle_payments([(alice.id, bob.id, '5')], os.urandom(16))
+
+
+    def test_balances_aggregate_e2e(self):
+        alice, bob, correspondence = self.setup_correspondence()
+        assert correspondence.balances() == {alice.id: 0, bob.id: 0}
+        for payer, payee, amount in ((alice, bob, 70), (bob, alice, 20)):
+            entries, _ = correspondence.pay_correspondent(
+                payer, payee, amount, os.urandom(16)
+            )
+            seed, committed_script = {
+                alice.id: (self.seed_alice, self.committed_script_alice),
+                bob.id: (self.seed_bob, self.committed_script_bob),
+            }[payer.id]
+            txn = models.Transaction.prepare(
+                entries, str(time()),
+                auth_scripts=self.sign_entries(entries, seed, committed_script)
+            )
+            txn.save()
+
+        balances = correspondence.balances()
+        assert balances == {alice.id: -50, bob.id: 50}, balances
+
+        # matches the per-Account tally
+        accts = correspondence.get_accounts()
+        for identity_id, by_type in accts.items():
+            nostro = by_type[models.AccountType.NOSTRO_ASSET].balance()
+            vostro = by_type[models.AccountType.VOSTRO_LIABILITY].balance()
+            assert balances[identity_id] == nostro - vostro
+
+        # rolled up balances are used as starting balances
+        nostro_alice = accts[alice.id][models.AccountType.NOSTRO_ASSET]
+        vostro_bob = accts[bob.id][models.AccountType.VOSTRO_LIABILITY]
+        balances = correspondence.balances({
+            nostro_alice.id: (models.EntryType.DEBIT, 5),
+            vostro_bob.id: (models.EntryType.CREDIT, 5),
+        })
+        assert balances == {alice.id: -45, bob.id: 45}, balances
+
+    def test_get_accounts_cache_e2e(self):
+        alice, bob, correspondence = self.setup_correspondence()
+        accts = correspondence.get_accounts()
+        assert all([len(a) == 3 for a in accts.values()])
+        equity_alice = accts[alice.id][models.AccountType.EQUITY]
+        assert equity_alice.name.startswith('General Equity')
+
+        # setup_accounts stored the IDs of the equity Accounts
+        equity_bob = accts[bob.id][models.AccountType.EQUITY]
+        assert correspondence.equity_account_ids == ','.join(
+            sorted([equity_alice.id, equity_bob.id])
+        )
+
+        # the loaded map is kept on the instance until reload=True
+        nostro_alice = accts[alice.id][models.AccountType.NOSTRO_ASSET]
+        nostro_alice.delete()
+        assert correspondence.get_accounts()[alice.id][models.AccountType.NOSTRO_ASSET].id == nostro_alice.id
+        assert models.AccountType.NOSTRO_ASSET not in correspondence.get_accounts(reload=True)[alice.id]
+        nostro_alice.save()
+        assert models.AccountType.NOSTRO_ASSET in correspondence.get_accounts(reload=True)[alice.id]
+
+        # other instances do not share the map
+        other = models.Correspondence.find(correspondence.id)
+        assert '_accounts' not in other.__dict__
+        assert other.get_accounts()[alice.id][models.AccountType.NOSTRO_ASSET].id == nostro_alice.id
+
+        # equity Accounts are looked up by the stored IDs, not by name
+        custom_equity = models.Account.insert({
+            'name': 'Owner Capital',
+            'type': models.AccountType.EQUITY.value,
+            'ledger_id': equity_alice.ledger_id,
+        })
+        correspondence.update({
+            'equity_account_ids': ','.join(sorted([custom_equity.id, equity_bob.id])),
+        })
+        correspondence = models.Correspondence.find(other.id)
+        assert correspondence is not None
+        accts = correspondence.get_accounts()
+        assert accts[alice.id][models.AccountType.EQUITY].id == custom_equity.id
+        assert accts[bob.id][models.AccountType.EQUITY].id == equity_bob.id
+
+    def test_setup_many_e2e(self):
+        currency = self.setup_currency()
+        parties = [
+            self.setup_party(currency, name, seed, pkey)
+            for name, seed, pkey in (
+                ('Alice', self.seed_alice, self.pkey_alice),
+                ('Bob', self.seed_bob, self.pkey_bob),
+                ('Charlie', self.seed_charlie, self.pkey_charlie),
+            )
+        ]
+        (alice, ledger_alice), (bob, ledger_bob), (charlie, ledger_charlie) = parties
+        locking_scripts = {
+            alice.id: self.locking_script_alice,
+            bob.id: self.locking_script_bob,
+            charlie.id: self.locking_script_alice,
+        }
+        groups = [
+            [ledger_alice, ledger_bob],
+            [ledger_bob, ledger_charlie],
+            [ledger_alice, ledger_bob, ledger_charlie],
+        ]
+        accounts_before = models.Account.query().count()
+        correspondences = models.Correspondence.setup_many(
+            groups, locking_scripts, {'txru_lock': self.multisig_lock}
+        )
+        assert len(correspondences) == 3
+        assert models.Correspondence.query().count() == 3
+        # 2 accounts for each ordered pair of Identities
+        assert models.Account.query().count() == accounts_before + 4 + 4 + 12
+
+        cor_ab = models.Correspondence.find(correspondences[0].id)
+        assert cor_ab.details['txru_lock'] == self.multisig_lock
+        equity_ids = [
+            models.Account.query().equal('ledger_id', l.id).starts_with(
+                name='General Equity'
+            ).first().id
+            for l in (ledger_alice, ledger_bob)
+        ]
+        assert cor_ab.equity_account_ids == ','.join(sorted(equity_ids))
+        assert cor_ab.details['locking_scripts'] == {
+            alice.id: self.locking_script_alice, bob.id: self.locking_script_bob
+        }
+        accts = cor_ab.get_accounts()
+        nostro = accts[alice.id][models.AccountType.NOSTRO_ASSET]
+        assert nostro.details == bob.id
+        assert nostro.locking_scripts == {
+            models.EntryType.CREDIT: self.locking_script_alice,
+            models.EntryType.DEBIT: self.locking_script_bob,
+        }
+        assert all([len(a) == 3 for a in accts.values()])
+
+        # rerunning the onboarding does not duplicate anything
+        models.Correspondence.setup_many(
+            groups, locking_scripts, {'txru_lock': self.multisig_lock}
+        )
+        assert models.Correspondence.query().count() == 3
+        assert models.Account.query().count() == accounts_before + 20
+
+        with self.assertRaises(ValueError) as e:
+            models.Correspondence.setup_many([[ledger_alice]], locking_scripts)
+        assert 'at least 2' in str(e.exception)
+        with self.assertRaises(ValueError) as e:
+            models.Correspondence.setup_many(
+                [[ledger_alice, ledger_bob]], {alice.id: self.locking_script_alice}
+            )
+        assert 'missing locking script' in str(e.exception)
+        with self.assertRaises(TypeError) as e:
+            models.Correspondence.setup_many([[alice]], locking_scripts)
+
+    def test_load_correspondents_e2e(self):
+        currency = self.setup_currency()
+        (alice, ledger_alice), (bob, ledger_bob), (charlie, ledger_charlie) = [
+            self.setup_party(currency, name, seed, pkey)
+            for name, seed, pkey in (
+                ('Alice', self.seed_alice, self.pkey_alice),
+                ('Bob', self.seed_bob, self.pkey_bob),
+                ('Charlie', self.seed_charlie, self.pkey_charlie),
+            )
+        ]
+        models.Correspondence.setup_many(
+            [[ledger_alice, ledger_bob], [ledger_alice, ledger_charlie]],
+            {
+                alice.id: self.locking_script_alice,
+                bob.id: self.locking_script_bob,
+                charlie.id: self.locking_script_bob,
+            }
+        )
+
+        correspondents = alice.correspondents(reload=True)
+        assert sorted([i.id for i in correspondents]) == sorted([bob.id, charlie.id])
+        assert [i.id for i in bob.correspondents(reload=True)] == [alice.id]
+
+        loaded = alice.load_correspondents()
+        assert set(loaded) == set([bob.id, charlie.id])
+        for counterparty_id, (identity, accounts) in loaded.items():
+            assert identity.id == counterparty_id
+            assert len(accounts) == 4
+            assert sorted([a.type.value for a in accounts]) == sorted([
+                models.AccountType.NOSTRO_ASSET.value, models.AccountType.NOSTRO_ASSET.value,
+                models.AccountType.VOSTRO_LIABILITY.value, models.AccountType.VOSTRO_LIABILITY.value,
+            ])
+            assert set([a.details for a in accounts]) == set([alice.id, counterparty_id])
+
+        # matches the lazy per-correspondent lookup
+        lazy = alice.get_correspondent_accounts(bob)
+        assert sorted([a.id for a in lazy]) == sorted([a.id for a in loaded[bob.id][1]])
+
+    def test_connection_pool_e2e(self):
+        models.set_connection_info(DB_FILEPATH, reuse_connections=True)
+        try:
+            assert models.Account.query_builder_class is models.PooledQueryBuilder
+            assert models.DeletedModel.query_builder_class is models.PooledQueryBuilder
+            with models.PooledContext(DB_FILEPATH) as cursor:
+                cursor.execute('pragma journal_mode')
+                assert cursor.fetchone()[0] == 'wal'
+                cursor.execute('pragma temp_store')
+                assert cursor.fetchone()[0] == 2
+                connection = cursor.connection
+
+            # the connection is kept for the thread
+            models.Currency.query().count()
+            with models.PooledContext(DB_FILEPATH) as cursor:
+                assert cursor.connection is connection
+            connections = []
+            def other_thread():
+                with models.PooledContext(DB_FILEPATH) as cursor:
+                    connections.append(cursor.connection)
+                models.close_pools()
+            thread = threading.Thread(target=other_thread)
+            thread.start()
+            thread.join()
+            assert connections[0] is not connection
+
+            # nested writes are committed or rolled back by the outermost context
+            with self.assertRaises(ValueError):
+                with models.PooledContext(DB_FILEPATH):
+                    models.Currency.insert({
+                        'name': 'Test', 'prefix_symbol': 'T', 'fx_symbol': 'TST',
+                        'base': 100, 'unit_divisions': 1,
+                    })
+                    assert models.Currency.query({'fx_symbol': 'TST'}).count() == 1
+                    raise ValueError('rollback')
+            assert models.Currency.query({'fx_symbol': 'TST'}).count() == 0
+
+            alice, bob, correspondence = self.setup_correspondence()
+            entries, _ = correspondence.pay_correspondent(alice, bob, 100, os.urandom(16))
+            txn = models.Transaction.prepare(
+                entries, str(time()),
+                auth_scripts=self.sign_entries(
+                    entries, self.seed_alice, self.committed_script_alice
+                )
+            )
+            txn.save()
+            balances = correspondence.balances()
+            assert balances[alice.id] == -100 and balances[bob.id] == 100, balances
+
+            # changing the pragmas reopens the connection
+            models.set_connection_info(
+                DB_FILEPATH, reuse_connections=True,
+                pragmas={**models.DEFAULT_PRAGMAS, 'temp_store': 'file'}
+            )
+            with models.PooledContext(DB_FILEPATH) as cursor:
+                assert cursor.connection is not connection
+                cursor.execute('pragma temp_store')
+                assert cursor.fetchone()[0] == 1
+        finally:
+            models.set_connection_info(DB_FILEPATH)
+            models.close_pools()
+        assert models.Account.query_builder_class is not models.PooledQueryBuilder
+
+    def test_sharding_e2e(self):
+        shards = ['tests/shard0.db', 'tests/shard1.db']
+        self.automigrate()
+        for shard in shards:
+            sqloquent.tools.automigrate(MIGRATIONS_PATH, shard)
+
+        def count(path: str, table: str, column: str, value: str) -> int:
+            connection = sqlite3.connect(path)
+            try:
+                return connection.execute(
+                    f'select count(*) from {table} where {column} = ?', [value]
+                ).fetchone()[0]
+            finally:
+                connection.close()
+
+        models.set_connection_info(DB_FILEPATH, shards=shards)
+        try:
+            currency = self.setup_currency()
+            parties = [
+                (models.Identity.insert({'name': name, 'pubkey': pkey, 'seed': seed}), lock)
+                for name, seed, pkey, lock in (
+                    ('Alice', self.seed_alice, self.pkey_alice, self.locking_script_alice),
+                    ('Bob', self.seed_bob, self.pkey_bob, self.locking_script_bob),
+                )
+            ]
+            alice, bob = parties[0][0], parties[1][0]
+
+            # assign the Ledgers to different shards
+            ledger_data = [
+                {'name': 'Current Ledger', 'identity_id': i.id, 'currency_id': currency.id}
+                for i, _ in parties
+            ]
+            ledger_ids = [models.Ledger.generate_id({**d}) for d in ledger_data]
+            shard_map = models.ShardMap(
+                DB_FILEPATH, shards, {ledger_ids[0]: 0, ledger_ids[1]: 1}
+            )
+            models.set_connection_info(DB_FILEPATH, shards=shard_map)
+            ledgers = []
+            for data in ledger_data:
+                ledger = models.Ledger.insert(data)
+                for acct in ledger.setup_basic_accounts():
+                    acct.save()
+                ledgers.append(ledger)
+            assert [l.id for l in ledgers] == ledger_ids
+            correspondence = self.link_parties([
+                (identity, ledger, lock)
+                for (identity, lock), ledger in zip(parties, ledgers)
+            ])
+
+            # each Ledger and its Accounts are stored only in its shard
+            for i, ledger in enumerate(ledgers):
+                assert count(shards[i], 'ledgers', 'id', ledger.id) == 1
+                assert count(shards[1-i], 'ledgers', 'id', ledger.id) == 0
+                assert count(DB_FILEPATH, 'ledgers', 'id', ledger.id) == 0
+                assert count(shards[i], 'accounts', 'ledger_id', ledger.id) == \
+                    models.Account.query({'ledger_id': ledger.id}).count() > 0
+            assert count(DB_FILEPATH, 'correspondences', 'id', correspondence.id) == 1
+            # reads span all shards
+            assert models.Ledger.query().count() == 2
+            assert set(correspondence.get_accounts(reload=True)) == {alice.id, bob.id}
+
+            # a cross-shard Transaction is committed atomically
+            entries, _ = correspondence.pay_correspondent(alice, bob, 100, os.urandom(16))
+            txn = models.Transaction.prepare(
+                entries, str(time()),
+                auth_scripts=self.sign_entries(
+                    entries, self.seed_alice, self.committed_script_alice
+                )
+            )
+            with models.ShardedContext(DB_FILEPATH):
+                txn.save()
+            assert count(shard_map.shard_for(sorted(ledger_ids)[0]), 'transactions', 'id', txn.id) == 1
+            assert count(shard_map.shard_for(sorted(ledger_ids)[1]), 'transactions', 'id', txn.id) == 0
+            for entry in txn.entries:
+                assert count(shard_map.shard_for(entry.account.ledger_id), 'entries', 'id', entry.id) == 1
+            assert {e.id for e in models.Transaction.find(txn.id).entries} == {e.id for e in entries}
+            balances = correspondence.balances()
+            assert balances[alice.id] == -100 and balances[bob.id] == 100, balances
+
+            # a failure rolls back the writes to every shard
+            entries, _ = correspondence.pay_correspondent(alice, bob, 50, os.urandom(16))
+            txn2 = models.Transaction.prepare(
+                entries, str(time()),
+                auth_scripts=self.sign_entries(
+                    entries, self.seed_alice, self.committed_script_alice
+                )
+            )
+            with self.assertRaises(ValueError):
+                with models.ShardedContext(DB_FILEPATH):
+                    txn2.save()
+                    assert models.Transaction.query().count() == 2
+                    raise ValueError('rollback')
+            assert models.Transaction.query().count() == 1
+            for shard in shards:
+                for entry in txn2.entries:
+                    assert count(shard, 'entries', 'id', entry.id) == 0
+
+            # updates and deletes by id run only in the shard of the row
+            entry = txn.entries[0]
+            schema = shard_map.schema_for(entry.account.ledger_id)
+            statements = []
+            with models.ShardedContext(DB_FILEPATH) as cursor:
+                cursor.connection.set_trace_callback(statements.append)
+                try:
+                    assert models.Entry.query({'id': entry.id}).update(
+                        {'description': 'routed'}
+                    ) == 1
+                finally:
+                    cursor.connection.set_trace_callback(None)
+            updates = [s for s in statements if s.lower().startswith('update')]
+            assert len(updates) == 1 and f'{schema}.entries' in updates[0], updates
+            assert models.Entry.find(entry.id).description == 'routed'
+
+            # writers to different shards commit concurrently
+            barrier = threading.Barrier(2)
+            errors = []
+            def write(ledger: models.Ledger) -> None:
+                try:
+                    with models.ShardedContext(DB_FILEPATH) as cursor:
+                        cursor.execute(
+                            'update ledgers set name = ? where id = ?',
+                            ['Concurrent Ledger', ledger.id]
+                        )
+                        barrier.wait(timeout=10)
+                except BaseException as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=write, args=(l,)) for l in ledgers]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert errors == [], errors
+            assert models.Ledger.query({'name': 'Concurrent Ledger'}).count() == 2
+
+            # updates and deletes without a where clause reach every shard
+            n = len(txn.entries)
+            assert models.Entry.query().update({'description': 'sharded'}) == n
+            assert models.Entry.query({'description': 'sharded'}).count() == n
+            assert models.Entry.query().delete() == n
+            assert models.Entry.query().count() == 0
+        finally:
+            models.set_connection_info(DB_FILEPATH)
+            models.close_pools()
+            for path in [*shards, *[f'{p}-journal' for p in [DB_FILEPATH, *shards]]]:
+                if isfile(path):
+                    os.remove(path)
+
+    def test_snapshot_e2e(self):
+        models.set_connection_info(DB_FILEPATH, reuse_connections=True)
+        alice, bob, correspondence = self.setup_correspondence()
+
+        def pay(amount: int) -> None:
+            entries, _ = correspondence.pay_correspondent(alice, bob, amount, os.urandom(16))
+            models.Transaction.prepare(
+                entries, str(time()),
+                auth_scripts=self.sign_entries(
+                    entries, self.seed_alice, self.committed_script_alice
+                )
+            ).save()
+
+        try:
+            pay(100)
+            with models.Snapshot(DB_FILEPATH) as snapshot:
+                assert snapshot.connection is not None
+                # posting in another thread is not blocked or visible
+                errors = []
+                def other_thread():
+                    try:
+                        pay(50)
+                        reports.append(correspondence.balances())
+                    except BaseException as e:
+                        errors.append(e)
+                    finally:
+                        models.close_pools()
+                reports = []
+                thread = threading.Thread(target=other_thread)
+                thread.start()
+                thread.join()
+                assert not errors, errors
+                assert reports[0][alice.id] == -150, reports
+                balances = correspondence.balances()
+                assert balances[alice.id] == -100 and balances[bob.id] == 100, balances
+                assert models.Transaction.query().count() == 1
+                # writes fail within the snapshot
+                with self.assertRaises(sqlite3.OperationalError):
+                    models.Currency.insert({
+                        'name': 'Test', 'prefix_symbol': 'T', 'fx_symbol': 'TST',
+                        'base': 100, 'unit_divisions': 1,
+                    })
+            assert snapshot.connection is None
+            assert models.Transaction.query().count() == 2
+
+            # models that do not reuse connections only read through
+            # snapshots when opted in
+            models.set_connection_info(DB_FILEPATH)
+            assert models.Transaction.query_builder_class is sqloquent.SqlQueryBuilder
+            with models.Snapshot(DB_FILEPATH):
+                assert models.Transaction.query().count() == 2
+                pay(10)
+                assert models.Transaction.query().count() == 3
+
+            models.set_connection_info(DB_FILEPATH, snapshots=True)
+            assert models.Transaction.query_builder_class is models.SnapshotQueryBuilder
+            # sqloquent's shared models are left alone
+            assert models.DeletedModel.query_builder_class is sqloquent.SqlQueryBuilder
+            assert sqloquent.Attachment.query_builder_class is sqloquent.SqlQueryBuilder
+            with models.Snapshot(DB_FILEPATH):
+                pay_thread = threading.Thread(target=pay, args=(25,))
+                pay_thread.start()
+                pay_thread.join()
+                assert models.Transaction.query().count() == 3
+            assert models.Transaction.query().count() == 4
+
+            # snapshots require WAL journal mode
+            connection = sqlite3.connect('tests/rollback.db')
+            connection.execute('create table t (id integer)')
+            connection.close()
+            with self.assertRaises(ValueError):
+                with models.Snapshot('tests/rollback.db'):
+                    pass
+        finally:
+            models.set_connection_info(DB_FILEPATH)
+            models.close_pools()
+            if isfile('tests/rollback.db'):
+                os.remove('tests/rollback.db')
+
+    def test_memory_engine_e2e(self):
+        alice, bob, correspondence = self.setup_correspondence()
+
+        def pay(amount: int) -> models.Transaction:
+            entries, _ = correspondence.pay_correspondent(alice, bob, amount, os.urandom(16))
+            txn = models.Transaction.prepare(
+                entries, str(time()),
+                auth_scripts=self.sign_entries(
+                    entries, self.seed_alice, self.committed_script_alice
+                )
+            )
+            txn.save()
+            return txn
+
+        def count_on_disk(table: str) -> int:
+            connection = sqlite3.connect(DB_FILEPATH)
+            try:
+                return connection.execute(f'select count(*) from {table}').fetchone()[0]
+            finally:
+                connection.close()
+
+        pay(100)
+        engine = models.MemoryEngine(DB_FILEPATH)
+        child = None
+        try:
+            models.set_connection_info(engine.connection_info)
+            assert models.Account.query_builder_class is models.MemoryQueryBuilder
+            assert engine.diff() == {}
+
+            # the simulation runs in memory only
+            txn = pay(50)
+            balances = correspondence.balances()
+            assert balances[alice.id] == -150 and balances[bob.id] == 150, balances
+            assert models.Transaction.query().count() == 2
+            assert count_on_disk('transactions') == 1
+            diff = engine.diff()
+            assert set(diff['transactions']) == {txn.id}
+            assert set(diff['entries']) == {e.id for e in txn.entries}
+
+            # forks of forks diff back into their parent
+            child = engine.fork()
+            models.set_connection_info(child.connection_info)
+            txn2 = pay(25)
+            account = models.Account.query().first()
+            account.description = 'simulated'
+            account.save()
+            assert models.Transaction.query().count() == 3
+            changed = sum([len(rows) for rows in child.diff().values()])
+            assert child.apply() == changed > 0
+            child.close()
+            models.set_connection_info(engine.connection_info)
+            assert models.Transaction.query().count() == 3
+            assert set(engine.diff()['transactions']) == {txn.id, txn2.id}
+            assert engine.diff()['accounts'][account.id]['description'] == 'simulated'
+
+            # deletes are tracked and the changes are written back
+            models.Transaction.find(txn2.id).delete()
+            models.Entry.query().is_in('id', [e.id for e in txn2.entries]).delete()
+            assert engine.diff()['transactions'][txn2.id] is None
+            assert engine.apply() > 0
+            assert engine.diff() == {}
+            models.set_connection_info(DB_FILEPATH)
+            assert count_on_disk('transactions') == 2
+            assert models.Transaction.find(txn.id) is not None
+            assert models.Transaction.find(txn2.id) is None
+            assert models.Account.find(account.id).description == 'simulated'
+            balances = correspondence.balances()
+            assert balances[alice.id] == -150 and balances[bob.id] == 150, balances
+
+            # rows changed in the target since the fork are not overwritten
+            models.set_connection_info(engine.connection_info)
+            forked = models.Account.find(account.id)
+            forked.description = 'forked'
+            forked.save()
+            models.set_connection_info(DB_FILEPATH)
+            account = models.Account.find(account.id)
+            account.description = 'concurrent'
+            account.save()
+            with self.assertRaises(ValueError) as e:
+                engine.apply()
+            assert f'accounts:{account.id}' in str(e.exception)
+            assert models.Account.find(account.id).description == 'concurrent'
+            assert account.id in engine.diff()['accounts']
+        finally:
+            models.set_connection_info(DB_FILEPATH)
+            models.close_pools()
+            if child is not None:
+                child.close()
+            engine.close()
+
+    def test_clearing_house_e2e(self):
+        currency = self.setup_currency()
+        alice, ledger_alice = self.setup_party(
+            currency, 'Alice', self.seed_alice, self.pkey_alice
+        )
+        bob, ledger_bob = self.setup_party(
+            currency, 'Bob', self.seed_bob, self.pkey_bob
+        )
+        charlie, ledger_charlie = self.setup_party(
+            currency, 'Charlie', self.seed_charlie, self.pkey_charlie
+        )
+        committed_script_charlie = tapescript.tools.make_delegate_key_lock(self.pkey_charlie)
+        locking_script_charlie = tapescript.tools.make_taproot_lock(
+            self.pkey_charlie, committed_script_charlie
+        ).bytes
+        cor_ab = self.link_parties([
+            (alice, ledger_alice, self.locking_script_alice),
+            (bob, ledger_bob, self.locking_script_bob),
+        ], {'credit_limits': {alice.id: 1000, bob.id: 1000}})
+        cor_bc = self.link_parties([
+            (bob, ledger_bob, self.locking_script_bob),
+            (charlie, ledger_charlie, locking_script_charlie),
+        ], {'credit_limits': {bob.id: 1000, charlie.id: 1000}})
+
+        house = clearing.ClearingHouse()
+        house.add(cor_ab)
+        house.add(cor_bc)
+
+        # alice and charlie have no Correspondence, so payments route through bob
+        route = house.find_route(alice.id, charlie.id, 100)
+        assert [(a, b, c.id) for a, b, c in route] == [
+            (alice.id, bob.id, cor_ab.id), (bob.id, charlie.id, cor_bc.id)
+        ]
+        assert house.find_route(alice.id, charlie.id, 5000) is None
+
+        # the cycle is netted before routing: alice owes 250 in total
+        payments = [
+            (alice.id, charlie.id, 300),
+            (charlie.id, bob.id, 100),
+            (bob.id, alice.id, 50),
+        ]
+        assert clearing.ClearingGraph.net_positions(payments) == {
+            alice.id: -250, bob.id: 50, charlie.id: 200
+        }
+        before = {cid: {**b} for cid, b in house.graph.balances.items()}
+        settlements = house.clear(payments, os.urandom(16))
+        assert len(settlements) == 2
+
+        # nothing is saved yet, so the cached balances are unchanged
+        assert house.graph.balances == before
+        signers = {
+            alice.id: (self.seed_alice, self.committed_script_alice),
+            bob.id: (self.seed_bob, self.committed_script_bob),
+        }
+        for correspondence, entries, _, details in settlements:
+            assert details['clearing_root'] == netting.payments_root(payments)
+            payer_id = {
+                cor_ab.id: alice.id, cor_bc.id: bob.id
+            }[correspondence.id]
+            txn = models.Transaction.prepare(
+                entries, str(time()), details=details,
+                auth_scripts=self.sign_entries(entries, *signers[payer_id])
+            )
+            txn.save()
+
+        # the cached balances are updated once refreshed after saving
+        assert house.graph.balances == before
+        house.refresh()
+        cached = {cid: {**b} for cid, b in house.graph.balances.items()}
+        assert cached[cor_ab.id] == {alice.id: -250, bob.id: 250}
+        assert cached[cor_bc.id] == {bob.id: -200, charlie.id: 200}
+
+        # a payment without enough credit fails and leaves the balances intact
+        with self.assertRaises(ValueError) as e:
+            house.clear([(charlie.id, alice.id, 5000)], os.urandom(16))
+        assert 'no route' in str(e.exception)
+        assert house.graph.balances == cached
+        assert house.find_route(bob.id, alice.id, 1250) is not None
+        assert house.find_route(bob.id, alice.id, 1251) is None
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,10 @@
+from asyncio import run
 from context import models, bookchain, asyncql, helpers
 from genericpath import isfile
 from sqlite3 import OperationalError
 import os
+import sqlite3
+import sqloquent.tools
 import unittest
 
 
@@ -14,6 +17,7 @@ class TestRegressions(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         bookchain.set_connection_info(DB_FILEPATH)
+        asyncql.set_connection_info(DB_FILEPATH)
         super().setUpClass()
 
     def setUp(self):
@@ -27,6 +31,9 @@ class TestRegressions(unittest.TestCase):
                 os.remove(f'{MIGRATIONS_PATH}/{file}')
         if isfile(DB_FILEPATH):
             os.remove(DB_FILEPATH)
+        # the rollup_heads table is only looked up once per database
+        models.TxRollupHead._tables.clear()
+        asyncql.TxRollupHead._tables.clear()
         super().tearDown()
 
     def test_AccountCategory_query_does_not_mutate_conditions(self):
@@ -59,6 +66,81 @@ class TestRegressions(unittest.TestCase):
         asyncql.Account.query(conditions)
         assert conditions == original, (conditions, original)
 
+    def migrate_without_rollup_heads(self):
+        sqloquent.tools.publish_migrations(MIGRATIONS_PATH)
+        for model in (
+            models.Identity, models.Currency, models.Ledger, models.Account,
+            models.Entry,
+        ):
+            name = model.__name__
+            m = sqloquent.tools.make_migration_from_model(model, name)
+            with open(f'{MIGRATIONS_PATH}/create_{name}.py', 'w') as f:
+                f.write(m)
+        sqloquent.tools.automigrate(MIGRATIONS_PATH, DB_FILEPATH)
+
+    def test_balances_without_rollup_heads_table(self):
+        self.migrate_without_rollup_heads()
+        identity = models.Identity.insert({'name': 'Alice'})
+        currency = models.Currency.insert({
+            'name': 'Test', 'prefix_symbol': 'T', 'base': 10, 'unit_divisions': 2,
+        })
+        ledger = models.Ledger.insert({
+            'name': 'Test', 'identity_id': identity.id, 'currency_id': currency.id,
+        })
+        for account in ledger.setup_basic_accounts():
+            account.save()
+        asset = models.Account.query({'ledger_id': ledger.id, 'type': models.AccountType.ASSET}).first()
+        models.Entry.insert({
+            'type': models.EntryType.DEBIT, 'amount': 100, 'nonce': os.urandom(16),
+            'account_id': asset.id,
+        })
+        assert asset.balance() == 100
+        assert ledger.balances()[asset.id][0] == 100
+        assert models.TxRollupHead._tables == {DB_FILEPATH: False}
+
+    def test_async_balances_without_rollup_heads_table(self):
+        self.migrate_without_rollup_heads()
+        identity = run(asyncql.Identity.insert({'name': 'Alice'}))
+        currency = run(asyncql.Currency.insert({
+            'name': 'Test', 'prefix_symbol': 'T', 'base': 10, 'unit_divisions': 2,
+        }))
+        ledger = run(asyncql.Ledger.insert({
+            'name': 'Test', 'identity_id': identity.id, 'currency_id': currency.id,
+        }))
+        for account in ledger.setup_basic_accounts():
+            run(account.save())
+        asset = run(asyncql.Account.query({
+            'ledger_id': ledger.id, 'type': asyncql.AccountType.ASSET
+        }).first())
+        run(asyncql.Entry.insert({
+            'type': asyncql.EntryType.DEBIT, 'amount': 100, 'nonce': os.urandom(16),
+            'account_id': asset.id,
+        }))
+        assert run(asset.balance()) == 100
+        assert run(ledger.balances())[asset.id][0] == 100
+        assert asyncql.TxRollupHead._tables == {DB_FILEPATH: False}
+
+    def test_upgrade_schema_adds_rollup_id_column(self):
+        # a transactions table created before the rollup_id column
+        self.migrate_without_rollup_heads()
+        connection = sqlite3.connect(DB_FILEPATH)
+        connection.execute(
+            'create table transactions (id text, entry_ids text, ledger_ids text, '
+            'timestamp text, details blob, auth_scripts blob, description text)'
+        )
+        connection.execute("insert into transactions (id) values ('old')")
+        connection.commit()
+        connection.close()
+        with self.assertRaises(OperationalError):
+            models.Transaction.find('old')
+
+        assert bookchain.upgrade_schema(DB_FILEPATH) == ['transactions.rollup_id']
+        assert bookchain.upgrade_schema(DB_FILEPATH) == []
+        txn = models.Transaction.find('old')
+        assert txn is not None and txn.rollup_id is None
+        assert models.Transaction.query().is_null('rollup_id').count() == 1
+        assert run(asyncql.Transaction.find('old')) is not None
+
 
 if __name__ == '__main__':
     unittest.main()